@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# Checks that a plain dhop hop stays cheap to start.
+#
+# Copyright (C) 2013-2018, Abstrys / Eron Hennessey
+#
+# This file is released under the terms of the GNU General Public License, v3.
+# For details about this license, see LICENSE.txt or go to
+# <http://www.gnu.org/licenses/gpl.html>
+#
+# Usage: python3 bench/check_startup.py [--update]
+#
+# This runs a hop the way the shell wrappers do (see 'dhop init'), in a
+# temporary home directory, and compares it against the budget recorded in
+# startup_budget.json:
+#
+# * the modules that dhop imports on top of a bare interpreter (measured with
+#   'python -X importtime'). Any module that isn't in the budget is an error.
+# * the total import time of those modules, and the time a hop takes beyond
+#   starting the interpreter. Either one going over the budget (plus
+#   TOLERANCE, since timings vary between runs) is an error.
+#
+# With --update, the current measurements are written to startup_budget.json
+# instead. Do that (and commit the result) only when a change really needs to
+# import something new on the hop path.
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BUDGET_FILE = os.path.join(BENCH_DIR, 'startup_budget.json')
+DHOP_PY = os.path.join(BENCH_DIR, os.pardir, 'src', 'dhop', 'dhop.py')
+
+# the same launcher that the shell wrappers use.
+LAUNCHER = ('import sys; sys.path.insert(0, sys.argv.pop(1)); import dhop; '
+            'sys.exit(dhop.main(sys.argv[1:]))')
+
+RUNS = 15
+TOLERANCE = 1.5
+
+
+def parse_importtime(output):
+    """
+    Return a dict of {module: cumulative microseconds} for the top-level
+    imports in the output of 'python -X importtime'.
+    """
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        name = fields[2].rstrip()
+        # nested imports are indented; only count the top-level ones, since
+        # their cumulative time includes the nested ones.
+        if name.startswith('  '):
+            continue
+        modules[name.strip()] = int(fields[1])
+    return modules
+
+
+def run(args, env, stderr=subprocess.DEVNULL):
+    """
+    Run a Python command and return its stderr output and how long it took,
+    in milliseconds.
+    """
+    start = time.monotonic()
+    result = subprocess.run([sys.executable] + args, env=env,
+                            stdout=subprocess.DEVNULL, stderr=stderr,
+                            universal_newlines=True)
+    return result.stderr, (time.monotonic() - start) * 1000
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure():
+    """
+    Measure a hop in a temporary home directory.
+    """
+    home_dir = tempfile.mkdtemp(prefix='dhop-startup-')
+    try:
+        bin_dir = os.path.join(home_dir, 'bin')
+        os.mkdir(bin_dir)
+        shutil.copy(DHOP_PY, bin_dir)
+
+        env = dict(os.environ, HOME=home_dir)
+        env.pop('DHOP_CD_FD', None)
+        env.pop('DHOP_BACKEND', None)
+
+        hop = ['-I', '-S', '-c', LAUNCHER, bin_dir, 'here']
+        bare = ['-I', '-S', '-c', 'pass']
+
+        # set up a location, which also caches dhop's bytecode.
+        run(['-I', '-S', '-c', LAUNCHER, bin_dir, 'set', 'here', home_dir], env)
+
+        baseline = parse_importtime(
+            run(['-X', 'importtime'] + bare, env, subprocess.PIPE)[0])
+
+        # import times vary a lot from run to run, so keep the median for
+        # each module.
+        samples = {}
+        for x in range(RUNS):
+            output = run(['-X', 'importtime'] + hop, env, subprocess.PIPE)[0]
+            for (module, us) in parse_importtime(output).items():
+                if module not in baseline and module != 'dhop':
+                    samples.setdefault(module, []).append(us)
+        imports = dict((module, median(us)) for (module, us) in
+                       samples.items())
+
+        hop_ms = median([run(hop, env)[1] for x in range(RUNS)])
+        bare_ms = median([run(bare, env)[1] for x in range(RUNS)])
+    finally:
+        shutil.rmtree(home_dir)
+
+    return {
+        'modules': imports,
+        'import_us': sum(imports.values()),
+        'overhead_ms': round(hop_ms - bare_ms, 1),
+    }
+
+
+def main(args):
+    current = measure()
+
+    print("modules imported for a hop: %s" %
+          (", ".join(sorted(current['modules'])) or "(none)"))
+    print("import time:    %6d us" % current['import_us'])
+    print("start-up cost:  %6.1f ms (over a bare interpreter)" %
+          current['overhead_ms'])
+
+    if '--update' in args:
+        budget_file = open(BUDGET_FILE, 'w')
+        json.dump(current, budget_file, indent=2, sort_keys=True)
+        budget_file.write('\n')
+        budget_file.close()
+        print("updated %s" % BUDGET_FILE)
+        return 0
+
+    budget_file = open(BUDGET_FILE, 'r')
+    budget = json.load(budget_file)
+    budget_file.close()
+
+    errors = []
+    for module in sorted(set(current['modules']) - set(budget['modules'])):
+        errors.append("new import on the hop path: %s" % module)
+    if current['import_us'] > budget['import_us'] * TOLERANCE:
+        errors.append("import time is over budget (%d us)" %
+                      budget['import_us'])
+    if current['overhead_ms'] > budget['overhead_ms'] * TOLERANCE:
+        errors.append("start-up cost is over budget (%.1f ms)" %
+                      budget['overhead_ms'])
+
+    for error in errors:
+        print("!! %s" % error)
+
+    if len(errors) != 0:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# Benchmarks dhop's store, name resolution, hops and copies at scale.
+#
+# Copyright (C) 2013-2018, Abstrys / Eron Hennessey
+#
+# This file is released under the terms of the GNU General Public License, v3.
+# For details about this license, see LICENSE.txt or go to
+# <http://www.gnu.org/licenses/gpl.html>
+#
+# Usage: python3 bench/run_bench.py [--quick] [--backend NAME]
+#                                   [--other-fs DIR] [--output FILE]
+#                                   [--compare FILE]
+#
+# Everything runs in temporary home directories, with synthetic stores of
+# 1k, 10k and 100k locations (and a deep directory stack), for each store
+# backend. For each store, it measures:
+#
+# * init: creating a Dhop object, which loads the store.
+# * write: saving one changed location (Dhop.__write_store__), and for the
+#   JSON backend, compact: rewriting the whole snapshot.
+# * resolve hit, resolve miss and resolve sub: resolve_location_or_path for a
+#   stored name, a name that isn't stored, and 'name/sub/path'.
+# * hop: a whole hop through dhop.sh, from starting bash to the cd.
+#
+# It also times 'dhop cp' and 'dhop mv' on a tree of many small files and one
+# of a few large files. With --other-fs, trees are also moved to a directory
+# on another filesystem, which means copying them.
+#
+# Each timing is the median of several runs, in milliseconds. The results are
+# printed and saved as JSON (in bench/results, unless --output is given), so
+# that a run on one version can be compared with a run on another using
+# --compare. Timings that are more than TOLERANCE times slower than in the
+# compared file are reported as regressions.
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+SRC_DIR = os.path.join(BENCH_DIR, os.pardir, 'src')
+
+# the same launcher that the shell wrappers use.
+LAUNCHER = ('import sys; sys.path.insert(0, sys.argv.pop(1)); import dhop; '
+            'sys.exit(dhop.main(sys.argv[1:]))')
+
+STORE_SIZES = [1000, 10000, 100000]
+STACK_DEPTH = 5000
+# locations point at this many real directories (in turn), each with a
+# 'sub/path' directory under it.
+TARGET_DIRS = 200
+
+RUNS = 15
+RESOLVE_CALLS = 200
+COPY_RUNS = 3
+
+# (number of files, size of each) for the copy trees.
+SMALL_FILES = (5000, 4096)
+LARGE_FILES = (4, 64 * 1024 * 1024)
+
+TOLERANCE = 1.25
+
+sys.path.insert(0, os.path.join(SRC_DIR, 'dhop'))
+import dhop
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def ms_since(start):
+    return (time.perf_counter() - start) * 1000
+
+
+def make_home(size, backend):
+    """
+    Make a temporary home directory with a store of size locations, and
+    return its path. Location n is called 'loc<n>'.
+    """
+    home_dir = tempfile.mkdtemp(prefix='dhop-bench-')
+    targets = []
+    for n in range(TARGET_DIRS):
+        target = os.path.join(home_dir, 'dirs', 'd%03d' % n)
+        os.makedirs(os.path.join(target, 'sub', 'path'))
+        targets.append(target)
+
+    data = {
+        'locations': dict(('loc%d' % n, targets[n % TARGET_DIRS])
+                          for n in range(size)),
+        'mark': targets[0],
+        'stack': [targets[n % TARGET_DIRS] for n in range(STACK_DEPTH)],
+    }
+    store_file = open(os.path.join(home_dir, dhop.Dhop.DHOP_STORE), 'w')
+    json.dump(data, store_file)
+    store_file.close()
+
+    # a new SQLite store copies the JSON store into itself.
+    if backend == 'sqlite':
+        dhop.SqliteStore(home_dir).db.close()
+
+    bin_dir = os.path.join(home_dir, 'bin')
+    os.mkdir(bin_dir)
+    shutil.copy(os.path.join(SRC_DIR, 'dhop', 'dhop.py'), bin_dir)
+    shutil.copy(os.path.join(SRC_DIR, 'dhop.sh'), bin_dir)
+    return home_dir
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Throw away anything printed (such as errors for names that don't
+    resolve).
+    """
+    devnull = open(os.devnull, 'w')
+    with contextlib.redirect_stdout(devnull):
+        with contextlib.redirect_stderr(devnull):
+            yield
+    devnull.close()
+
+
+def bench_store(size, backend, results):
+    """
+    Time loading, saving and resolving with a store of size locations.
+    """
+    home_dir = make_home(size, backend)
+    os.environ['HOME'] = home_dir
+    os.environ['DHOP_BACKEND'] = backend
+    prefix = '%s %d ' % (backend, size)
+    try:
+        # the first run builds the location index and the stat cache, as the
+        # first hop after a change would.
+        with quiet():
+            dhop.Dhop().run(['resolve', 'loc%d' % (size // 2)])
+
+        times = []
+        for x in range(RUNS):
+            start = time.perf_counter()
+            dhop_object = dhop.Dhop()
+            times.append(ms_since(start))
+        results[prefix + 'init'] = median(times)
+
+        times = []
+        for x in range(RUNS):
+            dhop_object = dhop.Dhop()
+            dhop_object.backend.set_location('bench-write', '%s/dirs/d%03d' %
+                                             (home_dir, x % TARGET_DIRS))
+            start = time.perf_counter()
+            dhop_object.__write_store__()
+            times.append(ms_since(start))
+        results[prefix + 'write'] = median(times)
+
+        if backend == 'json':
+            times = []
+            for x in range(RUNS):
+                dhop_object = dhop.Dhop()
+                start = time.perf_counter()
+                dhop_object.backend.compact()
+                times.append(ms_since(start))
+            results[prefix + 'compact'] = median(times)
+
+        dhop_object = dhop.Dhop()
+        names = {
+            'resolve hit': ['loc%d' % n for n in range(0, size, 97)],
+            'resolve miss': ['nosuch%d' % n for n in range(RESOLVE_CALLS)],
+            'resolve sub': ['loc%d/sub/path' % n for n in range(0, size, 97)],
+        }
+        for (name, queries) in sorted(names.items()):
+            queries = (queries * RESOLVE_CALLS)[:RESOLVE_CALLS]
+            times = []
+            with quiet():
+                for query in queries:
+                    start = time.perf_counter()
+                    dhop_object.resolve_location_or_path(query)
+                    times.append(ms_since(start))
+            results[prefix + name] = median(times)
+        dhop_object.stat_cache.save()
+
+        results[prefix + 'hop'] = bench_hop(home_dir, backend,
+                                            'loc%d' % (size // 3))
+    finally:
+        shutil.rmtree(home_dir)
+
+
+def bench_hop(home_dir, backend, name):
+    """
+    Time a hop through dhop.sh, the way an interactive shell runs it.
+    """
+    env = dict(os.environ, HOME=home_dir, DHOP_BACKEND=backend,
+               DHOP_SOCKET=os.path.join(home_dir, 'no-server.sock'))
+    env.pop('DHOP_CD_FD', None)
+    command = ['bash', '--noprofile', '--norc', '-c',
+               '. "$HOME/bin/dhop.sh" "$1"', 'bash', name]
+
+    times = []
+    for x in range(RUNS + 1):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        times.append(ms_since(start))
+    # the first run compiles dhop.py.
+    return median(times[1:])
+
+
+def make_tree(path, count, size):
+    """
+    Make a tree of count files of size bytes, 100 to a directory.
+    """
+    block = os.urandom(min(size, 1024 * 1024))
+    for n in range(count):
+        dir_path = os.path.join(path, 'd%03d' % (n // 100))
+        if n % 100 == 0:
+            os.makedirs(dir_path)
+        tree_file = open(os.path.join(dir_path, 'f%05d' % n), 'wb')
+        written = 0
+        while written < size:
+            written += tree_file.write(block[:size - written])
+        tree_file.close()
+
+
+def dhop_command(home_dir, args):
+    """
+    Run a dhop command in home_dir, and return how long it took.
+    """
+    env = dict(os.environ, HOME=home_dir)
+    env.pop('DHOP_CD_FD', None)
+    env.pop('DHOP_BACKEND', None)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-I', '-S', '-c', LAUNCHER,
+                    os.path.join(home_dir, 'bin'), args[0]] + args[1:],
+                   env=env, stdout=subprocess.DEVNULL, check=True)
+    return ms_since(start)
+
+
+def bench_copies(other_fs, results, throughput):
+    """
+    Time 'dhop cp' and 'dhop mv' on trees of small and large files.
+    """
+    home_dir = make_home(0, 'json')
+    try:
+        for (label, (count, size)) in [('small files', SMALL_FILES),
+                                       ('large files', LARGE_FILES)]:
+            tree = os.path.join(home_dir, 'tree')
+            make_tree(tree, count, size)
+            total_mb = count * size / (1024.0 * 1024.0)
+
+            times = []
+            for x in range(COPY_RUNS):
+                copy = os.path.join(home_dir, 'copy')
+                times.append(dhop_command(home_dir, ['cp', tree, copy]))
+                shutil.rmtree(copy)
+            results['cp ' + label] = median(times)
+
+            times = []
+            for x in range(COPY_RUNS):
+                moved = os.path.join(home_dir, 'moved')
+                times.append(dhop_command(home_dir, ['mv', tree, moved]))
+                os.rename(moved, tree)
+            results['mv ' + label] = median(times)
+
+            if other_fs is not None:
+                times = []
+                for x in range(COPY_RUNS):
+                    moved = tempfile.mkdtemp(prefix='dhop-bench-', dir=other_fs)
+                    times.append(dhop_command(home_dir, ['mv', tree, moved]))
+                    # move it back for the next run.
+                    dhop_command(home_dir, ['mv', os.path.join(moved, 'tree'),
+                                            home_dir])
+                    shutil.rmtree(moved)
+                results['mv ' + label + ' (other fs)'] = median(times)
+
+            seconds = results['cp ' + label] / 1000.0
+            throughput['cp ' + label] = '%.0f files/s, %.1f MB/s' % (
+                count / seconds, total_mb / seconds)
+            shutil.rmtree(tree)
+    finally:
+        shutil.rmtree(home_dir)
+
+
+def compare(results, quick, old_path):
+    """
+    Print how the results compare with the ones saved in old_path, and
+    return the number of regressions.
+    """
+    old_file = open(old_path, 'r')
+    old = json.load(old_file)
+    old_file.close()
+
+    print("\ncompared with %s (%s):" % (old_path, old.get('version')))
+    names = set(results) & set(old['results'])
+    if old.get('quick') != quick:
+        # the copy trees are a different size in a quick run (the stores are
+        # named by their size, so only the same sizes are compared anyway).
+        print("(only one run is --quick, so copies aren't compared)")
+        names = [name for name in names if name.split()[0] not in ('cp', 'mv')]
+    regressions = 0
+    for name in sorted(names):
+        ratio = results[name] / max(old['results'][name], 0.001)
+        flag = ' '
+        if ratio > TOLERANCE:
+            flag = '!'
+            regressions += 1
+        print("%s %-36s %10.3f -> %10.3f ms (x%.2f)" %
+              (flag, name, old['results'][name], results[name], ratio))
+    if regressions != 0:
+        print("!! %d timing(s) more than %.2f times slower" %
+              (regressions, TOLERANCE))
+    return regressions
+
+
+def version():
+    """
+    Return the git version of the tree being benchmarked, if there is one.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=BENCH_DIR,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    global STORE_SIZES, SMALL_FILES, LARGE_FILES
+
+    options = {}
+    while len(args) > 0 and args[0].startswith('--'):
+        option = args.pop(0)[2:]
+        if option == 'quick':
+            options[option] = True
+        elif len(args) > 0:
+            options[option] = args.pop(0)
+        else:
+            print("usage: run_bench.py [--quick] [--backend NAME] "
+                  "[--other-fs DIR] [--output FILE] [--compare FILE]")
+            return 2
+
+    if 'quick' in options:
+        STORE_SIZES = [1000]
+        SMALL_FILES = (500, 4096)
+        LARGE_FILES = (2, 8 * 1024 * 1024)
+
+    backends = sorted(dhop.Dhop.BACKENDS)
+    if 'backend' in options:
+        if options['backend'] not in dhop.Dhop.BACKENDS:
+            print("unknown backend: %s (use one of: %s)" %
+                  (options['backend'], ", ".join(backends)))
+            return 2
+        backends = [options['backend']]
+
+    saved_environ = dict(os.environ)
+    results = {}
+    throughput = {}
+    try:
+        for backend in backends:
+            for size in STORE_SIZES:
+                bench_store(size, backend, results)
+        bench_copies(options.get('other-fs'), results, throughput)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+    for name in sorted(results):
+        print("%-38s %10.3f ms" % (name, results[name]))
+    for name in sorted(throughput):
+        print("%-38s %s" % (name, throughput[name]))
+
+    output = options.get('output')
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.mkdir(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, '%s.json' %
+                              time.strftime('%Y%m%d-%H%M%S'))
+    output_file = open(output, 'w')
+    json.dump({'version': version(), 'python': sys.version.split()[0],
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'quick': 'quick' in options, 'results': results,
+               'throughput': throughput}, output_file, indent=2,
+              sort_keys=True)
+    output_file.write('\n')
+    output_file.close()
+    print("saved %s" % output)
+
+    if ('compare' in options and
+            compare(results, 'quick' in options, options['compare']) != 0):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
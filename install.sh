@@ -31,3 +31,7 @@ echo Feel free to cut-and-paste the above line, since it refers to the actual
 echo install location. Then, you can simply type \'dhop\' on the command-line
 echo for help.
 echo
+echo Or, to define dhop as a shell function instead \(bash and zsh\), use:
+echo
+echo   eval \"\$\(python3 $PATH_TO_INSTALL/dhop.py init bash\)\"
+echo
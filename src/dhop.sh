@@ -1,12 +1,55 @@
 #!/bin/bash
 DHOPDIR=$HOME/bin
-DHOP_CMD_FILE=$HOME/.dhopcmd
 
-# Run the dhop script, passing it all of the command-line arguments.
-python3 $DHOPDIR/dhop.py $@
+# Note: instead of sourcing this file, you can define dhop as a shell function
+# with 'eval "$(python3 $HOME/bin/dhop.py init bash)"' (see 'dhop help init').
 
-# Once execution is finished, see if dhop wrote a location to cd to...
-if [ -e $DHOP_CMD_FILE ]; then
-  source $DHOP_CMD_FILE
-  rm $DHOP_CMD_FILE
+# The socket that 'dhop serve' listens on (see 'dhop help serve').
+if [ -n "$DHOP_SOCKET" ]; then
+  DHOP_SOCK=$DHOP_SOCKET
+elif [ -n "$XDG_RUNTIME_DIR" ]; then
+  DHOP_SOCK=$XDG_RUNTIME_DIR/dhop.sock
+else
+  DHOP_SOCK=$HOME/.dhop.sock
 fi
+
+# If the dhop server is running, ask it first. This skips starting Python. The
+# request is the argument count, the current directory and the arguments, each
+# followed by a NUL.
+DHOP_REPLY=""
+DHOP_DEST=""
+DHOP_STATUS=0
+if [ -S "$DHOP_SOCK" ] && command -v socat > /dev/null 2>&1; then
+  DHOP_REPLY=$(printf '%s\0' "$#" "$PWD" "$@" | socat -t 5 - "UNIX-CONNECT:$DHOP_SOCK" 2> /dev/null)
+fi
+
+if [ "${DHOP_REPLY%%$'\n'*}" = "ok" ]; then
+  # The reply is 'ok', the directory to go to, then whatever the command
+  # printed.
+  DHOP_REPLY=${DHOP_REPLY#ok}
+  DHOP_REPLY=${DHOP_REPLY#$'\n'}
+  DHOP_DEST=${DHOP_REPLY%%$'\n'*}
+  DHOP_REPLY=${DHOP_REPLY#"$DHOP_DEST"}
+  DHOP_REPLY=${DHOP_REPLY#$'\n'}
+  if [ -n "$DHOP_REPLY" ]; then
+    printf '%s\n' "$DHOP_REPLY"
+  fi
+else
+  # No server (or it can't handle this command). Run the dhop script, passing
+  # it all of the command-line arguments. It writes the location to cd to (if
+  # any) on fd 3. dhop.py is imported rather than run, so that Python can use
+  # its cached bytecode. DHOP_SESSION_PID identifies this shell's session, and
+  # DHOP_TRACE_START is for timing Python's start-up when tracing (see
+  # SessionStore and Trace in dhop.py).
+  { DHOP_DEST=$(DHOP_CD_FD=3 DHOP_SESSION_PID=$$ DHOP_TRACE_START=$EPOCHREALTIME python3 -I -S -c 'import sys; sys.path.insert(0, sys.argv.pop(1)); import dhop; sys.exit(dhop.main(sys.argv[1:]))' "$DHOPDIR" "$@" 3>&1 1>&4 4>&-); } 4>&1
+  DHOP_STATUS=$?
+fi
+
+# Once execution is finished, see if dhop gave us a location to cd to...
+if [ -n "$DHOP_DEST" ]; then
+  cd -- "$DHOP_DEST"
+fi
+unset DHOP_REPLY DHOP_SOCK DHOP_DEST
+
+# pass on dhop's exit status (eval expands it before it's unset).
+eval "unset DHOP_STATUS; return $DHOP_STATUS"
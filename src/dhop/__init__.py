@@ -0,0 +1,20 @@
+"""
+dhop's Python API, for finding where dhop names lead from other programs
+without running dhop itself:
+
+    import dhop
+    resolver = dhop.Resolver()
+    try:
+        path = resolver.resolve('proj/src')
+    except dhop.NotFoundError as e:
+        print(e.suggestions)
+
+See Resolver (in dhop/dhop.py) for the details.
+"""
+from .dhop import (DhopError, NotFoundError, InvalidLocationError,
+                   UnreachableError, JsonStore, SqliteStore, ShardedStore,
+                   MemoryStore, History, StatCache, Resolver, open_store)
+
+__all__ = ['DhopError', 'NotFoundError', 'InvalidLocationError',
+           'UnreachableError', 'JsonStore', 'SqliteStore', 'ShardedStore',
+           'MemoryStore', 'History', 'StatCache', 'Resolver', 'open_store']
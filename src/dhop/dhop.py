@@ -1,8 +1,5 @@
 #!/usr/bin/env python3
-import json
-import glob
 import os
-import shutil
 import sys
 
 # A command-line utility for hopping around the filesystem.
@@ -14,11 +11,19 @@ import sys
 # <http://www.gnu.org/licenses/gpl.html>
 #
 # Full documentation is in this file and in README.rst
+#
+# Note: the most common use of dhop is a plain hop, so only os and sys are
+# imported up front. Anything else (json, shutil, glob, ...) is imported by the
+# code that needs it. bench/check_startup.py checks that this stays true.
 
 # for Python 2|3 compatibility.
 if not hasattr(__builtins__, 'raw_input'):
       raw_input=input
 
+# the Trace for the current run, if tracing is turned on (see Trace).
+trace = None
+
+
 def __print_error__(string):
     """
     Print an error message.
@@ -60,26 +65,4131 @@ def __format_doc__(string, extra_indent=0, line_start=0, line_end=-1):
         if stripped:
             indent = min(indent, len(line) - len(stripped))
 
-    # if line_end is negative, then set it to the last line in the list.
-    if line_end == -1:
-        line_end = len(lines)
+    # if line_end is negative, then set it to the last line in the list.
+    if line_end == -1:
+        line_end = len(lines)
+
+    # put the lines together, removing the first num_spaces characters from
+    # each line (except for line 0).
+    result_text = ""
+
+    if line_start == 0:
+        result_text = lines[0] + '\n'
+        line_start = 1
+
+    # convert the extra indent number into spaces
+    extra_indent = ' ' * extra_indent
+
+    # add each line to the result.
+    for cur_line in lines[line_start:line_end]:
+        result_text += "%s%s\n" % (extra_indent, cur_line[indent:])
+
+    return result_text
+
+
+def __split_options__(args, known):
+    """
+    Separate the options (arguments that start with '--') from the rest of the
+    arguments, and return them as (options, args).
+
+    known is a dict of the option names that are allowed (without the '--'),
+    with True for options that take a value ('--jobs 4' or '--jobs=4') and
+    False for flags. The options are returned as a dict of {name: value} (the
+    value of a flag is True). An argument of '--' ends the options, and an
+    unknown option raises ValueError.
+    """
+    options = {}
+    rest = []
+    args = list(args)
+
+    while len(args) != 0:
+        arg = args.pop(0)
+
+        if arg == '--':
+            rest.extend(args)
+            break
+
+        if not arg.startswith('--') or len(arg) == 2:
+            rest.append(arg)
+            continue
+
+        (name, equals, value) = arg[2:].partition('=')
+
+        if name not in known:
+            raise ValueError("Unknown option: --%s" % name)
+
+        if not known[name]:
+            if equals:
+                raise ValueError("--%s doesn't take a value" % name)
+            options[name] = True
+        elif equals:
+            options[name] = value
+        elif len(args) != 0:
+            options[name] = args.pop(0)
+        else:
+            raise ValueError("--%s needs a value" % name)
+
+    return (options, rest)
+
+
+def __read_records__(stream, separator):
+    """
+    Generate the records in a text stream, one at a time, where each record
+    ends with separator (the last one doesn't have to). The stream is read in
+    blocks, so it doesn't need to fit in memory.
+
+    Where the stream has a binary buffer underneath, each block is whatever
+    is available (rather than waiting for a whole block), so records from a
+    pipe are handed on as soon as they arrive.
+    """
+    buffer = getattr(stream, 'buffer', None)
+    if buffer is not None and hasattr(buffer, 'read1'):
+        import codecs
+        decoder = codecs.getincrementaldecoder(stream.encoding)(
+            stream.errors or 'strict')
+
+        def read_block():
+            data = buffer.read1(64 * 1024)
+            return (decoder.decode(data, not data), len(data) != 0)
+    else:
+        def read_block():
+            block = stream.read(64 * 1024)
+            return (block, len(block) != 0)
+
+    buffered = ''
+    while True:
+        (block, more) = read_block()
+        records = (buffered + block).split(separator)
+        buffered = records.pop()
+        for record in records:
+            yield record
+        if not more:
+            break
+
+    if len(buffered) != 0:
+        yield buffered
+
+
+def __runtime_dir__():
+    """
+    Return $XDG_RUNTIME_DIR (a private directory for the user's files that
+    only need to last until they log out, usually in memory), or None if it
+    isn't set.
+    """
+    return os.environ.get('XDG_RUNTIME_DIR') or None
+
+
+def __socket_path__():
+    """
+    Return the path of the per-user socket that 'dhop serve' listens on.
+
+    This is $DHOP_SOCKET if it's set, otherwise 'dhop.sock' in
+    $XDG_RUNTIME_DIR, otherwise '.dhop.sock' in the user's home directory.
+    The shell wrapper (dhop.sh) uses the same rules.
+    """
+    if os.environ.get('DHOP_SOCKET'):
+        return os.environ['DHOP_SOCKET']
+
+    runtime_dir = __runtime_dir__()
+    if runtime_dir is not None:
+        return os.path.join(runtime_dir, 'dhop.sock')
+
+    return os.path.join(os.path.expanduser('~'), '.dhop.sock')
+
+
+# The shell functions printed by 'dhop init'. @PYTHON@ and @DHOPDIR@ are
+# replaced with the (quoted) Python interpreter and the directory holding this
+# script. dhop is started with -I -S (no site packages, nothing from the current
+# directory) and imported as a module, so that its bytecode is cached; see main().
+SH_INIT_SCRIPT = """\
+dhop() {
+  local dhop_sock dhop_reply dhop_dest dhop_status=0
+  if [ -n "$DHOP_SOCKET" ]; then
+    dhop_sock=$DHOP_SOCKET
+  elif [ -n "$XDG_RUNTIME_DIR" ]; then
+    dhop_sock=$XDG_RUNTIME_DIR/dhop.sock
+  else
+    dhop_sock=$HOME/.dhop.sock
+  fi
+
+  # ask 'dhop serve' first, if it's running.
+  if [ -S "$dhop_sock" ] && command -v socat > /dev/null 2>&1; then
+    dhop_reply=$(printf '%s\\0' "$#" "$PWD" "$@" | socat -t 5 - "UNIX-CONNECT:$dhop_sock" 2> /dev/null)
+  fi
+
+  if [ "${dhop_reply%%$'\\n'*}" = "ok" ]; then
+    # the reply is 'ok', the directory to go to, then the command's output.
+    dhop_reply=${dhop_reply#ok}
+    dhop_reply=${dhop_reply#$'\\n'}
+    dhop_dest=${dhop_reply%%$'\\n'*}
+    dhop_reply=${dhop_reply#"$dhop_dest"}
+    dhop_reply=${dhop_reply#$'\\n'}
+    if [ -n "$dhop_reply" ]; then
+      printf '%s\\n' "$dhop_reply"
+    fi
+  else
+    # dhop writes the directory to go to on fd 3; its output goes to stdout.
+    { dhop_dest=$(DHOP_CD_FD=3 DHOP_SESSION_PID=$$ DHOP_TRACE_START=$EPOCHREALTIME @PYTHON@ -I -S -c 'import sys; sys.path.insert(0, sys.argv.pop(1)); import dhop; sys.exit(dhop.main(sys.argv[1:]))' @DHOPDIR@ "$@" 3>&1 1>&4 4>&-); } 4>&1
+    dhop_status=$?
+  fi
+
+  if [ -n "$dhop_dest" ]; then
+    cd -- "$dhop_dest" || return
+  fi
+  return $dhop_status
+}
+"""
+
+FISH_INIT_SCRIPT = """\
+function dhop
+    set -l dhop_dest
+    # dhop writes the directory to go to on fd 3; its output goes to stdout.
+    begin
+        set dhop_dest (env DHOP_CD_FD=3 DHOP_SESSION_PID=$fish_pid @PYTHON@ -I -S -c 'import sys; sys.path.insert(0, sys.argv.pop(1)); import dhop; sys.exit(dhop.main(sys.argv[1:]))' @DHOPDIR@ $argv 3>&1 1>&4 4>&-)
+    end 4>&1
+    set -l dhop_status $status
+    if test -n "$dhop_dest"
+        cd "$dhop_dest"; or return
+    end
+    return $dhop_status
+end
+"""
+
+
+BASH_COMPLETION_SCRIPT = """\
+# complete commands, location names, and directories beneath locations (as in
+# 'name/sub/dir') from dhop's completion file, without running dhop.
+_dhop_complete() {
+  local cur=${COMP_WORDS[COMP_CWORD]} file=$HOME/.dhop.completions
+  local name dir match IFS=$'\n'
+  COMPREPLY=()
+  if [ "$COMP_CWORD" -ne 1 ]; then
+    COMPREPLY=($(compgen -f -- "$cur"))
+    return
+  fi
+  if [[ $cur == */* ]]; then
+    name=${cur%%/*}
+    dir=$(awk -F'\t' -v n="$name" '$1 == n { print $2; exit }' "$file" 2> /dev/null)
+    if [ -n "$dir" ]; then
+      for match in $(compgen -d -- "$dir/${cur#*/}"); do
+        COMPREPLY+=("$name${match#"$dir"}/")
+      done
+      compopt -o nospace 2> /dev/null
+      return
+    fi
+  fi
+  COMPREPLY=($(awk -F'\t' -v p="$cur" 'index($1, p) == 1 { print $1 }' "$file" 2> /dev/null)
+             $(compgen -d -- "$cur"))
+}
+complete -o filenames -F _dhop_complete dhop
+"""
+
+ZSH_COMPLETION_SCRIPT = """\
+# complete commands, location names, and directories beneath locations (as in
+# 'name/sub/dir') from dhop's completion file, without running dhop.
+_dhop() {
+  local file=$HOME/.dhop.completions name dir
+  local -a names
+  if (( CURRENT != 2 )); then
+    _files
+    return
+  fi
+  if [[ $PREFIX == */* ]]; then
+    name=${PREFIX%%/*}
+    dir=$(awk -F'\t' -v n="$name" '$1 == n { print $2; exit }' $file 2> /dev/null)
+    if [[ -n $dir ]]; then
+      compset -P 1 '*/'
+      _path_files -W "$dir" -/
+      return
+    fi
+  fi
+  names=(${(f)"$(awk -F'\t' '{ print $1 }' $file 2> /dev/null)"})
+  compadd -a names
+  _path_files -/
+}
+(( $+functions[compdef] )) && compdef _dhop dhop
+"""
+
+
+def __write_completions__(home_dir, locations):
+    """
+    Write the completion file (.dhop.completions, in home_dir) that the shell
+    completion functions read (see 'dhop init'): one line for each command
+    and location name, with a tab and the location's path after each
+    location name.
+    """
+    lines = ['%s\t\n' % command for command in sorted(Dhop.USER_COMMANDS)]
+    for name in sorted(locations.keys()):
+        # names and paths with tabs or newlines in them can't be written.
+        entry = '%s\t%s' % (name, os.path.normpath(locations[name]))
+        if entry.count('\t') == 1 and '\n' not in entry:
+            lines.append(entry + '\n')
+
+    path = os.path.join(home_dir, Dhop.DHOP_COMPLETIONS)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        completions_file = open(temp_path, 'w')
+        completions_file.write(''.join(lines))
+        completions_file.close()
+        os.replace(temp_path, path)
+    except (IOError, OSError):
+        return
+
+
+def __update_completions__(home_dir, changes, read_locations):
+    """
+    Apply changes ({name: path, or None if it was forgotten}) to the names
+    already in home_dir's completion file (see __write_completions__), or, if
+    there isn't one, write it from the locations that read_locations()
+    returns.
+
+    The caller should hold its store's lock, so that the file can't be
+    changed by another dhop process meanwhile, and both processes' changes
+    end up in it.
+    """
+    if len(changes) == 0:
+        return
+
+    path = os.path.join(home_dir, Dhop.DHOP_COMPLETIONS)
+    try:
+        completions_file = open(path, 'r')
+    except (IOError, OSError):
+        __write_completions__(home_dir, read_locations())
+        return
+
+    # the commands (which have no path) are written afresh.
+    locations = {}
+    try:
+        for line in completions_file:
+            (name, tab, location) = line.rstrip('\n').partition('\t')
+            if len(location) != 0:
+                locations[name] = location
+    finally:
+        completions_file.close()
+
+    for (name, location) in changes.items():
+        if location is None:
+            locations.pop(name, None)
+        else:
+            locations[name] = location
+    __write_completions__(home_dir, locations)
+
+
+def __location_changes__(records):
+    """
+    Return the changes to the locations in a list of change records (see
+    JsonStore), as {name: path, or None if it was forgotten}.
+    """
+    changes = {}
+    for record in records:
+        if record[0] == 'set':
+            changes[record[1]] = record[2]
+        elif record[0] == 'forget':
+            changes[record[1]] = None
+    return changes
+
+
+def __run_detached__(function):
+    """
+    Call function in a detached process, so that the current command doesn't
+    have to wait for it. Where that isn't possible, call it now.
+    """
+    if not hasattr(os, 'fork'):
+        function()
+        return
+
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid != 0:
+        # wait for the intermediate child, which exits right away.
+        os.waitpid(pid, 0)
+        return
+
+    # fork again so that the working process isn't our child, and let go of
+    # the terminal and of any pipes the shell is reading from (it would wait
+    # for them to be closed).
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in [0, 1, 2]:
+                os.dup2(devnull, fd)
+            os.closerange(3, 256)
+            try:
+                function()
+            except Exception:
+                pass
+    finally:
+        os._exit(0)
+
+
+def __lock_file__(f, exclusive=True):
+    """
+    Lock an open file (on systems that support it). The lock is released when
+    the file is closed.
+    """
+    try:
+        import fcntl
+    except ImportError:  # windows
+        return
+    if exclusive:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+
+
+def __trace_begin__(phase):
+    """
+    Start timing a phase of the current run, if it's being traced.
+    """
+    if trace is not None:
+        trace.begin(phase)
+
+
+def __trace_end__(phase):
+    """
+    Stop timing a phase of the current run, if it's being traced.
+    """
+    if trace is not None:
+        trace.end(phase)
+
+
+class Trace:
+    """
+    Times the phases of a dhop run, and counts the file system calls made
+    during it, for finding out why a hop is slow.
+
+    Tracing is turned on by setting $DHOP_TRACE, or with 'dhop --trace'.
+    Phases (init, load store, resolve, command, write store, ...) are timed
+    with a monotonic clock; a phase that runs more than once (such as
+    resolve, in 'dhop path --stdin') adds up. While tracing, the os and
+    built-in functions in COUNTED are wrapped so that each call is counted.
+
+    If $DHOP_TRACE is '1' (or unset, with --trace), a summary is printed to
+    stderr when the run finishes. Otherwise, $DHOP_TRACE is the path of a
+    log, and one JSON object is appended to it per run, for collecting
+    timings from many machines.
+
+    The shell wrappers pass the time they started Python in
+    $DHOP_TRACE_START (bash's $EPOCHREALTIME), so that the time it took to
+    start the interpreter and import dhop shows up as the 'startup' phase.
+    """
+    # the calls that are counted, by the name they're counted under.
+    COUNTED = [
+        ('stat', 'os', ['stat', 'lstat']),
+        ('open', 'os', ['open']),
+        ('open', 'builtins', ['open']),
+        ('listdir', 'os', ['listdir', 'scandir']),
+        ('rename', 'os', ['rename', 'replace']),
+        ('fsync', 'os', ['fsync']),
+    ]
+
+    def __init__(self, destination, served=False):
+        """
+        Start tracing a run. destination is None for stderr, or the path of a
+        JSON-lines log. served is True for a command answered by 'dhop
+        serve'.
+        """
+        import builtins
+        import threading
+        import time
+
+        self.clock = time.perf_counter
+        self.started = self.clock()
+        self.destination = destination
+        self.served = served
+        self.command = None
+        self.phases = {}
+        self.order = []
+        self.running = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+        startup = os.environ.get('DHOP_TRACE_START', '').replace(',', '.')
+        if not served and startup:
+            try:
+                self.phases['startup'] = max(
+                    0.0, (time.time() - float(startup)) * 1000)
+                self.order.append('startup')
+            except ValueError:
+                pass
+
+        self.originals = []
+        modules = {'os': os, 'builtins': builtins}
+        for (counter, module_name, names) in Trace.COUNTED:
+            self.counts[counter] = 0
+            for name in names:
+                module = modules[module_name]
+                function = getattr(module, name)
+                self.originals.append((module, name, function))
+                setattr(module, name, self.__counted__(counter, function))
+
+    def __counted__(self, counter, function):
+        """
+        Return a version of function that counts its calls under counter.
+        """
+        def counted(*args, **kwargs):
+            with self.lock:
+                self.counts[counter] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def begin(self, phase):
+        """
+        Start timing a phase.
+        """
+        if phase not in self.phases:
+            self.phases[phase] = 0.0
+            self.order.append(phase)
+        self.running[phase] = self.clock()
+
+    def end(self, phase):
+        """
+        Stop timing a phase (if it was started).
+        """
+        started = self.running.pop(phase, None)
+        if started is not None:
+            self.phases[phase] += (self.clock() - started) * 1000
+
+    def finish(self):
+        """
+        Stop tracing, put the wrapped functions back, and report. Phases that
+        are still running are ended first.
+        """
+        for phase in list(self.running):
+            self.end(phase)
+        total = (self.clock() - self.started) * 1000
+        for (module, name, function) in self.originals:
+            setattr(module, name, function)
+        self.originals = []
+
+        # requests that 'dhop serve' sent back to the wrapper ran nothing.
+        if self.served and self.command is None:
+            return
+
+        if self.destination is None:
+            self.__print__(total)
+        else:
+            self.__log__(total)
+
+    def __print__(self, total):
+        """
+        Print a summary of the run to stderr.
+        """
+        lines = ["dhop trace: %s%s" % (self.command or '(none)',
+                                       self.served and ' (served)' or '')]
+        for phase in self.order:
+            lines.append("  %-16s %9.3f ms" % (phase, self.phases[phase]))
+        lines.append("  %-16s %9.3f ms" % ('total', total))
+        lines.append("  calls: %s" % ", ".join(
+            ["%s %d" % (counter, self.counts[counter]) for counter in
+             sorted(self.counts)]))
+        sys.stderr.write('\n'.join(lines) + '\n')
+        sys.stderr.flush()
+
+    def __log__(self, total):
+        """
+        Append a JSON record of the run to the trace log.
+        """
+        import json
+        import time
+
+        phases = dict(self.phases)
+        phases['total'] = total
+        record = {
+            'time': round(time.time(), 3),
+            'host': os.uname().nodename if hasattr(os, 'uname') else None,
+            'pid': os.getpid(),
+            'command': self.command,
+            'served': self.served,
+            'backend': os.environ.get('DHOP_BACKEND', 'json'),
+            'ms': dict((phase, round(ms, 3)) for (phase, ms) in phases.items()),
+            'calls': self.counts,
+        }
+        try:
+            log_file = open(os.path.expanduser(self.destination), 'a')
+            __lock_file__(log_file)
+            log_file.write(json.dumps(record, sort_keys=True) + '\n')
+            log_file.close()
+        except (IOError, OSError) as e:
+            sys.stderr.write("!! dhop error: Can't write the trace log %s: %s\n"
+                             % (self.destination, e))
+
+
+def __start_trace__(forced=False, served=False):
+    """
+    Start tracing if $DHOP_TRACE is set (or forced, by --trace).
+    """
+    global trace
+    setting = os.environ.get('DHOP_TRACE', '')
+    if setting in ('', '0') and not forced:
+        return
+    destination = None
+    if setting not in ('', '0', '1'):
+        destination = setting
+    trace = Trace(destination, served)
+
+
+def __finish_trace__():
+    """
+    Finish the current trace, if there is one.
+    """
+    global trace
+    if trace is not None:
+        trace.finish()
+        trace = None
+
+
+class DhopError(Exception):
+    """
+    The base class of the errors raised by dhop's Python API (see Resolver).
+    The messages saying what went wrong are in args.
+    """
+
+
+class NotFoundError(DhopError, LookupError):
+    """
+    Raised when a name is neither a stored location (nor the start of one)
+    nor a path that exists. name is the whole name that was given (such as
+    'proj/src'), and suggestions lists the locations whose names are close
+    to it, if there are any.
+    """
+    def __init__(self, name, messages, suggestions=None):
+        DhopError.__init__(self, *messages)
+        self.name = name
+        self.suggestions = suggestions or []
+
+
+class InvalidLocationError(NotFoundError):
+    """
+    Raised when a name is a stored location, but its path (or the path given
+    after it) doesn't exist.
+    """
+    def __init__(self, name, path, messages):
+        NotFoundError.__init__(self, name, messages)
+        self.path = path
+
+
+class UnreachableError(DhopError, LookupError):
+    """
+    Raised when a path can't be checked because its filesystem doesn't answer
+    in time (see StatCache).
+    """
+    def __init__(self, path, messages):
+        DhopError.__init__(self, *messages)
+        self.path = path
+
+
+class JsonStore:
+    """
+    Keeps the dhop data in a JSON snapshot file (~/.dhop.json), along with a
+    journal (~/.dhop.journal) of the changes made since the snapshot was
+    written.
+
+    This is the default store backend. Every backend provides the same methods:
+    get_location, get_mark, names and dump to read the data, and version,
+    which changes whenever the locations do (some backends change it with
+    the stack and mark, too); set_location, forget, push, pop and set_mark
+    to change it; commit to save the changes; and load
+    and is_stale, which 'dhop serve' uses to pick up changes made by other
+    processes.
+
+    Changes are saved by commit(), which appends one small JSON record per
+    change to the journal instead of rewriting the whole snapshot. Once the
+    journal grows past JOURNAL_LIMIT bytes, it's folded back into the snapshot
+    by a background process.
+
+    The snapshot also keeps a generation, which goes up with each change to
+    the locations (and as the journal's changes are replayed). It's what
+    version() returns, so pushes, pops and marks don't make the location
+    index look out of date.
+    """
+    JOURNAL_LIMIT = 64 * 1024
+
+    def __init__(self, home_dir):
+        """
+        Initialize the store, loading the data in home_dir. home_dir is None
+        for a subclass that keeps the data somewhere other than in files (see
+        MemoryStore), and replaces load, is_stale and commit.
+        """
+        self.home_dir = home_dir
+        self.snapshot_path = None
+        self.journal_path = None
+        if home_dir is not None:
+            self.snapshot_path = os.path.join(home_dir, Dhop.DHOP_STORE)
+            self.journal_path = os.path.join(home_dir, Dhop.DHOP_JOURNAL)
+        self.pending = []
+        self.load()
+
+    def __file_state__(self):
+        """
+        Return something that changes whenever the files on disk change.
+        """
+        state = []
+        for path in [self.snapshot_path, self.journal_path]:
+            try:
+                st = os.stat(path)
+                state.append((st.st_mtime, st.st_size, st.st_ino))
+            except OSError:
+                state.append(None)
+        return state
+
+    def __read__(self):
+        """
+        Read the snapshot and replay the journal on top of it. The caller
+        should hold a lock on the journal, if there is one.
+        """
+        import json
+
+        if os.path.exists(self.snapshot_path):
+            snapshot_file = open(self.snapshot_path, 'r')
+            self.data = json.load(snapshot_file)
+            snapshot_file.close()
+        else:
+            # copy the default so that changes don't leak into the class data.
+            self.data = dict((key, type(value)()) for (key, value) in
+                             Dhop.DEFAULT_STORE.items())
+        self.generation = self.data.pop('generation', 0)
+
+        if os.path.exists(self.journal_path):
+            journal_file = open(self.journal_path, 'r')
+            for line in journal_file:
+                # a partly-written last line (from a crash) is skipped.
+                try:
+                    self.__apply__(json.loads(line))
+                except ValueError:
+                    continue
+            journal_file.close()
+
+    def load(self):
+        """
+        Load (or reload) the data from disk, dropping any uncommitted changes.
+        """
+        self.pending = []
+        journal_file = None
+
+        # hold a shared lock on the journal while reading, so that it can't be
+        # compacted between reading the snapshot and reading the journal.
+        if os.path.exists(self.journal_path):
+            journal_file = open(self.journal_path, 'r')
+            __lock_file__(journal_file, exclusive=False)
+
+        self.__read__()
+        self.disk_state = self.__file_state__()
+
+        if journal_file is not None:
+            journal_file.close()
+
+    def is_stale(self):
+        """
+        Return True if another dhop process has changed the data on disk since
+        it was loaded.
+        """
+        return self.__file_state__() != self.disk_state
+
+    def __apply__(self, record):
+        """
+        Apply a change record to the in-memory data.
+        """
+        op = record[0]
+        if op in ('set', 'forget'):
+            self.generation += 1
+        if op == 'set':
+            self.data['locations'][record[1]] = record[2]
+        elif op == 'forget':
+            self.data['locations'].pop(record[1], None)
+        elif op == 'push':
+            self.data['stack'].append(record[1])
+        elif op == 'pop':
+            if record[1] > 0:
+                del self.data['stack'][-record[1]:]
+        elif op == 'drop':
+            self.data['stack'] = [path for path in self.data['stack']
+                                  if path not in record[1]]
+        elif op == 'mark':
+            self.data['mark'] = record[1]
+
+    def __change__(self, record):
+        """
+        Apply a change record and queue it to be saved by commit().
+        """
+        self.__apply__(record)
+        self.pending.append(record)
+
+    def set_location(self, name, path):
+        """
+        Set (or replace) a named location.
+        """
+        if self.data['locations'].get(name) != path:
+            self.__change__(['set', name, path])
+
+    def forget(self, name):
+        """
+        Forget a named location. Unknown names are ignored.
+        """
+        if name in self.data['locations']:
+            self.__change__(['forget', name])
+
+    def push(self, path):
+        """
+        Push a path onto the stack.
+        """
+        self.__change__(['push', path])
+
+    def get_location(self, name):
+        """
+        Return the path for a named location, or None if it isn't set.
+        """
+        return self.data['locations'].get(name)
+
+    def get_mark(self):
+        """
+        Return the marked path ("" if there isn't one).
+        """
+        return self.data['mark']
+
+    def names(self):
+        """
+        Return the names of all of the stored locations.
+        """
+        return list(self.data['locations'].keys())
+
+    def version(self):
+        """
+        Return a value that changes whenever the locations do.
+        """
+        return self.generation
+
+    def dump(self):
+        """
+        Return all of the data as a dict with 'locations', 'mark' and 'stack'
+        entries (the layout of Dhop.DEFAULT_STORE).
+        """
+        return self.data
+
+    def pop(self, count=1):
+        """
+        Pop count paths (or all of them, if count is None) from the stack, and
+        return the last one popped (or None, if the stack is empty).
+        """
+        stack = self.data['stack']
+        if count is None:
+            count = len(stack)
+        count = min(count, len(stack))
+        if count == 0:
+            return None
+        path = stack[-count]
+        self.__change__(['pop', count])
+        return path
+
+    def drop_from_stack(self, paths):
+        """
+        Remove every entry for the given paths from the stack.
+        """
+        if len(set(paths) & set(self.data['stack'])) != 0:
+            self.__change__(['drop', sorted(set(paths))])
+
+    def set_mark(self, path):
+        """
+        Set the mark.
+        """
+        if self.data['mark'] != path:
+            self.__change__(['mark', path])
+
+    def commit(self):
+        """
+        Save any changes made since the last commit. If nothing changed, the
+        files on disk aren't touched.
+        """
+        if len(self.pending) == 0:
+            return
+
+        import json
+        changes = __location_changes__(self.pending)
+        lines = ''.join([json.dumps(record) + '\n' for record in self.pending])
+        self.pending = []
+
+        journal_file = open(self.journal_path, 'a')
+        __lock_file__(journal_file)
+        # if the journal isn't the size we left it at, someone else has
+        # written to it since we loaded, and is_stale() should say so.
+        journal_size = os.fstat(journal_file.fileno()).st_size
+        others_changed = self.is_stale()
+        journal_file.write(lines)
+        journal_file.flush()
+
+        # while the journal is still locked, so other processes' changes to
+        # the locations aren't lost.
+        def read_locations():
+            self.__read__()
+            return self.data['locations']
+        __update_completions__(self.home_dir, changes, read_locations)
+        journal_file.close()
+
+        if not others_changed:
+            self.disk_state = self.__file_state__()
+
+        if journal_size + len(lines) > JsonStore.JOURNAL_LIMIT:
+            self.__compact_in_background__()
+
+    def rollback(self):
+        """
+        Drop any changes made since the last commit.
+        """
+        self.load()
+
+    def compact(self):
+        """
+        Write the current data (including everyone's journaled changes) to the
+        snapshot file and empty the journal.
+        """
+        import json
+
+        journal_file = open(self.journal_path, 'a')
+        __lock_file__(journal_file)
+
+        # re-read under the lock, to pick up changes made by other processes.
+        self.__read__()
+
+        # write the new snapshot next to the old one and then swap them, so
+        # there's always a complete snapshot on disk.
+        temp_path = self.snapshot_path + '.tmp'
+        snapshot_file = open(temp_path, 'w')
+        snapshot_file.write(json.JSONEncoder().encode(
+            dict(self.data, generation=self.generation)))
+        snapshot_file.close()
+        os.replace(temp_path, self.snapshot_path)
+
+        journal_file.truncate(0)
+        journal_file.close()
+        self.disk_state = self.__file_state__()
+
+    def __compact_in_background__(self):
+        """
+        Compact the store in a detached process, so that the current command
+        doesn't have to wait for it. Where that isn't possible, compact now.
+        """
+        __run_detached__(self.compact)
+
+
+class SqliteStore:
+    """
+    Keeps the dhop data in an SQLite database (~/.dhop.db), which suits large
+    numbers of locations and many terminals using dhop at once.
+
+    Locations are looked up by name with an index, rather than loading all of
+    them, and each command's changes are made in a single transaction, so
+    concurrent pushes and pops don't overwrite each other. The database uses
+    write-ahead logging, so readers never wait for a writer.
+
+    When the database is first created, any data in ~/.dhop.json (and its
+    journal) is copied into it. The JSON files are left as they are.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS locations (
+            name TEXT PRIMARY KEY,
+            path TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS stack (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID;
+        """
+
+    def __init__(self, home_dir):
+        """
+        Initialize the store, opening (or creating) the database in home_dir.
+        """
+        import sqlite3
+
+        self.home_dir = home_dir
+        self.db_path = os.path.join(home_dir, Dhop.DHOP_DB)
+        is_new = not os.path.exists(self.db_path)
+
+        # {name: path, or None if it was forgotten}, for the changes that
+        # haven't been committed.
+        self.location_changes = {}
+
+        # transactions are started explicitly (see __begin__).
+        self.db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+        if is_new:
+            self.__begin__()
+            self.db.executescript(SqliteStore.SCHEMA)
+            self.__migrate__(home_dir)
+            self.commit()
+
+    def __migrate__(self, home_dir):
+        """
+        Copy the data from the JSON store into the (new) database.
+        """
+        if not (os.path.exists(os.path.join(home_dir, Dhop.DHOP_STORE)) or
+                os.path.exists(os.path.join(home_dir, Dhop.DHOP_JOURNAL))):
+            return
+
+        data = JsonStore(home_dir).dump()
+        self.db.executemany('INSERT INTO locations (name, path) VALUES (?, ?)',
+                            data['locations'].items())
+        self.db.executemany('INSERT INTO stack (path) VALUES (?)',
+                            [(path,) for path in data['stack']])
+        self.set_mark(data['mark'])
+
+    def __begin__(self):
+        """
+        Start a write transaction, if one isn't already underway. Until it's
+        committed, other dhop processes can read, but can't write.
+        """
+        if not self.db.in_transaction:
+            self.db.execute('BEGIN IMMEDIATE')
+
+    def load(self):
+        """
+        Nothing to do: the data is always read straight from the database.
+        """
+        return
+
+    def is_stale(self):
+        """
+        Always False, since nothing is cached.
+        """
+        return False
+
+    def get_location(self, name):
+        """
+        Return the path for a named location, or None if it isn't set.
+        """
+        row = self.db.execute('SELECT path FROM locations WHERE name = ?',
+                              (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_mark(self):
+        """
+        Return the marked path ("" if there isn't one).
+        """
+        row = self.db.execute("SELECT value FROM settings WHERE key = 'mark'"
+                              ).fetchone()
+        if row is None:
+            return ""
+        return row[0]
+
+    def names(self):
+        """
+        Return the names of all of the stored locations.
+        """
+        return [row[0] for row in self.db.execute('SELECT name FROM locations')]
+
+    def version(self):
+        """
+        Return a value that changes whenever the locations do: a generation
+        kept in the settings table, which set_location and forget bump.
+        """
+        row = self.db.execute("SELECT value FROM settings WHERE key = "
+                              "'generation'").fetchone()
+        if row is None:
+            return 0
+        return int(row[0])
+
+    def __location_changed__(self, name, path):
+        """
+        Note that the location name has been set to path (or forgotten, if
+        path is None), for version() and the completion file. The caller
+        should have started a transaction.
+        """
+        self.db.execute("INSERT OR REPLACE INTO settings (key, value) "
+                        "VALUES ('generation', ?)", (str(self.version() + 1),))
+        self.location_changes[name] = path
+
+    def dump(self):
+        """
+        Return all of the data as a dict with 'locations', 'mark' and 'stack'
+        entries (the layout of Dhop.DEFAULT_STORE).
+        """
+        locations = dict(self.db.execute('SELECT name, path FROM locations'))
+        stack = [row[0] for row in
+                 self.db.execute('SELECT path FROM stack ORDER BY id')]
+        return {'locations': locations, 'mark': self.get_mark(), 'stack': stack}
+
+    def set_location(self, name, path):
+        """
+        Set (or replace) a named location.
+        """
+        if self.get_location(name) != path:
+            self.__begin__()
+            self.db.execute('INSERT OR REPLACE INTO locations (name, path) '
+                            'VALUES (?, ?)', (name, path))
+            self.__location_changed__(name, path)
+
+    def forget(self, name):
+        """
+        Forget a named location. Unknown names are ignored.
+        """
+        if self.get_location(name) is None:
+            return
+        self.__begin__()
+        self.db.execute('DELETE FROM locations WHERE name = ?', (name,))
+        self.__location_changed__(name, None)
+
+    def push(self, path):
+        """
+        Push a path onto the stack.
+        """
+        self.__begin__()
+        self.db.execute('INSERT INTO stack (path) VALUES (?)', (path,))
+
+    def pop(self, count=1):
+        """
+        Pop count paths (or all of them, if count is None) from the stack, and
+        return the last one popped (or None, if the stack is empty).
+        """
+        if count is None:
+            count = -1  # no limit
+
+        # read and remove the entries in the same transaction, so that two
+        # terminals can't pop the same entry.
+        self.__begin__()
+        rows = self.db.execute('SELECT id, path FROM stack ORDER BY id DESC '
+                               'LIMIT ?', (count,)).fetchall()
+        if len(rows) == 0:
+            return None
+
+        self.db.execute('DELETE FROM stack WHERE id >= ?', (rows[-1][0],))
+        return rows[-1][1]
+
+    def drop_from_stack(self, paths):
+        """
+        Remove every entry for the given paths from the stack.
+        """
+        self.__begin__()
+        self.db.executemany('DELETE FROM stack WHERE path = ?',
+                            [(path,) for path in set(paths)])
+
+    def set_mark(self, path):
+        """
+        Set the mark.
+        """
+        if self.get_mark() != path:
+            self.__begin__()
+            self.db.execute("INSERT OR REPLACE INTO settings (key, value) "
+                            "VALUES ('mark', ?)", (path,))
+
+    def commit(self):
+        """
+        Save any changes made since the last commit.
+        """
+        if self.db.in_transaction:
+            # while the write lock is still held, so other processes' changes
+            # to the locations aren't lost.
+            def read_locations():
+                return self.dump()['locations']
+            __update_completions__(self.home_dir, self.location_changes,
+                                   read_locations)
+            self.db.execute('COMMIT')
+        self.location_changes = {}
+
+    def rollback(self):
+        """
+        Drop any changes made since the last commit.
+        """
+        if self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+        self.location_changes = {}
+
+
+class ShardedStore:
+    """
+    Keeps the dhop data in a directory (~/.dhop.shards) in which the locations
+    are split by a hash of their names into SHARDS small JSON files, for
+    catalogs of locations too large to read in full on every hop.
+
+    Looking up a location reads only the shard that holds its name, so a hop
+    takes about the same time however many locations there are. Listing
+    them all still reads every shard, one after another. The mark and stack
+    are kept in
+    state.json, and a generation file holds a number that goes up with each
+    commit, which is what version() and is_stale() look at.
+
+    Changes are saved by commit(), which takes a lock, re-reads just the
+    shards (and state) that were changed, applies the changes to them and
+    replaces them, so changes made by other dhop processes meanwhile aren't
+    lost. The completion file is updated with the same changes, under the
+    same lock. When the directory is first created, any data in
+    ~/.dhop.json (and its journal) is copied into it, and the user is told
+    that the JSON files, which are left as they are, won't be kept up to
+    date from then on.
+    """
+    SHARDS = 256
+
+    def __init__(self, home_dir):
+        """
+        Initialize the store in home_dir. Nothing is read until it's needed.
+        """
+        self.home_dir = home_dir
+        self.shards_dir = os.path.join(home_dir, Dhop.DHOP_SHARDS)
+        self.generation_path = os.path.join(self.shards_dir, 'generation')
+
+        if not os.path.isdir(self.shards_dir):
+            self.__migrate__(home_dir)
+        self.load()
+
+    def __migrate__(self, home_dir):
+        """
+        Create the store, copying the data from the JSON store into it.
+        """
+        data = {'locations': {}, 'mark': "", 'stack': []}
+        copied = (os.path.exists(os.path.join(home_dir, Dhop.DHOP_STORE)) or
+                  os.path.exists(os.path.join(home_dir, Dhop.DHOP_JOURNAL)))
+        if copied:
+            data = JsonStore(home_dir).dump()
+
+        # build it under a temporary name, so that a half-made store is never
+        # seen.
+        temp_dir = '%s.%d.tmp' % (self.shards_dir, os.getpid())
+        os.mkdir(temp_dir)
+        shards = {}
+        for (name, path) in data['locations'].items():
+            shards.setdefault(ShardedStore.shard_of(name), {})[name] = path
+        for (shard, locations) in shards.items():
+            self.__write_json__(self.__shard_path__(shard, temp_dir), locations)
+        self.__write_json__(os.path.join(temp_dir, 'state.json'),
+                            {'mark': data['mark'], 'stack': data['stack']})
+        self.__write_json__(os.path.join(temp_dir, 'generation'), 1)
+
+        try:
+            os.rename(temp_dir, self.shards_dir)
+        except OSError:
+            # another dhop process created it first.
+            import shutil
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return
+
+        # on stderr, so that it doesn't end up in the output of 'dhop path'.
+        if copied:
+            sys.stderr.write(
+                "dhop: copied your data from ~/%s into ~/%s. From now on, "
+                "changes are only saved there; if you go back to the json "
+                "backend, you'll get your data as it was before this.\n" %
+                (Dhop.DHOP_STORE, Dhop.DHOP_SHARDS))
+
+    @staticmethod
+    def shard_of(name):
+        """
+        Return the number of the shard that holds the location name.
+        """
+        import zlib
+        return zlib.crc32(name.encode('utf-8', 'surrogateescape')) % \
+            ShardedStore.SHARDS
+
+    def __shard_path__(self, shard, shards_dir=None):
+        return os.path.join(shards_dir or self.shards_dir, '%02x.json' % shard)
+
+    def __read_json__(self, path, default):
+        """
+        Return the data in a JSON file, or default if there's no such file.
+        """
+        import json
+        try:
+            json_file = open(path, 'r')
+        except (IOError, OSError):
+            return default
+        try:
+            return json.load(json_file)
+        finally:
+            json_file.close()
+
+    def __write_json__(self, path, data):
+        """
+        Replace a JSON file with data, in one step.
+        """
+        import json
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        json_file = open(temp_path, 'w')
+        json_file.write(json.JSONEncoder().encode(data))
+        json_file.close()
+        os.replace(temp_path, path)
+
+    def __shard__(self, shard):
+        """
+        Return the locations in a shard, reading it if it hasn't been read.
+        """
+        self.version()
+        if shard not in self.shards:
+            self.shards[shard] = self.__read_json__(self.__shard_path__(shard),
+                                                    {})
+        return self.shards[shard]
+
+    def __state__(self):
+        """
+        Return the mark and stack, reading them if they haven't been read.
+        """
+        self.version()
+        if self.state is None:
+            self.state = self.__read_json__(
+                os.path.join(self.shards_dir, 'state.json'),
+                {'mark': "", 'stack': []})
+        return self.state
+
+    def __disk_generation__(self):
+        return self.__read_json__(self.generation_path, 0)
+
+    def load(self):
+        """
+        Forget anything read, and any uncommitted changes, so that the data
+        is read from disk again as it's needed.
+        """
+        self.shards = {}
+        self.state = None
+        self.pending = []
+        self.generation = None
+
+    def is_stale(self):
+        """
+        Return True if another dhop process has committed changes since the
+        data was read.
+        """
+        return (self.generation is not None and
+                self.__disk_generation__() != self.generation)
+
+    def version(self):
+        """
+        Return a value that changes whenever the stored data does. It's read
+        along with the first data read, so that it's from before that data.
+        """
+        if self.generation is None:
+            self.generation = self.__disk_generation__()
+        return self.generation
+
+    def __apply__(self, record, locations=None, state=None):
+        """
+        Apply a change record to the given shard or state (or to the ones
+        that have been read, by default).
+        """
+        op = record[0]
+        if op in ('set', 'forget'):
+            if locations is None:
+                locations = self.__shard__(ShardedStore.shard_of(record[1]))
+            if op == 'set':
+                locations[record[1]] = record[2]
+            else:
+                locations.pop(record[1], None)
+            return
+
+        if state is None:
+            state = self.__state__()
+        if op == 'push':
+            state['stack'].append(record[1])
+        elif op == 'pop':
+            if record[1] > 0:
+                del state['stack'][-record[1]:]
+        elif op == 'drop':
+            state['stack'] = [path for path in state['stack']
+                              if path not in record[1]]
+        elif op == 'mark':
+            state['mark'] = record[1]
+
+    def __change__(self, record):
+        """
+        Apply a change record and queue it to be saved by commit().
+        """
+        self.__apply__(record)
+        self.pending.append(record)
+
+    def get_location(self, name):
+        """
+        Return the path for a named location, or None if it isn't set.
+        """
+        return self.__shard__(ShardedStore.shard_of(name)).get(name)
+
+    def get_mark(self):
+        """
+        Return the marked path ("" if there isn't one).
+        """
+        return self.__state__()['mark']
+
+    def names(self):
+        """
+        Return the names of all of the stored locations.
+        """
+        names = []
+        for shard in range(ShardedStore.SHARDS):
+            names.extend(self.__shard__(shard).keys())
+        return names
+
+    def dump(self):
+        """
+        Return all of the data as a dict with 'locations', 'mark' and 'stack'
+        entries (the layout of Dhop.DEFAULT_STORE).
+        """
+        locations = {}
+        for shard in range(ShardedStore.SHARDS):
+            locations.update(self.__shard__(shard))
+        state = self.__state__()
+        return {'locations': locations, 'mark': state['mark'],
+                'stack': state['stack']}
+
+    def set_location(self, name, path):
+        """
+        Set (or replace) a named location.
+        """
+        if self.get_location(name) != path:
+            self.__change__(['set', name, path])
+
+    def forget(self, name):
+        """
+        Forget a named location. Unknown names are ignored.
+        """
+        if self.get_location(name) is not None:
+            self.__change__(['forget', name])
+
+    def push(self, path):
+        """
+        Push a path onto the stack.
+        """
+        self.__change__(['push', path])
+
+    def pop(self, count=1):
+        """
+        Pop count paths (or all of them, if count is None) from the stack, and
+        return the last one popped (or None, if the stack is empty).
+        """
+        stack = self.__state__()['stack']
+        if count is None:
+            count = len(stack)
+        count = min(count, len(stack))
+        if count == 0:
+            return None
+        path = stack[-count]
+        self.__change__(['pop', count])
+        return path
+
+    def drop_from_stack(self, paths):
+        """
+        Remove every entry for the given paths from the stack.
+        """
+        if len(set(paths) & set(self.__state__()['stack'])) != 0:
+            self.__change__(['drop', sorted(set(paths))])
+
+    def set_mark(self, path):
+        """
+        Set the mark.
+        """
+        if self.get_mark() != path:
+            self.__change__(['mark', path])
+
+    def commit(self):
+        """
+        Save any changes made since the last commit. Only the shards that
+        changed are rewritten.
+        """
+        if len(self.pending) == 0:
+            return
+
+        lock_file = open(os.path.join(self.shards_dir, 'lock'), 'a')
+        __lock_file__(lock_file)
+        try:
+            disk_generation = self.__disk_generation__()
+
+            # re-read each changed shard (and the state, if it changed), to
+            # pick up changes made by other processes, and apply ours on top.
+            shards = {}
+            state = None
+            for record in self.pending:
+                if record[0] in ('set', 'forget'):
+                    shard = ShardedStore.shard_of(record[1])
+                    if shard not in shards:
+                        shards[shard] = self.__read_json__(
+                            self.__shard_path__(shard), {})
+                    self.__apply__(record, locations=shards[shard])
+                else:
+                    if state is None:
+                        state = self.__read_json__(
+                            os.path.join(self.shards_dir, 'state.json'),
+                            {'mark': "", 'stack': []})
+                    self.__apply__(record, state=state)
+
+            for (shard, locations) in shards.items():
+                self.__write_json__(self.__shard_path__(shard), locations)
+                self.shards[shard] = locations
+            if state is not None:
+                self.__write_json__(os.path.join(self.shards_dir, 'state.json'),
+                                    state)
+                self.state = state
+            self.__write_json__(self.generation_path, disk_generation + 1)
+
+            # only if there's no completion file yet are all of the shards
+            # read.
+            def read_locations():
+                locations = {}
+                for shard in range(ShardedStore.SHARDS):
+                    locations.update(self.__read_json__(
+                        self.__shard_path__(shard), {}))
+                return locations
+            __update_completions__(self.home_dir,
+                                   __location_changes__(self.pending),
+                                   read_locations)
+        finally:
+            lock_file.close()
+
+        # if someone else committed since we read, is_stale() should say so.
+        if disk_generation == self.generation:
+            self.generation = disk_generation + 1
+        self.pending = []
+
+    def rollback(self):
+        """
+        Drop any changes made since the last commit.
+        """
+        self.load()
+
+
+class MemoryStore(JsonStore):
+    """
+    Keeps dhop data in memory only, for programs that use dhop's API (see
+    Resolver) with locations of their own, rather than the user's.
+
+    It has the same methods as the other backends. commit() keeps the
+    changes made since the last commit (nothing is written anywhere), and
+    rollback() drops them.
+    """
+    def __init__(self, locations=None, mark="", stack=None):
+        """
+        Initialize the store with a dict of locations, a mark and a stack.
+        """
+        self.saved = {'locations': dict(locations or {}), 'mark': mark,
+                      'stack': list(stack or [])}
+        self.generation = 0
+        JsonStore.__init__(self, None)
+
+    def load(self):
+        """
+        Go back to the data as it was at the last commit.
+        """
+        # the locations might be going back, too.
+        self.generation += 1
+        self.pending = []
+        self.data = {'locations': dict(self.saved['locations']),
+                     'mark': self.saved['mark'],
+                     'stack': list(self.saved['stack'])}
+
+    def is_stale(self):
+        """
+        Always False, since nothing else can change the data.
+        """
+        return False
+
+    def commit(self):
+        """
+        Keep the changes made since the last commit.
+        """
+        self.saved = self.data
+        self.load()
+
+
+class SessionStore:
+    """
+    Keeps the stack and mark of one terminal session in a small file of its
+    own (~/.dhop.sessions/<session>.json), in front of another store that
+    keeps the locations, which every session shares.
+
+    This is used when $DHOP_SESSION is set: to 'auto', the session is the
+    tmux pane, or otherwise the terminal, that dhop was run from; any other
+    value is used as the session's name. Pushes, pops and marks in one
+    terminal then don't get mixed up with another's, and they never rewrite
+    the shared store. $DHOP_STACK_DEPTH, if it's set, limits how deep a
+    session's stack gets; the oldest entries are dropped.
+
+    The shell wrappers pass the shell's process ID in $DHOP_SESSION_PID,
+    which is kept in the file of an 'auto' session. A terminal's name is
+    reused once it's closed, so an auto session's file left by a shell that
+    has exited is ignored, and once every GC_INTERVAL seconds, the files of
+    auto sessions whose shells have exited, or that haven't been used for
+    MAX_AGE seconds, are removed. Named sessions are meant to outlive their
+    terminals (and can be shared by several at once), so they're kept until
+    they're removed by hand.
+
+    Changes are saved by commit(), which takes a lock, re-reads the session
+    file and applies the changes to it, so that terminals in the same
+    session don't overwrite each other's pushes and pops.
+
+    Everything other than the stack and the mark is passed on to the shared
+    store.
+    """
+    GC_INTERVAL = 3600
+    MAX_AGE = 30 * 24 * 3600
+
+    def __init__(self, store, home_dir, session, pid=None, depth=None,
+                 auto=False):
+        """
+        Initialize the session store, in front of store. pid is the ID of the
+        session's shell (if known), depth the most entries to keep on the
+        stack (if there's a limit), and auto is True if the session's name
+        was made from the terminal's (see above). The session file is read
+        when it's first needed.
+        """
+        self.store = store
+        self.sessions_dir = os.path.join(home_dir, Dhop.DHOP_SESSIONS)
+        self.session_path = os.path.join(self.sessions_dir,
+                                         '%s.json' % session)
+        self.auto = auto
+        # only an auto session belongs to its shell.
+        self.pid = pid if auto else None
+        self.depth = depth
+        self.load_session()
+
+    @staticmethod
+    def session_name():
+        """
+        Return the name of the current session, from $DHOP_SESSION (see
+        above), or None if there isn't one.
+        """
+        setting = os.environ.get('DHOP_SESSION', '')
+        if setting == '':
+            return None
+
+        import re
+        if setting == 'auto':
+            # $TMUX is '<socket>,<server pid>,<session>'; pane IDs are only
+            # unique to a server.
+            if os.environ.get('TMUX_PANE'):
+                setting = 'tmux-%s-%s' % (
+                    (os.environ.get('TMUX', '').split(',') + ['', ''])[1],
+                    os.environ['TMUX_PANE'])
+            else:
+                try:
+                    setting = os.ttyname(0)
+                except (OSError, AttributeError):
+                    return None
+                if setting.startswith('/dev/'):
+                    setting = setting[len('/dev/'):]
+        setting = re.sub('[^A-Za-z0-9._-]+', '_', setting).strip('.')
+        return setting or None
+
+    @staticmethod
+    def wrap(store, home_dir):
+        """
+        Return a SessionStore in front of store if $DHOP_SESSION names a
+        session, or store itself if it doesn't.
+        """
+        session = SessionStore.session_name()
+        if session is None:
+            return store
+
+        pid = os.environ.get('DHOP_SESSION_PID', '')
+        depth = os.environ.get('DHOP_STACK_DEPTH', '')
+        return SessionStore(store, home_dir, session,
+                            int(pid) if pid.isdigit() else None,
+                            int(depth) if depth.isdigit() else None,
+                            os.environ.get('DHOP_SESSION') == 'auto')
+
+    def __getattr__(self, name):
+        # the locations (and anything else) are the shared store's.
+        return getattr(self.store, name)
+
+    def load_session(self):
+        """
+        Forget the session's data (and any changes to it), so that it's read
+        again when it's next needed.
+        """
+        self.session = None
+        self.session_state = None
+        self.pending = []
+
+    def __session__(self):
+        """
+        Return the session's data, reading the session file if it hasn't
+        been read.
+        """
+        import json
+
+        if self.session is not None:
+            return self.session
+
+        self.session = {'mark': "", 'stack': [], 'pid': self.pid,
+                        'auto': self.auto}
+        self.session_state = self.__session_state__()
+        try:
+            session_file = open(self.session_path, 'r')
+        except (IOError, OSError):
+            return self.session
+        try:
+            data = json.load(session_file)
+        except ValueError:
+            data = None
+        session_file.close()
+        if not isinstance(data, dict):
+            data = {}
+
+        # an auto session left by a shell that has exited isn't this one,
+        # even if it has the same name.
+        owner = data.get('pid')
+        if (not self.auto or self.pid is None or owner is None or
+                owner == self.pid or SessionStore.__alive__(owner)):
+            self.session['mark'] = data.get('mark', "")
+            self.session['stack'] = data.get('stack', [])
+            self.session['pid'] = self.pid or owner
+        return self.session
+
+    def __session_state__(self):
+        try:
+            st = os.stat(self.session_path)
+            return (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+    @staticmethod
+    def __alive__(pid):
+        """
+        Return True if the process pid is still running.
+        """
+        try:
+            os.kill(pid, 0)
+        except PermissionError:
+            return True
+        except (OSError, OverflowError):
+            return False
+        return True
+
+    def load(self):
+        """
+        Reload the shared store, and the session's data.
+        """
+        self.store.load()
+        self.load_session()
+
+    def is_stale(self):
+        """
+        Return True if the shared store, or this session's file, has been
+        changed by another dhop process since it was read.
+        """
+        if self.store.is_stale():
+            return True
+        return (self.session is not None and
+                self.__session_state__() != self.session_state)
+
+    def dump(self):
+        """
+        Return all of the data (see JsonStore.dump), with this session's
+        stack and mark.
+        """
+        data = dict(self.store.dump())
+        data['mark'] = self.get_mark()
+        data['stack'] = self.__session__()['stack']
+        return data
+
+    def get_mark(self):
+        """
+        Return the session's marked path ("" if there isn't one).
+        """
+        return self.__session__()['mark']
+
+    def __apply__(self, session, record):
+        """
+        Apply a change record (see JsonStore) to the session's data.
+        """
+        op = record[0]
+        stack = session['stack']
+        if op == 'push':
+            stack.append(record[1])
+            if self.depth is not None and len(stack) > self.depth:
+                del stack[:len(stack) - self.depth]
+        elif op == 'pop':
+            if record[1] > 0:
+                del stack[-record[1]:]
+        elif op == 'drop':
+            session['stack'] = [path for path in stack
+                                if path not in record[1]]
+        elif op == 'mark':
+            session['mark'] = record[1]
+
+    def __change__(self, record):
+        """
+        Apply a change record and queue it to be saved by commit().
+        """
+        self.__apply__(self.__session__(), record)
+        self.pending.append(record)
+
+    def set_mark(self, path):
+        """
+        Set the session's mark.
+        """
+        if self.get_mark() != path:
+            self.__change__(['mark', path])
+
+    def push(self, path):
+        """
+        Push a path onto the session's stack, dropping the oldest entries if
+        it's as deep as it's allowed to get.
+        """
+        self.__change__(['push', path])
+
+    def pop(self, count=1):
+        """
+        Pop count paths (or all of them, if count is None) from the session's
+        stack, and return the last one popped (or None, if it's empty).
+        """
+        stack = self.__session__()['stack']
+        if count is None:
+            count = len(stack)
+        count = min(count, len(stack))
+        if count == 0:
+            return None
+        path = stack[-count]
+        self.__change__(['pop', count])
+        return path
+
+    def drop_from_stack(self, paths):
+        """
+        Remove every entry for the given paths from the session's stack.
+        """
+        if len(set(paths) & set(self.__session__()['stack'])) != 0:
+            self.__change__(['drop', sorted(set(paths))])
+
+    def commit(self):
+        """
+        Save any changes to the shared store and to the session's file.
+        """
+        import json
+
+        self.store.commit()
+        if len(self.pending) == 0:
+            return
+
+        if not os.path.isdir(self.sessions_dir):
+            os.mkdir(self.sessions_dir, 0o700)
+        lock_file = open(os.path.join(self.sessions_dir, '.lock'), 'a')
+        __lock_file__(lock_file)
+        try:
+            # re-read the session, to pick up changes made by other dhop
+            # processes in it, and apply ours on top.
+            self.session = None
+            session = self.__session__()
+            for record in self.pending:
+                self.__apply__(session, record)
+
+            temp_path = '%s.%d.tmp' % (self.session_path, os.getpid())
+            session_file = open(temp_path, 'w')
+            json.dump(session, session_file)
+            session_file.close()
+            os.replace(temp_path, self.session_path)
+            self.session_state = self.__session_state__()
+            self.pending = []
+
+            self.__collect__()
+        finally:
+            lock_file.close()
+
+    def rollback(self):
+        """
+        Drop any changes made since the last commit.
+        """
+        self.store.rollback()
+        self.load_session()
+
+    def __collect__(self):
+        """
+        Remove the files of dead auto sessions, if that hasn't been done for
+        GC_INTERVAL seconds. The caller should hold the sessions' lock.
+        """
+        import json
+        import time
+
+        stamp_path = os.path.join(self.sessions_dir, '.collected')
+        now = time.time()
+        try:
+            if now - os.stat(stamp_path).st_mtime < SessionStore.GC_INTERVAL:
+                return
+        except OSError:
+            pass
+        open(stamp_path, 'w').close()
+
+        for entry in os.listdir(self.sessions_dir):
+            path = os.path.join(self.sessions_dir, entry)
+            if not entry.endswith('.json') or path == self.session_path:
+                continue
+            try:
+                session_file = open(path, 'r')
+                try:
+                    data = json.load(session_file)
+                finally:
+                    session_file.close()
+                if not data.get('auto'):
+                    continue
+                pid = data.get('pid')
+                if (now - os.stat(path).st_mtime > SessionStore.MAX_AGE or
+                        (pid is not None and not SessionStore.__alive__(pid))):
+                    os.remove(path)
+            except (OSError, ValueError, AttributeError):
+                continue
+
+
+def __trigrams__(string):
+    """
+    Return the set of three-character sequences in a string (padded, so that
+    the start and end of the string count for more).
+    """
+    string = '  %s ' % string
+    return set(string[i:i + 3] for i in range(len(string) - 2))
+
+
+class LocationIndex:
+    """
+    An index of the names of the stored locations, for finding a location from
+    the start of its name, or from a name that's close to it.
+
+    Names are kept in a sorted list, so that all of the names that start with
+    some text can be found with a binary search, along with a table of the
+    names that contain each three-character sequence (trigram), which is used
+    to find similar names. Both ignore case.
+
+    The index is saved to ~/.dhop.index with marshal (which loads much faster
+    than JSON), along with a stamp from the store backend's version(), so that
+    it's only rebuilt after the locations change. The lists of names for each
+    trigram are kept as packed arrays of positions, which keeps loading fast
+    even with a very large number of names.
+    """
+    FORMAT = 1
+    MAX_MATCHES = 10
+
+    def __init__(self, names, stamp=None):
+        """
+        Build an index of the given location names.
+        """
+        self.stamp = stamp
+
+        pairs = sorted((name.lower(), name) for name in names)
+        self.keys = [key for (key, name) in pairs]
+        self.names = [name for (key, name) in pairs]
+
+        from array import array
+
+        trigrams = {}
+        for (pos, key) in enumerate(self.keys):
+            for trigram in __trigrams__(key):
+                trigrams.setdefault(trigram, []).append(pos)
+
+        self.trigrams = dict((trigram, array('I', positions).tobytes())
+                             for (trigram, positions) in trigrams.items())
+
+    @staticmethod
+    def load(path):
+        """
+        Load a saved index, or return None if it can't be loaded.
+        """
+        import marshal
+
+        try:
+            # reading the whole file first is much faster than letting marshal
+            # read from the file.
+            index_file = open(path, 'rb')
+            try:
+                saved = marshal.loads(index_file.read())
+            finally:
+                index_file.close()
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if type(saved) is not tuple or saved[0] != LocationIndex.FORMAT:
+            return None
+
+        index = LocationIndex([])
+        (_, index.stamp, index.keys, index.names, index.trigrams) = saved
+        return index
+
+    def save(self, path):
+        """
+        Save the index. Failing to save it isn't an error; it's just rebuilt
+        next time.
+        """
+        import marshal
+
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            index_file = open(temp_path, 'wb')
+            marshal.dump((LocationIndex.FORMAT, self.stamp, self.keys,
+                          self.names, self.trigrams), index_file)
+            index_file.close()
+            os.replace(temp_path, path)
+        except OSError:
+            return
+
+    def prefix(self, text):
+        """
+        Return the names that start with text, shortest first.
+        """
+        import bisect
+
+        text = text.lower()
+        start = bisect.bisect_left(self.keys, text)
+        end = bisect.bisect_left(self.keys, text + '\uffff', start)
+        return sorted(self.names[start:end], key=len)
+
+    def similar(self, text):
+        """
+        Return the names most like text, best match first.
+        """
+        from array import array
+        from collections import Counter
+
+        trigrams = __trigrams__(text.lower())
+
+        # count the trigrams that each name shares with the text.
+        shared = Counter()
+        for trigram in trigrams:
+            positions = array('I')
+            positions.frombytes(self.trigrams.get(trigram, b''))
+            shared.update(positions)
+
+        # score the names with the most trigrams in common by how much of the
+        # text and the name they share (a name of length n has n + 1
+        # trigrams, give or take repeats).
+        scores = []
+        for (pos, count) in shared.most_common(LocationIndex.MAX_MATCHES * 5):
+            total = len(trigrams) + len(self.keys[pos]) + 1 - count
+            score = float(count) / total
+            if score >= 0.2:
+                scores.append((-score, self.names[pos]))
+
+        scores.sort()
+        return [name for (score, name) in scores[:LocationIndex.MAX_MATCHES]]
+
+    def lookup(self, text, limit=MAX_MATCHES):
+        """
+        Look up a name that isn't an exact match for a location. Returns
+        ('prefix', names) if any names start with text (at most limit of
+        them), and otherwise ('similar', names), with the names that are
+        closest to it.
+        """
+        names = self.prefix(text)
+        if len(names) != 0:
+            return ('prefix', names[:limit])
+        return ('similar', self.similar(text))
+
+
+class History:
+    """
+    Keeps a record of the places that dhop has taken you (~/.dhop.history),
+    which is used to rank locations by "frecency": how often, and how
+    recently, they've been visited.
+
+    Each visit is appended to the file as a single line (time, weight and
+    path), so recording a visit never rereads or rewrites anything. A visit's
+    weight halves every HALF_LIFE seconds. When the file grows past
+    HISTORY_LIMIT bytes, the visits are added up into one line per path, and
+    only the MAX_PATHS highest-scoring paths are kept.
+
+    Given a runtime directory ($XDG_RUNTIME_DIR), visits are appended to a
+    file there (dhop.visits) instead, and only moved to the history file
+    once there are PENDING_LIMIT bytes of them, so most hops don't write to
+    the home directory (which is often on a network filesystem) at all.
+    Visits that haven't been moved yet count as usual, but are lost if the
+    runtime directory is cleared (when the user logs out, say).
+    """
+    HALF_LIFE = 7 * 24 * 60 * 60
+    HISTORY_LIMIT = 64 * 1024
+    PENDING_LIMIT = 4 * 1024
+    MAX_PATHS = 1000
+
+    def __init__(self, home_dir, runtime_dir=None):
+        """
+        Initialize the history, which is kept in home_dir (with recent visits
+        in runtime_dir, if it's given).
+        """
+        self.history_path = os.path.join(home_dir, Dhop.DHOP_HISTORY)
+        self.pending_path = None
+        if runtime_dir is not None:
+            self.pending_path = os.path.join(runtime_dir, Dhop.DHOP_VISITS)
+
+        # the last scores read, and the size and time of the file they were
+        # read from.
+        self.cached_scores = None
+        self.cached_state = None
+
+    def record(self, paths):
+        """
+        Record a visit to each of the given paths.
+        """
+        import time
+
+        # the file is line-based, so paths with newlines can't be recorded.
+        now = int(time.time())
+        lines = ''.join(['%d\t1\t%s\n' % (now, path) for path in paths
+                         if '\n' not in path])
+        if len(lines) == 0:
+            return
+
+        if self.pending_path is None:
+            self.__append__(lines)
+            return
+
+        pending_file = open(self.pending_path, 'a+')
+        __lock_file__(pending_file)
+        try:
+            pending_file.write(lines)
+            pending_file.flush()
+            if os.fstat(pending_file.fileno()).st_size > History.PENDING_LIMIT:
+                pending_file.seek(0)
+                self.__append__(pending_file.read())
+                pending_file.truncate(0)
+        finally:
+            pending_file.close()
+
+    def __append__(self, lines):
+        """
+        Append lines to the history file, compacting it if it's grown too big.
+        """
+        history_file = open(self.history_path, 'a')
+        __lock_file__(history_file)
+        history_file.write(lines)
+        history_file.flush()
+
+        if os.fstat(history_file.fileno()).st_size > History.HISTORY_LIMIT:
+            self.__compact__(history_file)
+
+        history_file.close()
+
+    def __read_scores__(self, history_file):
+        """
+        Return a dict of {path: score} from the lines in an open history file.
+        """
+        import time
+
+        now = time.time()
+        scores = {}
+        for line in history_file:
+            try:
+                (when, weight, path) = line.rstrip('\n').split('\t', 2)
+                score = float(weight) * 0.5 ** ((now - float(when)) /
+                                                History.HALF_LIFE)
+            except ValueError:
+                continue
+            scores[path] = scores.get(path, 0.0) + score
+        return scores
+
+    def __compact__(self, history_file):
+        """
+        Replace the contents of the (open and locked) history file with one
+        line for each of the highest-scoring paths.
+        """
+        import time
+
+        reader = open(self.history_path, 'r')
+        scores = self.__read_scores__(reader)
+        reader.close()
+
+        best = sorted(scores.items(), key=lambda item: -item[1])
+        now = int(time.time())
+
+        history_file.seek(0)
+        history_file.truncate()
+        for (path, score) in best[:History.MAX_PATHS]:
+            history_file.write('%d\t%.6g\t%s\n' % (now, score, path))
+
+    def scores(self):
+        """
+        Return a dict of {path: score}. The files are only reread if they've
+        changed since the last call (every score decays at the same rate, so
+        the order of the cached scores stays right).
+        """
+        files = []
+        for path in [self.history_path, self.pending_path]:
+            if path is None or not os.path.exists(path):
+                continue
+            history_file = open(path, 'r')
+            __lock_file__(history_file, exclusive=False)
+            files.append(history_file)
+
+        try:
+            state = [(os.fstat(history_file.fileno()).st_size,
+                      os.fstat(history_file.fileno()).st_mtime)
+                     for history_file in files]
+            if state != self.cached_state:
+                scores = {}
+                for history_file in files:
+                    for (path, score) in self.__read_scores__(
+                            history_file).items():
+                        scores[path] = scores.get(path, 0.0) + score
+                self.cached_scores = scores
+                self.cached_state = state
+        finally:
+            for history_file in files:
+                history_file.close()
+        return self.cached_scores
+
+
+class StatCache:
+    """
+    Remembers whether paths exist, so that hopping somewhere again within TTL
+    seconds doesn't touch the filesystem at all. Given a directory to keep
+    them in (Dhop uses $XDG_RUNTIME_DIR, which is usually in memory), the
+    results are kept in its dhop.stats (the MAX_ENTRIES most recent of them),
+    so they're shared by every dhop process. Otherwise, they only last as
+    long as the process does (which, for 'dhop serve', is a long time). The
+    file is only written when something new was learned: a path that wasn't
+    cached, or one whose answer changed.
+
+    Paths are cached by their absolute paths, and only paths that exist (or
+    that couldn't be checked) are cached: a path that's missing may be
+    created at any moment, so it's always checked again.
+
+    Paths that aren't in the cache are checked on a worker thread, which is
+    given TIMEOUT seconds ($DHOP_STAT_TIMEOUT, if it's set) to answer. If a
+    network filesystem is slow or hung, the check gives up with an error
+    instead of hanging the shell, and that answer is cached too, so the next
+    hop there fails straight away. The same worker does every check, unless
+    one of them hangs, in which case it's abandoned and a new one started.
+    """
+    TTL = 10
+    TIMEOUT = 2.0
+    MAX_ENTRIES = 256
+
+    def __init__(self, cache_dir=None):
+        """
+        Initialize the cache, which is kept in cache_dir (or only in memory,
+        if it's None).
+        """
+        self.cache_path = None
+        if cache_dir is not None:
+            self.cache_path = os.path.join(cache_dir, Dhop.DHOP_STATS)
+        try:
+            self.timeout = float(os.environ.get('DHOP_STAT_TIMEOUT',
+                                                StatCache.TIMEOUT))
+        except ValueError:
+            self.timeout = StatCache.TIMEOUT
+
+        # {path: (time checked, True, or None if it timed out)}, which is
+        # read from the cache file when it's first needed.
+        self.entries = None
+        self.changed = False
+
+        # the thread that checks paths (see __check__).
+        self.worker = None
+
+    def __load__(self):
+        """
+        Read the cached entries. A missing or damaged file is treated as an
+        empty cache.
+        """
+        import marshal
+
+        self.entries = {}
+        if self.cache_path is None:
+            return
+        try:
+            cache_file = open(self.cache_path, 'rb')
+            self.entries = marshal.loads(cache_file.read())
+            cache_file.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+        if type(self.entries) is not dict:
+            self.entries = {}
+
+    def __start_worker__(self):
+        """
+        Start a thread that checks the path in its job whenever its 'ready'
+        lock is released, and then releases the job's 'done' lock.
+        """
+        import _thread
+
+        worker = {'ready': _thread.allocate_lock(), 'job': None}
+        worker['ready'].acquire()
+
+        def run():
+            while True:
+                worker['ready'].acquire()
+                job = worker['job']
+                try:
+                    job['result'] = os.path.exists(job['path'])
+                finally:
+                    job['done'].release()
+
+        _thread.start_new_thread(run, ())
+        self.worker = worker
+
+    def __check__(self, path):
+        """
+        Return whether path exists, or None if finding out takes longer than
+        the timeout. A check that times out keeps running in the background
+        (its worker is abandoned), and is given up on when dhop exits.
+        """
+        import _thread
+
+        if self.worker is None:
+            self.__start_worker__()
+
+        job = {'path': path, 'result': None, 'done': _thread.allocate_lock()}
+        job['done'].acquire()
+        self.worker['job'] = job
+        self.worker['ready'].release()
+
+        if not job['done'].acquire(True, self.timeout):
+            self.worker = None
+            return None
+        return job['result']
+
+    def exists(self, path):
+        """
+        Return whether path exists, raising LookupError if its filesystem
+        doesn't answer in time.
+        """
+        import time
+
+        if self.entries is None:
+            self.__load__()
+
+        key = os.path.abspath(path)
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None or not 0 <= now - entry[0] < StatCache.TTL:
+            found = self.__check__(key)
+            if found is False:
+                if key in self.entries:
+                    del self.entries[key]
+                    self.changed = True
+                return False
+            # the same answer again isn't worth writing out.
+            if entry is None or entry[1] != found:
+                self.changed = True
+            entry = (now, found)
+            self.entries[key] = entry
+
+        if entry[1] is None:
+            raise UnreachableError(path, ["Timed out checking %s (is its "
+                                          "filesystem reachable?)" % path])
+        return entry[1]
+
+    def save(self):
+        """
+        Write the cache back to disk, if anything new was learned. Expired
+        entries are dropped.
+        """
+        if not self.changed or self.cache_path is None:
+            return
+
+        import marshal
+        import time
+
+        now = time.time()
+        entries = sorted([(entry[0], path, entry[1]) for (path, entry) in
+                          self.entries.items()
+                          if 0 <= now - entry[0] < StatCache.TTL and
+                          entry[1] is not False],
+                         reverse=True)[:StatCache.MAX_ENTRIES]
+        self.entries = dict([(path, (when, found)) for (when, path, found)
+                             in entries])
+
+        # write to a temporary file and rename it over the old one, so that
+        # other dhop processes never read a partly-written cache.
+        temp_path = '%s.%d' % (self.cache_path, os.getpid())
+        try:
+            cache_file = open(temp_path, 'wb')
+            cache_file.write(marshal.dumps(self.entries))
+            cache_file.close()
+            os.replace(temp_path, self.cache_path)
+        except (IOError, OSError):
+            pass
+        self.changed = False
+
+
+def __mount_points__():
+    """
+    Return the mount points of the mounted filesystems, longest first, or just
+    the root directory if they can't be found (they're read from
+    /proc/self/mounts, so this only finds them on Linux).
+    """
+    mount_points = set([os.sep])
+    try:
+        mounts_file = open('/proc/self/mounts', 'r')
+        for line in mounts_file:
+            fields = line.split()
+            if len(fields) > 1:
+                # spaces and the like are written as octal escapes.
+                mount_points.add(fields[1].encode('latin-1').decode(
+                    'unicode_escape'))
+        mounts_file.close()
+    except (IOError, OSError, UnicodeError):
+        pass
+    return sorted(mount_points, key=len, reverse=True)
+
+
+class HealthCheck:
+    """
+    Checks whether many directories exist, for 'dhop check'.
+
+    The checks are made by a pool of worker threads, so that slow filesystems
+    are waited on in parallel. A check that takes longer than the timeout is
+    given up on, and the whole filesystem that it's on is then taken to be
+    unreachable: its other paths aren't checked at all, so a dead network
+    mount costs one timeout rather than one per path. Workers that are stuck
+    on such a check are replaced, and are abandoned when dhop exits.
+    """
+    DEFAULT_JOBS = 32
+
+    def __init__(self, jobs=DEFAULT_JOBS, timeout=StatCache.TIMEOUT):
+        """
+        Initialize the check, with jobs worker threads and a timeout (in
+        seconds) for each path.
+        """
+        self.jobs = jobs
+        self.timeout = timeout
+
+    def __mount_point__(self, path):
+        """
+        Return the mount point of the filesystem that path is on.
+        """
+        for mount_point in self.mount_points:
+            if (path == mount_point or
+                    path.startswith(mount_point.rstrip(os.sep) + os.sep)):
+                return mount_point
+        return os.sep
+
+    def __work__(self):
+        """
+        Check paths from the queue until there are none left (run on each
+        worker thread).
+        """
+        import errno
+        import stat
+        import time
+
+        while True:
+            with self.lock:
+                if len(self.queue) == 0:
+                    return
+                path = self.queue.popleft()
+                if self.__mount_point__(path) in self.dead_mounts:
+                    self.results[path] = 'unreachable'
+                    continue
+                self.started[path] = time.time()
+
+            try:
+                if stat.S_ISDIR(os.stat(path).st_mode):
+                    result = 'ok'
+                else:
+                    result = 'not a directory'
+            except (IOError, OSError) as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    result = 'missing'
+                else:
+                    result = e.strerror or str(e)
+
+            with self.lock:
+                if path in self.started:
+                    del self.started[path]
+                    self.results[path] = result
+                else:
+                    # it took too long, and has already been reported.
+                    self.stuck -= 1
+
+    def run(self, paths):
+        """
+        Check the given paths, and return a dict of {path: result}, where the
+        result is 'ok', 'missing', 'not a directory', 'unreachable' (if the
+        check timed out, or its filesystem is unreachable) or the error that
+        checking it gave.
+        """
+        import collections
+        import threading
+        import time
+
+        self.mount_points = __mount_points__()
+        self.queue = collections.deque(sorted(set(paths)))
+        self.results = {}
+        # when each check that's underway started.
+        self.started = {}
+        self.dead_mounts = set()
+        # the number of workers still waiting on checks that timed out.
+        self.stuck = 0
+        self.lock = threading.Lock()
+
+        total = len(self.queue)
+        workers = []
+
+        while True:
+            with self.lock:
+                now = time.time()
+                for (path, started) in list(self.started.items()):
+                    if now - started > self.timeout:
+                        del self.started[path]
+                        self.results[path] = 'unreachable'
+                        self.dead_mounts.add(self.__mount_point__(path))
+                        self.stuck += 1
+                if len(self.results) == total:
+                    break
+                # stuck workers don't count towards the number of jobs.
+                workers = [worker for worker in workers if worker.is_alive()]
+                wanted = min(self.jobs, len(self.queue)) - (len(workers) -
+                                                             self.stuck)
+
+            for x in range(wanted):
+                worker = threading.Thread(target=self.__work__)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+            time.sleep(0.01)
+
+        return self.results
+
+
+class DirectoryIndex:
+    """
+    An index of the directories beneath the stored locations, for 'dhop
+    find'.
+
+    For each directory, the index keeps its modification time and the names
+    of its subdirectories. A directory's modification time changes whenever
+    something is added to, removed from or renamed in it, so when the index
+    is refreshed, only the directories whose times have changed are read
+    again; the rest just get a stat. Each location is crawled on its own
+    worker thread.
+
+    The index is saved to ~/.dhop.dirs with marshal, along with the time that
+    it was built. Hidden directories (and those in SKIPPED) aren't indexed.
+    """
+    FORMAT = 1
+    DEFAULT_JOBS = 8
+
+    # an index older than this (in seconds) is refreshed after it's used.
+    REFRESH_AGE = 60 * 60
+
+    SKIPPED = ['__pycache__', 'node_modules']
+
+    def __init__(self, path):
+        """
+        Initialize the index, loading it from path if it's been saved.
+        """
+        import marshal
+
+        self.path = path
+        self.built = 0
+        # {directory path: (modification time, subdirectory names)}
+        self.dirs = {}
+        self.roots = []
+
+        try:
+            index_file = open(path, 'rb')
+            try:
+                saved = marshal.loads(index_file.read())
+            finally:
+                index_file.close()
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+
+        if type(saved) is tuple and saved[0] == DirectoryIndex.FORMAT:
+            (_, self.built, self.roots, self.dirs) = saved
+
+    def save(self):
+        """
+        Save the index. Failing to save it isn't an error; it's just rebuilt
+        next time.
+        """
+        import marshal
+
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            index_file = open(temp_path, 'wb')
+            marshal.dump((DirectoryIndex.FORMAT, self.built, self.roots,
+                          self.dirs), index_file)
+            index_file.close()
+            os.replace(temp_path, self.path)
+        except OSError:
+            return
+
+    def __crawl__(self, root):
+        """
+        Return the index entries for root and everything beneath it, reading
+        only the directories that have changed since the last refresh.
+        """
+        import time
+
+        # a directory changed in the same tick as it was read might look
+        # unchanged later, so recent times aren't trusted.
+        trust_before = (time.time() - 2) * 1e9
+        found = {}
+        pending = [root]
+
+        while len(pending) != 0:
+            path = pending.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            known = self.dirs.get(path)
+            if known is not None and known[0] == mtime:
+                children = known[1]
+            else:
+                children = []
+                try:
+                    for entry in os.scandir(path):
+                        if (entry.name.startswith('.') or
+                                entry.name in DirectoryIndex.SKIPPED):
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                children.append(entry.name)
+                        except OSError:
+                            continue
+                except OSError:
+                    pass
+                if mtime > trust_before:
+                    mtime = -1
+
+            found[path] = (mtime, children)
+            pending.extend([os.path.join(path, child) for child in children])
+
+        return found
+
+    def refresh(self, roots, jobs=DEFAULT_JOBS, timeout=StatCache.TIMEOUT):
+        """
+        Bring the index up to date for the given locations, crawling jobs of
+        them at once. Locations that can't be reached within timeout seconds
+        keep what was indexed for them before.
+        """
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        # nested locations are crawled along with the ones they're in.
+        roots = sorted(set([os.path.normpath(root) for root in roots]))
+        # (sorting puts each location after the ones it's in.)
+        outer = set()
+        for root in roots:
+            ancestor = root
+            while (ancestor not in outer and
+                   os.path.dirname(ancestor) != ancestor):
+                ancestor = os.path.dirname(ancestor)
+            if ancestor not in outer:
+                outer.add(root)
+        outer = sorted(outer)
+
+        results = HealthCheck(jobs, timeout).run(outer)
+        reachable = [root for root in outer if results[root] == 'ok']
+
+        self.built = time.time()
+        dirs = {}
+        pool = ThreadPoolExecutor(max_workers=jobs)
+        try:
+            for found in pool.map(self.__crawl__, reachable):
+                dirs.update(found)
+        finally:
+            pool.shutdown()
+
+        # keep the old entries for the locations that couldn't be reached.
+        for root in outer:
+            if results[root] == 'unreachable':
+                prefix = root.rstrip(os.sep) + os.sep
+                for (path, entry) in self.dirs.items():
+                    if path == root or path.startswith(prefix):
+                        dirs[path] = entry
+
+        self.dirs = dirs
+        self.roots = roots
+
+    def needs_refresh(self, roots):
+        """
+        Return 'now' if some of the given locations haven't been indexed yet,
+        'later' if the index is getting old, or None.
+        """
+        import time
+
+        roots = sorted(set([os.path.normpath(root) for root in roots]))
+        if roots != self.roots:
+            return 'now'
+        if not 0 <= time.time() - self.built < DirectoryIndex.REFRESH_AGE:
+            return 'later'
+        return None
+
+    def find(self, pattern):
+        """
+        Generate the paths of the indexed directories whose names match
+        pattern, ignoring case: a shell-style pattern, if it has any of the
+        characters '*?[', or otherwise any part of the name.
+        """
+        import fnmatch
+
+        pattern = pattern.lower()
+        if any([c in pattern for c in '*?[']):
+            matches = lambda name: fnmatch.fnmatchcase(name, pattern)
+        else:
+            matches = lambda name: pattern in name
+
+        for path in self.dirs:
+            if matches(os.path.basename(path).lower()):
+                yield path
+
+
+class Watcher:
+    """
+    Keeps the stored locations up to date as their directories are renamed,
+    moved or removed, for 'dhop watch'.
+
+    Every directory above a stored location is watched with Linux inotify, so
+    renaming or moving a location (or any directory it's in) is seen as it
+    happens, and the location is changed to match. Events are read in
+    bursts: once one arrives, the watcher waits until things have been quiet
+    for COALESCE seconds before acting on them all at once, and saves any
+    changes to the store in a single commit.
+
+    A rename shows up as a pair of events (moved from, and moved to) with
+    the same cookie. If only the first of them has arrived by the time a
+    burst is handled, it's kept for the next one, and the location is only
+    checked if the second still hasn't turned up by then.
+
+    Which locations are known to be valid is kept in a bitmap, saved to
+    ~/.dhop.valid along with the store's version and the watcher's process
+    id. While the watcher is running and the store hasn't changed behind its
+    back, hops trust the bitmap instead of checking that the location
+    exists (see Watcher.is_valid). When the store does change, only
+    locations that weren't there before are checked.
+
+    Where inotify isn't available, or the limit on the number of watches has
+    been reached, locations are polled instead: every POLL_INTERVAL seconds,
+    the modification time of each one's parent directory is checked, and the
+    location is checked again if it has changed. Polled locations can't
+    follow a rename; they're only marked invalid.
+    """
+    FORMAT = 1
+    COALESCE = 0.2
+    POLL_INTERVAL = 5
+
+    # from <sys/inotify.h>
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    IN_NONBLOCK = 0o4000
+
+    WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, backend, validity_path, prune=False):
+        """
+        Initialize the watcher for the locations in backend. If prune is True,
+        locations whose directories are removed are forgotten.
+        """
+        self.backend = backend
+        self.validity_path = validity_path
+        self.prune = prune
+
+        # {watch descriptor: directory}, and the reverse.
+        self.watches = {}
+        self.watched = {}
+        # {location path: parent's modification time}, for polled locations.
+        self.polled = {}
+        # {cookie: path}, for moves whose other half hasn't been seen yet.
+        self.moves = {}
+        # {name: normalized path}, the sorted list of the paths that the
+        # bitmap is for, and the ones that are valid.
+        self.locations = {}
+        self.paths = []
+        self.valid = set()
+        self.libc = None
+        self.fd = None
+
+        try:
+            import ctypes
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(Watcher.IN_NONBLOCK |
+                                              Watcher.IN_CLOEXEC)
+            if self.fd < 0:
+                self.fd = None
+        except (ImportError, OSError, AttributeError):
+            self.fd = None
+
+        self.__load__()
+
+    def __load__(self):
+        """
+        (Re)read the locations from the store, check the ones that are new
+        (the watches already keep the others up to date), and watch (or poll)
+        them.
+        """
+        if self.backend.is_stale():
+            self.backend.load()
+        self.stamp = self.backend.version()
+
+        locations = dict((name, os.path.normpath(path)) for (name, path) in
+                         self.backend.dump()['locations'].items())
+        if locations == self.locations:
+            return
+        self.locations = locations
+
+        paths = sorted(set(locations.values()))
+        new_paths = sorted(set(paths) - set(self.paths))
+        results = HealthCheck().run(new_paths)
+        self.valid = ((self.valid & set(paths)) |
+                      set([path for path in new_paths
+                           if results[path] == 'ok']))
+        self.paths = paths
+
+        self.__sync_watches__()
+
+    def __sync_watches__(self):
+        """
+        Watch every directory above a location (and stop watching any that
+        no longer are). Locations beneath a directory that can't be watched
+        are polled instead.
+        """
+        wanted = set()
+        for path in self.paths:
+            parent = os.path.dirname(path)
+            while parent not in wanted:
+                wanted.add(parent)
+                if os.path.dirname(parent) == parent:
+                    break
+                parent = os.path.dirname(parent)
+
+        for (wd, directory) in list(self.watches.items()):
+            if directory not in wanted:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+                del self.watched[directory]
+
+        unwatchable = set()
+        for directory in sorted(wanted):
+            if directory in self.watched:
+                continue
+            wd = -1
+            if self.fd is not None:
+                wd = self.libc.inotify_add_watch(
+                    self.fd, directory.encode(sys.getfilesystemencoding(),
+                                              'surrogateescape'),
+                    Watcher.WATCH_MASK | Watcher.IN_ONLYDIR)
+            if wd < 0:
+                unwatchable.add(directory)
+                continue
+            # a renamed directory keeps its watch descriptor.
+            if wd in self.watches:
+                del self.watched[self.watches[wd]]
+            self.watches[wd] = directory
+            self.watched[directory] = wd
+
+        polled = {}
+        for path in self.paths:
+            if os.path.dirname(path) in unwatchable:
+                polled[path] = self.polled.get(path, self.__parent_mtime__(
+                    path))
+        self.polled = polled
+
+    def __parent_mtime__(self, path):
+        """
+        Return the modification time of the directory that path is in, or None
+        if it can't be read.
+        """
+        try:
+            return os.stat(os.path.dirname(path)).st_mtime_ns
+        except OSError:
+            return None
+
+    def __beneath__(self, directory):
+        """
+        Return the location paths that are directory, or are inside it.
+        """
+        import bisect
+
+        start = bisect.bisect_left(self.paths, directory)
+        found = []
+        if start < len(self.paths) and self.paths[start] == directory:
+            found.append(directory)
+        prefix = directory.rstrip(os.sep) + os.sep
+        start = bisect.bisect_left(self.paths, prefix)
+        for path in self.paths[start:]:
+            if not path.startswith(prefix):
+                break
+            found.append(path)
+        return found
+
+    def __read_events__(self):
+        """
+        Return the events waiting to be read, as a list of (watch descriptor,
+        mask, cookie, name).
+        """
+        import struct
+
+        data = b''
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+
+        events = []
+        offset = 0
+        while offset + 16 <= len(data):
+            (wd, mask, cookie, length) = struct.unpack_from('iIII', data,
+                                                           offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            events.append((wd, mask, cookie,
+                           name.decode(sys.getfilesystemencoding(),
+                                       'surrogateescape')))
+            offset += 16 + length
+        return events
+
+    def __handle__(self, events):
+        """
+        Act on a burst of events, and return True if anything changed.
+        """
+        # the moves left over from the last burst get this one to find
+        # their other halves.
+        moves = self.moves
+        self.moves = {}
+        touched = set()
+        resync = False
+
+        for (wd, mask, cookie, name) in events:
+            if mask & Watcher.IN_Q_OVERFLOW:
+                # some events were lost; check everything again.
+                touched.update(self.paths)
+                continue
+            if mask & Watcher.IN_IGNORED:
+                # the directory was removed (or stopped being watched).
+                directory = self.watches.pop(wd, None)
+                if directory is not None:
+                    del self.watched[directory]
+                resync = True
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not mask & Watcher.IN_ISDIR:
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & Watcher.IN_MOVED_FROM:
+                self.moves[cookie] = path
+            elif mask & Watcher.IN_MOVED_TO and (cookie in self.moves or
+                                                 cookie in moves):
+                old_path = self.moves.pop(cookie, None)
+                if old_path is None:
+                    old_path = moves.pop(cookie)
+                self.__rename__(old_path, path)
+                touched.update(self.__beneath__(path))
+                resync = True
+            else:
+                touched.update(self.__beneath__(path))
+
+        # check each location that might have changed. Anything that was moved
+        # somewhere unwatched is gone, as far as dhop is concerned.
+        for path in moves.values():
+            touched.update(self.__beneath__(path))
+        changed = resync
+        location_paths = set(self.locations.values())
+        for path in touched:
+            if path not in location_paths:
+                continue
+            is_valid = os.path.isdir(path)
+            if is_valid != (path in self.valid):
+                changed = True
+                if is_valid:
+                    self.valid.add(path)
+                else:
+                    self.valid.discard(path)
+                    if self.prune:
+                        for name in [name for (name, location) in
+                                     self.locations.items()
+                                     if location == path]:
+                            self.backend.forget(name)
+                            del self.locations[name]
+                        resync = True
+
+        if resync:
+            self.paths = sorted(set(self.locations.values()))
+            self.valid &= set(self.paths)
+            self.__sync_watches__()
+        return changed
+
+    def __rename__(self, old_path, new_path):
+        """
+        Move the locations at or beneath old_path to new_path.
+        """
+        moved = set(self.__beneath__(old_path))
+        if len(moved) == 0:
+            return
+
+        for (name, path) in list(self.locations.items()):
+            if path in moved:
+                path = new_path + path[len(old_path):]
+                self.locations[name] = path
+                self.backend.set_location(name, path)
+                print("dhop: %s moved to %s" % (name, path))
+                sys.stdout.flush()
+
+        for path in moved:
+            if path in self.valid:
+                self.valid.discard(path)
+                self.valid.add(new_path + path[len(old_path):])
+        self.paths = sorted(set(self.locations.values()))
+
+    def __poll__(self):
+        """
+        Check the polled locations whose parent directories have changed, and
+        return True if any of them became valid or invalid.
+        """
+        changed = False
+        for (path, mtime) in list(self.polled.items()):
+            new_mtime = self.__parent_mtime__(path)
+            if new_mtime == mtime and new_mtime is not None:
+                continue
+            self.polled[path] = new_mtime
+            is_valid = os.path.isdir(path)
+            if is_valid != (path in self.valid):
+                changed = True
+                if is_valid:
+                    self.valid.add(path)
+                else:
+                    self.valid.discard(path)
+
+        # a directory that has come back might be watchable again.
+        if changed:
+            self.__sync_watches__()
+        return changed
+
+    def __save__(self):
+        """
+        Commit any changes to the store, and save the validity bitmap (along
+        with the store's new version).
+        """
+        import marshal
+
+        self.backend.commit()
+        self.stamp = self.backend.version()
+
+        bitmap = bytearray((len(self.paths) + 7) // 8)
+        for (pos, path) in enumerate(self.paths):
+            if path in self.valid:
+                bitmap[pos // 8] |= 1 << (pos % 8)
+
+        temp_path = '%s.%d.tmp' % (self.validity_path, os.getpid())
+        try:
+            validity_file = open(temp_path, 'wb')
+            marshal.dump((Watcher.FORMAT, self.stamp, os.getpid(),
+                          self.paths, bytes(bitmap)), validity_file)
+            validity_file.close()
+            os.replace(temp_path, self.validity_path)
+        except OSError:
+            return
+
+    def run(self):
+        """
+        Watch until interrupted (with Ctrl-C or SIGTERM).
+        """
+        import select
+        import time
+
+        self.__save__()
+        last_poll = time.time()
+
+        try:
+            while True:
+                changed = False
+                if self.fd is not None:
+                    ready = select.select([self.fd], [], [], 1.0)[0]
+                else:
+                    ready = []
+                    time.sleep(1.0)
+
+                if len(ready) != 0:
+                    # wait for the burst to die down, then handle it whole.
+                    events = self.__read_events__()
+                    while select.select([self.fd], [], [],
+                                        Watcher.COALESCE)[0]:
+                        events.extend(self.__read_events__())
+                    changed = self.__handle__(events)
+                elif len(self.moves) != 0:
+                    # the other halves of the last burst's moves never came.
+                    changed = self.__handle__([])
+
+                if time.time() - last_poll >= Watcher.POLL_INTERVAL:
+                    changed = self.__poll__() or changed
+                    last_poll = time.time()
+
+                # pick up locations that were set or forgotten meanwhile.
+                if (self.backend.version() != self.stamp or
+                        self.backend.is_stale()):
+                    self.__load__()
+                    changed = True
+
+                if changed:
+                    self.__save__()
+        finally:
+            if os.path.exists(self.validity_path):
+                os.remove(self.validity_path)
+            if self.fd is not None:
+                os.close(self.fd)
+
+    @staticmethod
+    def read_validity(validity_path):
+        """
+        Return the saved validity bitmap, as (store version, watcher's process
+        id, sorted location paths, bitmap), or None if there isn't one, or
+        the watcher that saved it isn't running any more.
+        """
+        import marshal
+
+        try:
+            validity_file = open(validity_path, 'rb')
+            try:
+                saved = marshal.loads(validity_file.read())
+            finally:
+                validity_file.close()
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if type(saved) is not tuple or saved[0] != Watcher.FORMAT:
+            return None
+        try:
+            os.kill(saved[2], 0)
+        except OSError:
+            return None
+        return saved[1:]
+
+    @staticmethod
+    def is_valid(validity, path, stamp):
+        """
+        Return True if the watcher vouches for path (a location path) being
+        valid, given the saved validity (see read_validity) and the store's
+        current version.
+        """
+        import bisect
+
+        if validity is None:
+            return False
+        (saved_stamp, pid, paths, bitmap) = validity
+        if saved_stamp != stamp:
+            return False
+
+        path = os.path.normpath(path)
+        pos = bisect.bisect_left(paths, path)
+        if pos == len(paths) or paths[pos] != path:
+            return False
+        return bool(bitmap[pos // 8] & (1 << (pos % 8)))
+
+
+class TransferJournal:
+    """
+    A checkpoint journal for a 'dhop cp' or 'dhop mv', so that an interrupted
+    transfer can be picked up where it left off (with --resume).
+
+    The journal is kept in ~/.dhop.transfers, under a name made from the
+    command and the directory that it was run in, so running the same
+    command again finds it. Each line is a JSON list:
+
+    * ["done", target, size, mtime]: the file (of the given size and
+      modification time) was copied to target.
+    * ["part", target, offset, size, mtime]: the first offset bytes of a large
+      file have been copied to target (from a source of the given size and
+      modification time).
+    * ["committed", source]: a move of source has been committed, but the
+      source might not have been removed yet.
+    * ["moved", source]: source has been moved and removed.
+
+    Records are written from the worker threads, so writing is locked, and
+    each one is flushed as it's written. The journal is removed once the
+    transfer has finished without errors.
+
+    Most transfers are over too soon to be worth resuming, so the journal
+    isn't written at all until it has MIN_RECORDS records, or a large file's
+    first piece is recorded; until then, the records are kept in memory,
+    and only written out if the transfer is interrupted or fails.
+    """
+    MIN_RECORDS = 1000
+
+    def __init__(self, home_dir, key, resume=False):
+        """
+        Open the journal for key (a list describing the transfer), in
+        home_dir's .dhop.transfers. If resume is True, the records of earlier,
+        interrupted runs are read back.
+        Otherwise they're ignored, but kept, in case this run is interrupted
+        before it gets as far.
+        """
+        import hashlib
+        import json
+        import threading
+
+        self.journal_dir = os.path.join(home_dir, Dhop.DHOP_TRANSFERS)
+        name = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        self.path = os.path.join(self.journal_dir, name[:16])
+
+        self.lock = threading.Lock()
+        self.done = {}
+        self.parts = {}
+        self.committed = set()
+        self.moved = set()
+        self.resumed = False
+
+        if resume and os.path.exists(self.path):
+            self.resumed = True
+            journal_file = open(self.path, 'r')
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a partly-written last line (from a crash) is skipped.
+                    continue
+                if record[0] == 'done':
+                    self.done[record[1]] = tuple(record[2:])
+                    self.parts.pop(record[1], None)
+                elif record[0] == 'part':
+                    self.parts[record[1]] = tuple(record[2:])
+                elif record[0] == 'committed':
+                    self.committed.add(record[1])
+                elif record[0] == 'moved':
+                    self.moved.add(record[1])
+            journal_file.close()
+
+        # the journal file, once it's opened, and the records that haven't
+        # been written to it yet.
+        self.journal_file = None
+        self.unwritten = []
+
+    def __open__(self):
+        """
+        Open the journal file, and write out the records kept so far. The
+        caller should hold the lock.
+        """
+        if not os.path.isdir(self.journal_dir):
+            os.mkdir(self.journal_dir, 0o700)
+        # line buffered, so that every record is flushed as it's written.
+        self.journal_file = open(self.path, 'a', buffering=1)
+        self.journal_file.write(''.join(self.unwritten))
+        self.unwritten = []
+
+    def record(self, *record):
+        """
+        Add a record to the journal.
+        """
+        import json
+
+        line = json.dumps(list(record)) + '\n'
+        with self.lock:
+            if self.journal_file is not None:
+                self.journal_file.write(line)
+                return
+            self.unwritten.append(line)
+            # the offsets of large files are worth keeping straight away.
+            if (record[0] == 'part' or
+                    len(self.unwritten) >= TransferJournal.MIN_RECORDS):
+                self.__open__()
+
+    def is_done(self, source_path, target_path):
+        """
+        Return True if source_path has already been copied to target_path
+        (and hasn't changed since).
+        """
+        done = self.done.get(target_path)
+        if done is None:
+            return False
+        try:
+            source_stat = os.stat(source_path)
+        except OSError:
+            return False
+        return done == (source_stat.st_size, source_stat.st_mtime_ns)
+
+    def offset(self, target_path, size, mtime):
+        """
+        Return how much of a file has already been copied to target_path (0 if
+        none of it has, or if the source has changed since).
+        """
+        part = self.parts.get(target_path)
+        if part is None or part[1:] != (size, mtime):
+            return 0
+        return part[0]
+
+    def close(self, remove=False):
+        """
+        Close the journal, and remove it if remove is True. Otherwise, any
+        records that were only kept in memory are written out first, so the
+        transfer can be resumed.
+        """
+        with self.lock:
+            if (not remove and self.journal_file is None and
+                    len(self.unwritten) != 0):
+                self.__open__()
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Transfer:
+    """
+    Copies files and directory trees, for 'dhop cp'.
+
+    Directory trees are walked (with os.scandir) and their directories created
+    on the calling thread, while the files themselves are copied by a pool of
+    worker threads. Copying lots of small files is mostly a matter of waiting
+    on the filesystem, especially on network storage, so having several copies
+    underway at once is much faster than copying one file at a time.
+
+    Only a limited number of copies are queued at a time, so memory use stays
+    the same no matter how big the tree is, and errors are reported in the
+    order that the files were found, whichever copy finishes first. Call
+    finish() once everything has been copied.
+
+    Each file's data is copied in the fastest way that the filesystems allow
+    (see STRATEGIES), without passing it through Python where possible.
+
+    If it's given a journal (a TransferJournal), each file that's copied is
+    recorded in it, and files larger than CHECKPOINT_SIZE are copied in
+    pieces of that size, each one recorded as it's done. When resuming,
+    files that the journal says were copied are skipped, and a large file
+    that was part-way through picks up from its last recorded piece. Target
+    directories can already exist when resuming.
+
+    In link mode, files are hard-linked rather than copied (only the
+    directories are created), which takes no extra space, and no time to
+    speak of. Files on a different filesystem from the target are copied.
+
+    In sync mode, the target can already exist, and files that are already
+    there with the same size and modification time (or, with checksum, the
+    same contents) are left alone, so copying the same tree again only
+    copies what has changed. With delete, anything in the target directories
+    that isn't in the source is removed.
+
+    With symlinks (as for 'dhop mv'), symbolic links are copied as links, as
+    shutil.copytree's symlinks option does, rather than as the files or
+    directories that they point to. A link that points back up the tree is
+    then just a link, rather than a tree that never ends.
+    """
+    DEFAULT_JOBS = 8
+    CHECKPOINT_SIZE = 64 * 1024 * 1024
+
+    # the ways of copying a file's data, fastest first:
+    #
+    # * reflink: the copy shares the original's blocks until either one
+    #   changes (the FICLONE ioctl; btrfs, XFS and others, on Linux).
+    # * copy_file_range: the kernel copies the data, or has the filesystem (or
+    #   file server) do it.
+    # * sendfile: the kernel copies the data.
+    # * read/write: the data is copied through a buffer.
+    #
+    # Once a way fails for a pair of filesystems, it isn't tried again for
+    # them.
+    STRATEGIES = ['reflink', 'copy_file_range', 'sendfile', 'read/write']
+
+    # from <linux/fs.h>
+    FICLONE = 0x40049409
+
+    # the errors that mean "this way of copying doesn't work here".
+    UNSUPPORTED_ERRORS = ['EBADF', 'EINVAL', 'ENOSYS', 'ENOTSOCK', 'ENOTSUP',
+                          'ENOTTY', 'EOPNOTSUPP', 'EPERM', 'EXDEV']
+
+    def __init__(self, jobs=DEFAULT_JOBS, verbose=False, sync=False,
+                 checksum=False, delete=False, journal=None, link=False,
+                 symlinks=False):
+        """
+        Initialize the transfer, with jobs worker threads. If verbose is True,
+        each file is listed (along with the way it was copied) as it's done.
+        sync, checksum and delete turn on sync mode, link turns on link mode,
+        journal is the TransferJournal to record progress in, and symlinks
+        keeps symbolic links as links (see above).
+        """
+        import collections
+
+        self.jobs = jobs
+        self.verbose = verbose
+        self.link = link
+        self.sync = sync
+        self.checksum = checksum
+        self.delete = delete
+        self.journal = journal
+        self.symlinks = symlinks
+        self.pool = None
+        self.errors = 0
+        self.deleted = 0
+
+        # set to make the workers give up on large files between pieces.
+        self.stopping = False
+
+        # how many files were copied with each strategy (or were unchanged,
+        # or had already been copied before resuming).
+        self.counts = dict((strategy, 0) for strategy in Transfer.STRATEGIES)
+        self.counts['unchanged'] = 0
+        self.counts['resumed'] = 0
+        self.counts['hardlink'] = 0
+        self.counts['symlink'] = 0
+
+        # the strategies that don't work, for each (source device, target
+        # device) pair.
+        self.unsupported = {}
+
+        # copies (futures, with their paths) and errors, in the order they were
+        # found.
+        self.pending = collections.deque()
+
+        # the directories that were created (or synced), to copy their
+        # permissions and times once their contents have been copied.
+        self.created_dirs = []
+
+    def copy(self, source_path, target_path):
+        """
+        Copy a file, or a directory tree, to target_path.
+        """
+        if self.symlinks and os.path.islink(source_path):
+            self.__submit__(source_path, target_path)
+        elif os.path.isdir(source_path):
+            self.__copy_tree__(source_path, target_path)
+        elif os.path.isfile(source_path):
+            self.__submit__(source_path, target_path)
+        else:
+            self.__error__("The source location is neither a file nor a "
+                           "directory: %s" % source_path)
+
+    def __copy_tree__(self, source_dir, target_dir):
+        """
+        Create the directories in a tree, and queue up its files to be copied.
+        Like shutil.copytree, the target directory must not exist yet (unless
+        syncing).
+        """
+        dirs = [(source_dir, target_dir)]
+
+        while len(dirs) != 0:
+            (source_dir, target_dir) = dirs.pop()
+
+            resuming = self.journal is not None and self.journal.resumed
+            try:
+                if not ((self.sync or self.link or resuming) and
+                        os.path.isdir(target_dir)):
+                    os.mkdir(target_dir)
+                entries = list(os.scandir(source_dir))
+            except OSError as e:
+                self.__error__("Can't copy %s: %s" % (source_dir, e))
+                continue
+
+            self.created_dirs.append((source_dir, target_dir))
+
+            if self.delete:
+                self.__delete_extra__(target_dir,
+                                      set([entry.name for entry in entries]))
+
+            subdirs = []
+            entries.sort(key=lambda entry: entry.name)
+            for entry in entries:
+                target_path = os.path.join(target_dir, entry.name)
+                if entry.is_dir(follow_symlinks=not self.symlinks):
+                    subdirs.append((entry.path, target_path))
+                else:
+                    self.__submit__(entry.path, target_path)
+
+            # visit the subdirectories in name order (they come off the end of
+            # the list).
+            dirs.extend(reversed(subdirs))
+
+    def __delete_extra__(self, target_dir, names):
+        """
+        Remove everything in target_dir that isn't in names.
+        """
+        import shutil
+
+        try:
+            entries = list(os.scandir(target_dir))
+        except OSError as e:
+            self.__error__("Can't read %s: %s" % (target_dir, e))
+            return
+
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.name in names:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+            except OSError as e:
+                self.__error__("Can't delete %s: %s" % (entry.path, e))
+                continue
+            self.deleted += 1
+            if self.verbose:
+                print("deleted: %s" % entry.path)
+
+    def __submit__(self, source_path, target_path):
+        """
+        Queue a file to be copied by the worker threads.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.jobs)
+
+        if self.symlinks and os.path.islink(source_path):
+            work = self.__copy_link__
+        elif (self.journal is not None and
+                self.journal.is_done(source_path, target_path)):
+            self.counts['resumed'] += 1
+            return
+        elif self.link:
+            work = self.__link_file__
+        elif self.sync:
+            work = self.__sync_file__
+        else:
+            work = self.__copy_file__
+        future = self.pool.submit(work, source_path, target_path)
+        self.pending.append((future, source_path, target_path))
+        self.__drain__(self.jobs * 4)
+
+    def __copy_file__(self, source_path, target_path):
+        """
+        Copy one file, along with its permissions and times (on a worker
+        thread). Returns (strategy, None) or (None, error message).
+        """
+        import shutil
+
+        try:
+            # opening the target would empty the source, if they're the same.
+            if (os.path.exists(target_path) and
+                    os.path.samefile(source_path, target_path)):
+                return (None, "%s and %s are the same file" %
+                        (source_path, target_path))
+
+            source_file = open(source_path, 'rb')
+            try:
+                source_stat = os.fstat(source_file.fileno())
+                large = (self.journal is not None and
+                         source_stat.st_size > Transfer.CHECKPOINT_SIZE)
+
+                # carry on from where an interrupted copy got to.
+                offset = 0
+                if large and os.path.exists(target_path):
+                    offset = self.journal.offset(target_path,
+                                                 source_stat.st_size,
+                                                 source_stat.st_mtime_ns)
+                    if offset > os.path.getsize(target_path):
+                        offset = 0
+                if offset != 0:
+                    target_file = open(target_path, 'r+b')
+                    target_file.truncate(offset)
+                else:
+                    target_file = open(target_path, 'wb')
+
+                try:
+                    if large:
+                        strategy = self.__copy_large__(
+                            source_file.fileno(), target_file.fileno(),
+                            offset, target_path)
+                    else:
+                        strategy = self.__copy_data__(source_file.fileno(),
+                                                      target_file.fileno())
+                    copied_size = os.fstat(target_file.fileno()).st_size
+                finally:
+                    target_file.close()
+            finally:
+                source_file.close()
+
+            if strategy is None:
+                return (None, "Stopped copying %s" % source_path)
+            # a copy that came up short isn't finished, whatever the
+            # strategy said.
+            if copied_size != source_stat.st_size:
+                return (None, "Can't copy %s: it changed size while it was "
+                        "being copied" % source_path)
+
+            shutil.copystat(source_path, target_path)
+        except (OSError, shutil.Error) as e:
+            return (None, "Can't copy %s: %s" % (source_path, e))
+
+        if self.journal is not None:
+            self.journal.record('done', target_path, source_stat.st_size,
+                                source_stat.st_mtime_ns)
+        return (strategy, None)
+
+    def __copy_large__(self, source_fd, target_fd, offset, target_path):
+        """
+        Copy a large file from offset onwards, CHECKPOINT_SIZE bytes at a
+        time, recording each piece in the journal once it's safely written.
+        Returns the strategy used, or None if the transfer is stopping.
+        """
+        import errno
+
+        source_stat = os.fstat(source_fd)
+        size = source_stat.st_size
+        key = (source_stat.st_dev, os.fstat(target_fd).st_dev)
+        unsupported = self.unsupported.setdefault(key, set())
+
+        # a reflink is made all at once, so there's nothing to checkpoint.
+        if offset == 0 and 'reflink' not in unsupported:
+            try:
+                if self.__copy_with__('reflink', source_fd, target_fd):
+                    return 'reflink'
+            except OSError as e:
+                if (errno.errorcode.get(e.errno) not in
+                        Transfer.UNSUPPORTED_ERRORS):
+                    raise
+            unsupported.add('reflink')
+
+        if ('copy_file_range' in unsupported or
+                not hasattr(os, 'copy_file_range')):
+            strategy = 'read/write'
+        else:
+            strategy = 'copy_file_range'
+
+        while offset < size:
+            if self.stopping:
+                return None
+
+            end = min(offset + Transfer.CHECKPOINT_SIZE, size)
+            while offset < end:
+                if strategy == 'copy_file_range':
+                    try:
+                        copied = os.copy_file_range(source_fd, target_fd,
+                                                    end - offset, offset,
+                                                    offset)
+                    except OSError as e:
+                        if (errno.errorcode.get(e.errno) not in
+                                Transfer.UNSUPPORTED_ERRORS):
+                            raise
+                        unsupported.add(strategy)
+                        strategy = 'read/write'
+                        continue
+                    if copied == 0:
+                        # some filesystems give up part way (procfs, some
+                        # FUSE and network mounts); read the rest instead.
+                        strategy = 'read/write'
+                        continue
+                else:
+                    data = os.pread(source_fd, min(end - offset, 1 << 20),
+                                    offset)
+                    copied = len(data)
+                    while len(data) != 0:
+                        data = data[os.pwrite(target_fd, data,
+                                              offset + copied - len(data)):]
+                if copied == 0:
+                    # the file got shorter while it was being copied; the
+                    # length check in __copy_file__ reports it.
+                    return strategy
+                offset += copied
+
+            # make sure the piece is really written before saying so.
+            os.fsync(target_fd)
+            self.journal.record('part', target_path, offset, size,
+                                source_stat.st_mtime_ns)
+
+        return strategy
+
+    def stop(self):
+        """
+        Stop the transfer after an interruption: queued copies are cancelled,
+        and the ones underway are finished (or, for large files, stopped
+        after their current piece).
+        """
+        self.stopping = True
+        if self.pool is not None:
+            # (shutdown's cancel_futures does this, but only from Python 3.9.)
+            for (future, source_path, target_path) in self.pending:
+                future.cancel()
+            self.pool.shutdown()
+            self.pool = None
+
+    def __link_file__(self, source_path, target_path):
+        """
+        Hard-link one file (on a worker thread), or copy it if it's on a
+        different filesystem. A target that's already a link to the source
+        is left alone. Returns the same as __copy_file__.
+        """
+        import errno
+
+        try:
+            os.link(source_path, target_path)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                return self.__copy_file__(source_path, target_path)
+            if (e.errno == errno.EEXIST and
+                    os.path.samefile(source_path, target_path)):
+                return ('unchanged', None)
+            return (None, "Can't link %s: %s" % (source_path, e))
+        return ('hardlink', None)
+
+    def __copy_link__(self, source_path, target_path):
+        """
+        Make a symbolic link at target_path that points where the one at
+        source_path does (on a worker thread). A target that's already the
+        same link (from before resuming) is left alone. Returns the same as
+        __copy_file__.
+        """
+        import shutil
+
+        try:
+            link = os.readlink(source_path)
+            if (os.path.islink(target_path) and
+                    os.readlink(target_path) == link):
+                return ('unchanged', None)
+            os.symlink(link, target_path)
+            shutil.copystat(source_path, target_path, follow_symlinks=False)
+        except OSError as e:
+            return (None, "Can't copy %s: %s" % (source_path, e))
+        return ('symlink', None)
+
+    def __sync_file__(self, source_path, target_path):
+        """
+        Copy one file, unless the target is already the same (on a worker
+        thread). The copy is made beside the target and renamed over it, so
+        the target is never left half-written. Returns the same as
+        __copy_file__, with a strategy of 'unchanged' if the file was left
+        alone.
+        """
+        import stat
+
+        try:
+            source_stat = os.stat(source_path)
+            target_stat = os.stat(target_path)
+        except OSError:
+            return self.__copy_file__(source_path, target_path)
+
+        if not stat.S_ISREG(target_stat.st_mode):
+            return (None, "Can't copy %s: %s is in the way" %
+                    (source_path, target_path))
+
+        if source_stat.st_size == target_stat.st_size:
+            try:
+                if self.checksum:
+                    same = (self.__file_hash__(source_path) ==
+                            self.__file_hash__(target_path))
+                else:
+                    same = (int(source_stat.st_mtime) ==
+                            int(target_stat.st_mtime))
+            except OSError as e:
+                return (None, "Can't compare %s: %s" % (source_path, e))
+            if same:
+                return ('unchanged', None)
+
+        temp_path = os.path.join(os.path.dirname(target_path),
+                                 '.%s.dhop-tmp' % os.path.basename(target_path))
+        (strategy, error) = self.__copy_file__(source_path, temp_path)
+        try:
+            if error is None:
+                os.replace(temp_path, target_path)
+            elif os.path.exists(temp_path):
+                os.remove(temp_path)
+        except OSError as e:
+            return (None, "Can't copy %s: %s" % (source_path, e))
+        return (strategy, error)
+
+    def __file_hash__(self, path):
+        """
+        Return a hash of a file's contents.
+        """
+        import hashlib
+
+        digest = hashlib.sha256()
+        hash_file = open(path, 'rb')
+        try:
+            while True:
+                data = hash_file.read(1 << 20)
+                if len(data) == 0:
+                    break
+                digest.update(data)
+        finally:
+            hash_file.close()
+        return digest.digest()
+
+    def __copy_data__(self, source_fd, target_fd):
+        """
+        Copy the data from one open file to another (empty) one, trying each
+        of the STRATEGIES in turn. Returns the strategy that worked.
+        """
+        import errno
+
+        key = (os.fstat(source_fd).st_dev, os.fstat(target_fd).st_dev)
+        unsupported = self.unsupported.setdefault(key, set())
+
+        for strategy in Transfer.STRATEGIES:
+            if strategy in unsupported:
+                continue
+
+            try:
+                if self.__copy_with__(strategy, source_fd, target_fd):
+                    return strategy
+            except OSError as e:
+                # anything other than "not supported" is a real error.
+                if (strategy == 'read/write' or
+                        errno.errorcode.get(e.errno) not in
+                        Transfer.UNSUPPORTED_ERRORS):
+                    raise
+
+            # start over with the next strategy.
+            unsupported.add(strategy)
+            os.lseek(source_fd, 0, os.SEEK_SET)
+            os.lseek(target_fd, 0, os.SEEK_SET)
+            os.ftruncate(target_fd, 0)
+
+    def __copy_with__(self, strategy, source_fd, target_fd):
+        """
+        Copy the data from one open file to another using a single strategy.
+        Returns False if the strategy isn't available at all.
+        """
+        if strategy == 'reflink':
+            if not sys.platform.startswith('linux'):
+                return False
+            import fcntl
+            fcntl.ioctl(target_fd, Transfer.FICLONE, source_fd)
+
+        elif strategy == 'copy_file_range':
+            if not hasattr(os, 'copy_file_range'):
+                return False
+            size = os.fstat(source_fd).st_size
+            offset = 0
+            while True:
+                copied = os.copy_file_range(source_fd, target_fd, 1 << 30)
+                if copied == 0:
+                    break
+                offset += copied
+            # some filesystems give up part way (procfs, some FUSE and
+            # network mounts); both files are positioned to read the rest.
+            if offset < size:
+                self.__copy_with__('read/write', source_fd, target_fd)
+
+        elif strategy == 'sendfile':
+            if not hasattr(os, 'sendfile'):
+                return False
+            offset = 0
+            while True:
+                sent = os.sendfile(target_fd, source_fd, offset, 1 << 30)
+                if sent == 0:
+                    break
+                offset += sent
+            if offset < os.fstat(source_fd).st_size:
+                os.lseek(source_fd, offset, os.SEEK_SET)
+                self.__copy_with__('read/write', source_fd, target_fd)
+
+        else:
+            while True:
+                data = os.read(source_fd, 1 << 20)
+                if len(data) == 0:
+                    break
+                while len(data) != 0:
+                    data = data[os.write(target_fd, data):]
+
+        return True
+
+    def __error__(self, message):
+        """
+        Queue an error message, to be reported in order with the copies.
+        """
+        from concurrent.futures import Future
+
+        future = Future()
+        future.set_result((None, message))
+        self.pending.append((future, None, None))
+        self.__drain__(self.jobs * 4)
+
+    def __drain__(self, limit):
+        """
+        Wait for the oldest copies to finish (and report any errors) until no
+        more than limit are left.
+        """
+        while len(self.pending) > limit:
+            (future, source_path, target_path) = self.pending.popleft()
+            (strategy, error) = future.result()
+
+            if error is not None:
+                self.errors += 1
+                __print_error__(error)
+                continue
+
+            self.counts[strategy] += 1
+            if self.verbose and strategy != 'unchanged':
+                print("%s: %s -> %s" % (strategy, source_path, target_path))
+
+    def finish(self):
+        """
+        Wait for all of the copies to finish, then copy the permissions and
+        times of the directories that were created. Returns True if everything
+        was copied.
+        """
+        import shutil
+
+        self.__drain__(0)
+
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+        # deepest first, since setting a directory's contents changes its
+        # times.
+        for (source_dir, target_dir) in reversed(self.created_dirs):
+            try:
+                shutil.copystat(source_dir, target_dir)
+            except OSError as e:
+                self.errors += 1
+                __print_error__("Can't copy the attributes of %s: %s" %
+                                (source_dir, e))
+        self.created_dirs = []
+
+        if self.verbose:
+            used = ["%s: %d" % (strategy, self.counts[strategy])
+                    for strategy in (['hardlink', 'symlink'] +
+                                     Transfer.STRATEGIES)
+                    if self.counts[strategy] != 0]
+            copied = (sum(self.counts.values()) - self.counts['unchanged'] -
+                      self.counts['resumed'])
+            if self.counts['resumed'] != 0:
+                print("%d file(s) had been copied before resuming" %
+                      self.counts['resumed'])
+            if self.sync:
+                print("%d file(s) copied (%s), %d unchanged, %d deleted, "
+                      "%d error(s)" % (copied, ", ".join(used) or "none",
+                                       self.counts['unchanged'], self.deleted,
+                                       self.errors))
+            else:
+                print("%d file(s) copied (%s), %d error(s)" %
+                      (copied, ", ".join(used) or "none", self.errors))
+
+        return self.errors == 0
+
+
+def open_store(home_dir=None, backend=None):
+    """
+    Open the dhop data in home_dir (the user's home directory, by default)
+    with the named store backend ($DHOP_BACKEND, or 'json', by default), and
+    return it. Raises DhopError if the backend isn't known or can't be used.
+    """
+    if home_dir is None:
+        home_dir = os.path.expanduser('~')
+    if backend is None:
+        backend = os.environ.get('DHOP_BACKEND', 'json')
+
+    if backend not in Dhop.BACKENDS:
+        raise DhopError("Unknown store backend: %s" % backend)
+    try:
+        return Dhop.BACKENDS[backend](home_dir)
+    except ImportError as e:
+        raise DhopError("Can't use the %s backend (%s)" % (backend, e))
+
+
+class Resolver:
+    """
+    Resolves names (stored locations, possibly followed by a path under them,
+    or paths) to paths. This is how dhop finds where a hop goes, and it's
+    meant to be used from other Python programs too:
+
+        import dhop
+        resolver = dhop.Resolver()
+        path = resolver.resolve('proj/src')
+
+    Creating a Resolver doesn't read or write anything. The store is opened
+    (with open_store) the first time it's needed, unless one is given, and is
+    kept open, so each resolve after the first takes microseconds. If refresh
+    is True, changes that other dhop processes make to the store are picked
+    up before each resolve.
+
+    Errors are raised rather than printed: NotFoundError (or
+    InvalidLocationError, for a location whose path doesn't exist) and
+    UnreachableError, all of which are DhopErrors.
+
+    Everything else that a hop uses can be given, and is left out if it
+    isn't:
+
+    * exists: a function that says whether a path exists (os.path.exists, by
+      default; a StatCache's exists gives up on unresponsive filesystems).
+    * history: a History, for choosing between locations that start with the
+      same text by how often they're visited.
+    * index_path: where to keep the index of location names between runs.
+      By default, it's only kept in memory.
+    * validity_path: the file where 'dhop watch' says which locations are
+      valid, so that they don't need to be checked.
+    """
+    # the most prefix matches that are ranked by frecency.
+    MAX_RANKED = 200
+
+    # how long (in seconds) the watcher's validity file is trusted before
+    # it's read again.
+    VALIDITY_TTL = 1.0
+
+    def __init__(self, store=None, home_dir=None, exists=None, history=None,
+                 index_path=None, validity_path=None, refresh=True):
+        """
+        Initialize the resolver (see above). home_dir is only used to open
+        the store, if store isn't given.
+        """
+        self.store = store
+        self.home_dir = home_dir
+        self.exists = exists or os.path.exists
+        self.history = history
+        self.index_path = index_path
+        self.validity_path = validity_path
+        self.refresh = refresh
+        self.index = None
+
+        # the watcher's validity (see Watcher.read_validity), and when it was
+        # read.
+        self.validity = None
+        self.validity_read = None
+
+        # the path of the stored location that the last resolved name used,
+        # if any.
+        self.resolved_location = None
+
+    def get_store(self):
+        """
+        Return the store, opening it if it hasn't been opened yet.
+        """
+        if self.store is None:
+            self.store = open_store(self.home_dir)
+        return self.store
+
+    def resolve(self, name):
+        """
+        Return the path that name (a stored location or path) refers to, or
+        raise NotFoundError or UnreachableError if it doesn't refer to
+        anything.
+        """
+        exists = self.exists
+        store = self.get_store()
+        self.resolved_location = None
+
+        # the errors name what was asked for, not just its first part.
+        requested = name
+
+        if self.refresh and store.is_stale():
+            store.load()
+
+        # First, if the name is an absolute path (starts with '/' on
+        # Unix-likes, and something like 'D:\' on Windows), then no processing
+        # needs to be done. Just check to see if its valid.
+        if os.path.isabs(name):
+            if exists(name):
+                return os.path.normpath(name)
+            else:
+                raise NotFoundError(name, ["Path doesn't exist: %s" % name])
+
+        # The path might have directories or a filespec attached. No worries,
+        # just chop off the nose and use that as the part of the path to
+        # dereference.
+        rest_of_the_path = ''
+
+        if name.count(os.sep) != 0:
+            name, rest_of_the_path = name.strip().split(os.sep, 1)
+
+        # The undecorated name *might* refer to a stored location...
+        location = store.get_location(name)
+
+        if location is None:
+            if rest_of_the_path == '':
+                resolved_path = name
+            else:
+                resolved_path = os.sep.join([name, rest_of_the_path])
+            if exists(resolved_path):
+                return os.path.normpath(resolved_path)
+
+            # It's not a path either, but it might be the start of the name of
+            # a stored location (if only one location starts with it, or if
+            # one of them has been visited more than the others).
+            (how, matches) = self.location_index().lookup(
+                name, Resolver.MAX_RANKED)
+            ranked = self.rank(matches)
+            matches = [match for (score, match) in ranked]
+
+            if how == 'prefix' and len(ranked) > 1 and ranked[0][0] > ranked[1][0]:
+                matches = matches[:1]
+
+            if how != 'prefix' or len(matches) != 1:
+                messages = ["Location or path doesn't exist: %s" %
+                            resolved_path]
+                suggestions = matches[:LocationIndex.MAX_MATCHES]
+                if len(suggestions) != 0:
+                    messages.append("Did you mean: %s?" %
+                                    ", ".join(suggestions))
+                raise NotFoundError(requested, messages, suggestions)
+
+            name = matches[0]
+            location = store.get_location(name)
+
+        self.resolved_location = os.path.normpath(location)
+        resolved_path = os.sep.join([location, rest_of_the_path])
+
+        # if 'dhop watch' is keeping an eye on the location, there's no need
+        # to check it.
+        if rest_of_the_path == '' and self.__watched_valid__(location):
+            return resolved_path
+
+        if not exists(resolved_path):
+            raise InvalidLocationError(requested, resolved_path, [
+                "Location %s is set, but does not refer to a valid "
+                "location: %s" % (name, resolved_path)])
+
+        return resolved_path
+
+    def __watched_valid__(self, path):
+        """
+        Return True if a running 'dhop watch' says that the location path is
+        valid. The watcher's file is read at most once every VALIDITY_TTL
+        seconds (with a single open, and no stat), so that asking is cheaper
+        than checking the location.
+        """
+        import time
+
+        if self.validity_path is None:
+            return False
+
+        now = time.time()
+        if (self.validity_read is None or
+                not 0 <= now - self.validity_read < Resolver.VALIDITY_TTL):
+            self.validity = Watcher.read_validity(self.validity_path)
+            self.validity_read = now
+        if self.validity is None:
+            return False
+        return Watcher.is_valid(self.validity, path, self.store.version())
+
+    def rank(self, names, locations=None):
+        """
+        Return a list of (score, name) for the given location names, ordered
+        from the most to the least frecent (see History). Names with the same
+        score keep their order, as do all of them if there's no history.
+
+        If locations (a dict of names and paths) is given, it's used instead of
+        looking up each name in the store.
+        """
+        if self.history is None:
+            return [(0.0, name) for name in names]
 
-    # put the lines together, removing the first num_spaces characters from
-    # each line (except for line 0).
-    result_text = ""
+        scores = self.history.scores()
+        ranked = []
 
-    if line_start == 0:
-        result_text = lines[0] + '\n'
-        line_start = 1
+        for name in names:
+            if locations is None:
+                path = self.get_store().get_location(name)
+            else:
+                path = locations[name]
+            if path is not None:
+                path = os.path.normpath(path)
+            ranked.append((scores.get(path, 0.0), name))
 
-    # convert the extra indent number into spaces
-    extra_indent = ' ' * extra_indent
+        # sorted() is stable, so ties keep their order.
+        return sorted(ranked, key=lambda item: -item[0])
 
-    # add each line to the result.
-    for cur_line in lines[line_start:line_end]:
-        result_text += "%s%s\n" % (extra_indent, cur_line[indent:])
+    def location_index(self):
+        """
+        Return the index of location names, loading it from index_path (or,
+        if the locations have changed since it was saved, rebuilding it).
+        """
+        store = self.get_store()
+        stamp = store.version()
 
-    return result_text
+        if self.index is not None and self.index.stamp == stamp:
+            return self.index
+
+        index = None
+        if self.index_path is not None:
+            index = LocationIndex.load(self.index_path)
+        if index is None or index.stamp != stamp:
+            index = LocationIndex(store.names(), stamp)
+            if self.index_path is not None:
+                index.save(self.index_path)
+
+        self.index = index
+        return index
 
 
 class Dhop:
@@ -89,12 +4199,28 @@ class Dhop:
     # some default data
     DHOP_CMD_FILE = '.dhopcmd'
     DHOP_STORE = '.dhop.json'
+    DHOP_JOURNAL = '.dhop.journal'
+    DHOP_DB = '.dhop.db'
+    DHOP_INDEX = '.dhop.index'
+    DHOP_HISTORY = '.dhop.history'
+    DHOP_STATS = 'dhop.stats'
+    DHOP_VISITS = 'dhop.visits'
+    DHOP_DIRS = '.dhop.dirs'
+    DHOP_VALID = '.dhop.valid'
+    DHOP_COMPLETIONS = '.dhop.completions'
+    DHOP_TRANSFERS = '.dhop.transfers'
+    DHOP_SHARDS = '.dhop.shards'
+    DHOP_SESSIONS = '.dhop.sessions'
     USER_COMMANDS = {
         'add': 'set_location',
+        'batch': 'batch',
+        'check': 'check',
         'cp': 'cp',
         'delete': 'forget',
+        'find': 'find',
         'forget': 'forget',
         'help': 'show_help',
+        'init': 'init_shell',
         'list': 'show_list',
         'mark': 'mark',
         'mv': 'mv',
@@ -104,8 +4230,10 @@ class Dhop:
         'recall': 'recall',
         'remove': 'forget',
         'resolve': 'path',
+        'serve': 'serve',
         'set': 'set_location',
         'unset': 'forget',
+        'watch': 'watch',
     }
 
     DEFAULT_STORE = {
@@ -114,123 +4242,438 @@ class Dhop:
         'stack': []       # empty list
     }
 
+    # the store backends that can be chosen with $DHOP_BACKEND.
+    BACKENDS = {
+        'json': JsonStore,
+        'sharded': ShardedStore,
+        'sqlite': SqliteStore,
+    }
+
+    # the commands that a running 'dhop serve' will answer. Anything else is
+    # sent back to the shell wrapper, which runs dhop.py itself.
+    SERVED_COMMANDS = ['add', 'path', 'pop', 'push', 'resolve', 'set']
+
+    # the commands that can be run by 'dhop batch'. Commands that go
+    # somewhere, or that ask questions on stdin, aren't included.
+    BATCH_COMMANDS = ['add', 'check', 'cp', 'delete', 'forget', 'list', 'mark',
+                      'mv', 'path', 'remove', 'resolve', 'set', 'unset']
+
     def __init__(self):
         """
         Initialize Dhop.
         """
-        home_dir = os.path.expanduser('~')  # should work on all systems.
+        __trace_begin__('init')
+
+        # set while running 'dhop serve'; 'go' then records where to go in
+        # cd_target instead of telling the shell directly.
+        self.serving = False
+        self.cd_target = None
+
+        # the path of the stored location that the last resolved name used, if
+        # any (see resolve_location_or_path).
+        self.resolved_location = None
+
+        # the visit history.
+        self.history = History(os.path.expanduser('~'), __runtime_dir__())
+
+        # cached checks of whether paths exist (see StatCache).
+        self.stat_cache = StatCache(__runtime_dir__())
+
+        # the command file isn't used if the shell reads the destination from
+        # a file descriptor (see 'dhop init').
+        if not os.environ.get('DHOP_CD_FD'):
+            self.__remove_cmd_file__()
+        self.__load_store__()
+
+        # finds where names lead, keeping the location index on disk and
+        # taking the watcher's word for which locations are valid.
+        home_dir = os.path.expanduser('~')
+        self.resolver = Resolver(
+            self.backend, exists=self.stat_cache.exists, history=self.history,
+            index_path=os.path.join(home_dir, Dhop.DHOP_INDEX),
+            validity_path=os.path.join(home_dir, Dhop.DHOP_VALID),
+            refresh=False)
+        __trace_end__('init')
 
-        # remove the command file if it exists
+
+    def __remove_cmd_file__(self):
+        """
+        Remove the command file (left by a previous 'go') if it exists.
+        """
+        home_dir = os.path.expanduser('~')  # should work on all systems.
         command_file_path = os.path.join(home_dir, self.DHOP_CMD_FILE)
         if os.path.exists(command_file_path):
             os.remove(command_file_path)
 
-        # check to see if a store file exists
-        path_to_store = os.path.join(home_dir, self.DHOP_STORE)
-        if os.path.exists(path_to_store):
-            # load the existing store.
-            store_file = open(os.path.join(home_dir, Dhop.DHOP_STORE), 'r')
-            self.store = json.load(store_file)
-            store_file.close()
-        else:
-            self.store = Dhop.DEFAULT_STORE
+
+    def __load_store__(self):
+        """
+        Load the Dhop data from disk, or start with an empty store if there
+        isn't one yet.
+        """
+        __trace_begin__('load store')
+        home_dir = os.path.expanduser('~')  # should work on all systems.
+        backend_name = os.environ.get('DHOP_BACKEND', 'json')
+
+        if backend_name not in Dhop.BACKENDS:
+            __print_error__("Unknown DHOP_BACKEND: %s (using 'json')" %
+                            backend_name)
+            backend_name = 'json'
+
+        try:
+            self.backend = Dhop.BACKENDS[backend_name](home_dir)
+        except ImportError as e:
+            __print_error__("Can't use the %s backend (%s); using 'json'." %
+                            (backend_name, e))
+            self.backend = JsonStore(home_dir)
+
+        # the stack and mark can be kept per terminal (see SessionStore).
+        self.backend = SessionStore.wrap(self.backend, home_dir)
+        __trace_end__('load store')
 
 
     def __write_store__(self):
         """
-        Write the current Dhop data to disk.
+        Write any changes to the Dhop data to disk.
         """
-        store_file = open(os.path.join(os.path.expanduser('~'), Dhop.DHOP_STORE), 'w')
-        json_str = json.JSONEncoder().encode(self.store)
-        store_file.write(json_str)
-        store_file.close()
+        __trace_begin__('write store')
+        self.backend.commit()
+        __trace_end__('write store')
         return
 
 
-    def __interpret_src_args__(self, src_args):
+    def __interpret_src_args__(self, src_args, dest_path, unresolved):
+        """
+        Generates the resolved src_args, one path at a time. Arguments that
+        can't be resolved are left out (after an error is printed), and added
+        to the unresolved list.
+
+        Any argument can start with a location name, and can be a file-glob
+        (including '**', which matches any number of directories). Globs are
+        expanded lazily, as the paths are used, so a copy can start straight
+        away, and memory use doesn't depend on how many files match. Matches
+        in dest_path (or that are dest_path) are skipped, so that what the
+        copy creates there can't match the glob too. An argument that names
+        a path that exists is used as it is, even if it has glob characters
+        ('[', say) in it.
+        """
+        import glob
+
+        dest_prefix = os.path.join(os.path.realpath(dest_path), '')
+        for src_arg in src_args:
+            if not any(c in src_arg for c in '*?['):
+                src_path = self.resolve_location_or_path(src_arg)
+                if src_path is not None:
+                    yield src_path
+                else:
+                    unresolved.append(src_arg)
+                continue
+
+            pattern = self.__expand_location__(src_arg)
+            if os.path.lexists(pattern):
+                yield pattern
+                continue
+
+            matched = False
+            for src_path in glob.iglob(pattern, recursive=True):
+                matched = True
+                real_path = os.path.join(os.path.realpath(src_path), '')
+                if not real_path.startswith(dest_prefix):
+                    yield src_path
+
+            if not matched:
+                __print_error__("Nothing matches: %s" % src_arg)
+                unresolved.append(src_arg)
+
+    def __expand_location__(self, name):
         """
-        Returns a list of resolved src_args (which may involve expanding a
-        fileglob).
+        Return name with its leading location name (if it has one) replaced by
+        the location's path. Unlike resolve_location_or_path, the result
+        doesn't need to exist, which is what's wanted for a destination.
         """
-        src_paths = list()
+        if os.path.isabs(name):
+            return os.path.normpath(name)
 
-        for x in range(0, len(src_args) - 1):
-            src_paths[x] = self.resolve_location_or_path(src_args[x])
+        (first, sep, rest) = name.partition(os.sep)
+        location = self.backend.get_location(first)
 
-        # In the case where src_args has only one value, it may be an
-        # unexpanded file-glob. If so, resolve it and expand the glob here.
-        if len(src_paths) == 1:
-            src_paths = glob.glob(src_paths)
+        if location is None:
+            return os.path.normpath(name)
 
-        return src_paths
+        return os.path.normpath(os.path.join(location, rest))
 
     def __cp_or_mv__(self, args, op='cp'):
         """
-        Copies (or moves) files given a source and destination path.
+        Copies (or moves) files given a source and destination path. Returns
+        False if anything couldn't be copied (or moved).
         """
+        try:
+            (options, args) = __split_options__(args, {'jobs': True,
+                                                       'verbose': False,
+                                                       'sync': False,
+                                                       'checksum': False,
+                                                       'delete': False,
+                                                       'resume': False,
+                                                       'link': False})
+            jobs = str(options.get('jobs', Transfer.DEFAULT_JOBS))
+            if not jobs.isdigit() or int(jobs) < 1:
+                raise ValueError("--jobs must be a number, 1 or more")
+            jobs = int(jobs)
+            for option in ['link', 'sync']:
+                if op == 'mv' and option in options:
+                    raise ValueError("--%s can only be used with cp" % option)
+            if 'link' in options and 'sync' in options:
+                raise ValueError("--link and --sync can't be used together")
+            for option in ['checksum', 'delete']:
+                if option in options and 'sync' not in options:
+                    raise ValueError("--%s can only be used with --sync" %
+                                     option)
+        except ValueError as e:
+            __print_error__(str(e))
+            self.show_help(op)
+            return False
+
         # there must be (at least) two arguments.
         if len(args) < 2:
             __print_error__("%s requires two arguments!" % op)
             self.show_help(op)
-            return
+            return False
 
         # dest_path: there can be only one! (in last place)
-        dest_path = self.resolve_location_or_path(args[-1])
+        dest_path = self.__expand_location__(args[-1])
         dest_is_dir = os.path.isdir(dest_path)
 
         # source_paths: we are many (nobody else can be last!)
-        source_paths = self.__interpret_src_args__(args[:-1])
-
-        # no globs allowed here!
-        for source_path in source_paths:
-            # if dest_path is a directory, append the filename part of the
-            # source path to the destination path.
-            if dest_is_dir:
-                fname = os.path.basename(source_path)
-                dest_path = os.path.join(dest_path, fname)
-
-            if op == 'mv':
-                # move path -> path. 'move' doesn't care if the source is a
-                # file or dir.
-                shutil.move(source_path, dest_path)
-            elif os.path.isfile(source_path):
-                # if source_path is a file, use 'copy2'
-                shutil.copy2(source_path, dest_path)
-            elif os.path.isdir(source_path):
-                # if source is a dir, then use 'copytree' instead.
-                shutil.copytree(source_path, dest_path)
-            else:
-                __print_error__("The source location is neither a file nor a"
-                                "directory!")
-        return
+        unresolved = []
+        source_paths = self.__interpret_src_args__(args[:-1], dest_path,
+                                                   unresolved)
+
+        # if the destination isn't a directory, there must only be one source.
+        # Check that before starting.
+        if not dest_is_dir:
+            import itertools
+            first_paths = list(itertools.islice(source_paths, 2))
+            if len(first_paths) > 1:
+                __print_error__("To %s more than one file, the destination "
+                                "must be a directory!" % op)
+                return False
+            source_paths = first_paths
+
+        # progress is recorded so that running the same command again with
+        # --resume can carry on where this one stopped.
+        home_dir = os.path.expanduser('~')  # should work on all systems.
+        journal = TransferJournal(home_dir, [op, os.getcwd()] + args,
+                                  resume=('resume' in options))
+        if 'resume' in options and not journal.resumed:
+            print("dhop: nothing to resume; starting from the beginning.")
+
+        transfer = Transfer(jobs, verbose=('verbose' in options),
+                            sync=('sync' in options),
+                            checksum=('checksum' in options),
+                            delete=('delete' in options),
+                            journal=journal, link=('link' in options),
+                            symlinks=(op == 'mv'))
+
+        # moves within a filesystem are just renamed, all together once the
+        # sources have been found. Moves to another filesystem are copied to
+        # a staging name beside the target, then committed once everything
+        # has been copied.
+        renames = []
+        staged = []
+        devices = {}
+        blocked = False
+
+        try:
+            for source_path in source_paths:
+                # if dest_path is a directory, append the filename part of the
+                # source path to the destination path.
+                target_path = dest_path
+                if dest_is_dir:
+                    fname = os.path.basename(os.path.normpath(source_path))
+                    target_path = os.path.join(dest_path, fname)
+
+                if op == 'cp':
+                    transfer.copy(source_path, target_path)
+                    continue
+
+                source_path = os.path.abspath(source_path)
+                if source_path in journal.moved:
+                    continue
+                if source_path in journal.committed:
+                    staged.append((source_path, None, target_path))
+                    continue
+
+                if self.__same_device__(source_path, target_path, devices):
+                    renames.append((source_path, target_path))
+                    continue
+
+                # as with shutil.move (which renames do use), a directory
+                # that's in the way gets the source put inside it.
+                if os.path.isdir(target_path):
+                    target_path = os.path.join(target_path,
+                                               os.path.basename(source_path))
+                    if os.path.lexists(target_path):
+                        __print_error__("Can't move %s: %s already exists" %
+                                        (source_path, target_path))
+                        blocked = True
+                        continue
+
+                staging_path = os.path.join(
+                    os.path.dirname(target_path),
+                    '.%s.dhop-partial' % os.path.basename(target_path))
+                if not journal.resumed and os.path.lexists(staging_path):
+                    self.__remove_path__(staging_path)
+                transfer.copy(source_path, staging_path)
+                staged.append((source_path, staging_path, target_path))
+
+            renamed = self.__rename_all__(renames)
+            finished = (transfer.finish() and renamed and not blocked and
+                        len(unresolved) == 0)
+        except KeyboardInterrupt:
+            transfer.stop()
+            journal.close()
+            __print_error__("Interrupted. Run the same command with --resume "
+                            "to carry on from here.")
+            return False
+
+        if finished:
+            finished = self.__commit_moves__(staged, journal)
+
+        if not finished:
+            __print_error__("Not everything could be %s; run the same command "
+                            "with --resume to try the rest again." %
+                            ('moved' if op == 'mv' else 'copied'))
+        journal.close(remove=finished)
+        return finished
+
+    def __same_device__(self, source_path, target_path, devices):
+        """
+        Return True if source_path and the directory that target_path would
+        be in are on the same filesystem (or if that can't be told). devices
+        caches the device of each target directory.
+        """
+        try:
+            target_dir = os.path.dirname(os.path.abspath(target_path))
+            if target_dir not in devices:
+                devices[target_dir] = os.stat(target_dir).st_dev
+            return os.lstat(source_path).st_dev == devices[target_dir]
+        except OSError:
+            return True
+
+    def __rename_all__(self, renames):
+        """
+        Move each (source, target) pair with shutil.move, which renames them
+        (they're on the same filesystem), but puts a source inside a target
+        that's a directory, and replaces a target file on Windows, too.
+        Returns True if they all were moved.
+        """
+        import shutil
+
+        renamed = True
+        for (source_path, target_path) in renames:
+            try:
+                shutil.move(source_path, target_path)
+            except (OSError, shutil.Error) as e:
+                __print_error__("Can't move %s: %s" % (source_path, e))
+                renamed = False
+        return renamed
+
+    def __remove_path__(self, path):
+        """
+        Remove a file or a directory tree.
+        """
+        import shutil
+
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def __commit_moves__(self, staged, journal):
+        """
+        Finish moving the staged (source, staging path, target) moves, once
+        everything has been copied: each staging path is renamed to its
+        target (which can't be seen half-done), and then the source is
+        removed. A staging path of None means that it was renamed before an
+        interruption. Returns True if every move was committed.
+        """
+        committed = True
+        for (source_path, staging_path, target_path) in staged:
+            try:
+                if staging_path is not None:
+                    os.replace(staging_path, target_path)
+                    journal.record('committed', source_path)
+                if os.path.lexists(source_path):
+                    self.__remove_path__(source_path)
+                journal.record('moved', source_path)
+            except OSError as e:
+                __print_error__("Can't move %s: %s" % (source_path, e))
+                committed = False
+        return committed
 
     def cp(self, args):
         """
         Copy files from one location/path to another
 
-        Usage: dhop cp <source_path> <dest_path>
+        Usage: dhop cp [--jobs N] [--verbose] [--sync [--checksum] [--delete]]
+                       [--link] [--resume] <source_path> ... <dest_path>
 
         Either source_path or dest_path can begin with a named location.
 
         If source_path is a directory, then the operation will copy the entire
         directory structure recursively, beginning at that location.
 
+        Files are copied N at a time (8, by default), which is much faster
+        than one at a time when copying lots of small files, especially to or
+        from network storage. Use '--jobs 1' to copy one file at a time.
+
+        Where the filesystems allow it, files are copied without their data
+        passing through dhop at all: as reflinks (which share the original's
+        data until it changes, on btrfs, XFS and others), or by the kernel,
+        with copy_file_range or sendfile. With '--verbose', each file is
+        listed along with the way it was copied.
+
         File-globs (wildcards) can be used in source_path to specify multiple
         files/directories that match a pattern. In this case, all files or
         directories that match the pattern will be copied. If any directories
         match the pattern, the entire directory will be copied, recursively.
 
+        Quote a file-glob to have dhop expand it rather than the shell (which
+        is needed for globs that start with a named location). dhop copies
+        each match as it's found (leaving out anything already in dest_path),
+        and also understands '**', which matches any number of directories:
+
+            dhop cp 'build/**/*.so' artifacts
+
         In the case where source_path refers to a single file or directory, you
         can specify a different name for the file/directory in dest_path to
         rename the file during the copy. Specifying a filename in dest_path
-        when source_path contains a file-glob will result in an error."""
+        when source_path contains a file-glob will result in an error.
+
+        With '--sync', the copy can go over an earlier one: files that are
+        already there with the same size and modification time are skipped,
+        so only new and changed files are copied. Add '--checksum' to compare
+        the contents of files of the same size instead of their times, and
+        '--delete' to remove anything in the copy that's no longer in the
+        source.
+
+        If a copy is interrupted (or some files can't be copied), run the
+        same command again from the same directory, adding '--resume', to
+        carry on from where it stopped. Files that were copied are skipped,
+        and large files pick up from the last 64 MiB piece that was copied.
+
+        With '--link', files are hard-linked instead of copied, and only the
+        directories are created, so a snapshot of a large tree takes seconds
+        and no extra space (a file that's changed in place changes in both,
+        though). Files on another filesystem are copied as usual."""
         return self.__cp_or_mv__(args)
 
     def mv(self, args):
         """
         Move files from one location/path to another
 
-        Usage: dhop mv <source_path> <dest_path>
+        Usage: dhop mv [--jobs N] [--verbose] [--resume] <source_path> ...
+                       <dest_path>
 
         Either source_path or dest_path can begin with a named location.
 
@@ -245,7 +4688,16 @@ class Dhop:
         In the case where source_path refers to a single file or directory, you
         can specify a different name for the file/directory in dest_path to
         rename the file during the copy. Specifying a filename in dest_path
-        when source_path contains a file-glob will result in an error."""
+        when source_path contains a file-glob will result in an error.
+
+        Within a filesystem, each source is simply renamed, however large a
+        tree it is. Moving to another filesystem copies everything (like
+        'dhop cp', but with symbolic links kept as links) to a hidden name
+        beside the destination first. Only once
+        all of it has been copied is it renamed into place and the source
+        removed, so an interrupted move never leaves a partial copy at the
+        destination. Run the same command again with '--resume' to carry on
+        with it."""
         return self.__cp_or_mv__(args, op='mv')
 
     def set_location(self, args):
@@ -267,7 +4719,7 @@ class Dhop:
         if len(args) == 0:
             __print_error__("You must specify at least one argument for set.")
             self.show_help('set')
-            return
+            return False
 
         name = args[0]
         pathname = ""
@@ -281,8 +4733,9 @@ class Dhop:
             name = args[0]
             pathname = self.resolve_location_or_path(" ".join(args[1:]))
 
-        if pathname is not None:
-            self.store['locations'][name] = pathname
+        if pathname is None:
+            return False
+        self.backend.set_location(name, pathname)
 
 
     def forget(self, args):
@@ -293,13 +4746,61 @@ class Dhop:
         """
         if len(args) == 0 or len(args[0]) == 0:
             __print_error__("Can't forget nothing!")
-            self.help(['forget'])
-            return
+            self.show_help('forget')
+            return False
 
-        name = args[0]
+        self.backend.forget(args[0])
+
+
+    def init_shell(self, args):
+        """
+        Print a 'dhop' shell function to load from your shell's startup file.
+
+        Usage: dhop init <bash|zsh|fish>
+
+        The function runs dhop and then changes to the directory that dhop
+        sends back on a separate file descriptor, so no command file is
+        written (and no wrapper script is sourced) when you hop. The bash and
+        zsh versions also use 'dhop serve' if it's running, and come with tab
+        completion of commands, location names and the directories beneath
+        them ('name/sub/dir'). Completion reads a list of the names that dhop
+        keeps up to date (~/.dhop.completions), so pressing tab never has to
+        start Python.
+
+        To use it, add one of these lines to your shell's startup file:
+
+            eval "$(python3 ~/bin/dhop.py init bash)"     # ~/.bashrc
+            eval "$(python3 ~/bin/dhop.py init zsh)"      # ~/.zshrc
+            python3 ~/bin/dhop.py init fish | source      # config.fish
+
+        This replaces the 'alias dhop="source ~/bin/dhop.sh"' line.
+        """
+        import shlex
 
-        if name in self.store['locations']:
-            del(self.store['locations'][name])
+        if len(args) != 1 or args[0] not in ['bash', 'fish', 'zsh']:
+            __print_error__("You must specify a shell: bash, zsh or fish.")
+            self.show_help('init')
+            return False
+
+        if args[0] == 'fish':
+            script = FISH_INIT_SCRIPT
+        elif args[0] == 'bash':
+            script = SH_INIT_SCRIPT + BASH_COMPLETION_SCRIPT
+        else:
+            script = SH_INIT_SCRIPT + ZSH_COMPLETION_SCRIPT
+
+        # (re)write the completion file, in case it's missing, or this
+        # version of dhop has different commands.
+        if args[0] != 'fish':
+            __write_completions__(os.path.expanduser('~'),
+                                  self.backend.dump()['locations'])
+
+        python = sys.executable or 'python3'
+        script = script.replace('@PYTHON@', shlex.quote(python))
+        dhop_dir = os.path.dirname(os.path.abspath(__file__))
+        script = script.replace('@DHOPDIR@', shlex.quote(dhop_dir))
+        sys.stdout.write(script)
+        return
 
 
     def mark(self, args):
@@ -319,8 +4820,9 @@ class Dhop:
         else:
             path = self.resolve_location_or_path(args[0])
 
-        if path is not None:
-            self.store['mark'] = path
+        if path is None:
+            return False
+        self.backend.set_mark(path)
 
 
     def recall(self, args):
@@ -330,13 +4832,14 @@ class Dhop:
 
         Usage: dhop recall
         """
-        path = self.store['mark']
+        path = self.backend.get_mark()
 
         if path is not None and len(path) != 0:
-            self.go([path])
-        else:
-            __print_error__("Mark is not set! Use 'mark' to set a mark.")
-            self.show_help('mark')
+            return self.go([path])
+
+        __print_error__("Mark is not set! Use 'mark' to set a mark.")
+        self.show_help('mark')
+        return False
 
 
     def path(self, args):
@@ -344,22 +4847,83 @@ class Dhop:
         Print the full path for the named location.
 
         Usage: dhop path [location]
+               dhop path --stdin [--null] [--json]
 
         * If location refers to a named location, its full path will be printed.
         * If location refers to a path, then the full path will be printed.
         * Otherwise, an error will be printed.
+
+        With --stdin, the locations (one per line, or separated by NULs with
+        --null) are read from stdin, and each one's path is printed as soon
+        as it's resolved: one per line (or followed by a NUL, with --null),
+        in the same order. A location that can't be resolved gets an empty
+        line, and its error goes to stderr. With --json, each result is
+        printed as a JSON object on its own line, with the "name" and either
+        its "path" or an "error".
         """
-        if len(args) != 1:
+        try:
+            (options, args) = __split_options__(
+                args, {'stdin': False, 'null': False, 'json': False})
+        except ValueError as e:
+            __print_error__(e)
+            self.show_help('path')
+            return False
+
+        if 'stdin' in options and len(args) == 0:
+            self.__resolve_stream__(sys.stdin, sys.stdout,
+                                    'null' in options, 'json' in options)
+            return
+
+        if len(args) != 1 or len(options) != 0:
             __print_error__("You must supply one argument to resolve!")
             self.show_help('resolve')
-            return
+            return False
 
         pathname = self.resolve_location_or_path(args[0])
 
-        if pathname != None and len(pathname) != 0:
+        if pathname is None:
+            return False
+        if len(pathname) != 0:
             print(pathname)
 
 
+    def __resolve_stream__(self, in_file, out_file, null=False,
+                           as_json=False):
+        """
+        Resolve each of the names read from in_file, writing the results to
+        out_file (see 'dhop help path').
+        """
+        import json
+
+        separator = '\0' if null else '\n'
+
+        for name in __read_records__(in_file, separator):
+            if not null:
+                name = name.rstrip('\r')
+            try:
+                if len(name) == 0:
+                    raise LookupError("No location given")
+                path = self.__resolve__(name)
+                error = None
+            except LookupError as e:
+                path = None
+                error = '; '.join(e.args)
+                if len(name) != 0:
+                    sys.stderr.write("!! dhop error: %s\n" % error)
+
+            if as_json:
+                result = {'name': name}
+                if path is None:
+                    result['error'] = error
+                else:
+                    result['path'] = path
+                out_file.write(json.dumps(result) + '\n')
+            else:
+                out_file.write((path or '') + separator)
+            # whatever's reading the results may be waiting for this one.
+            out_file.flush()
+
+
     def push(self, args):
         """
         Push the current working directory onto the directory stack, then go
@@ -378,9 +4942,10 @@ class Dhop:
         else:
             path = self.resolve_location_or_path(args)
 
-        if path is not None:
-            self.store['stack'].append(old_path)
-            self.go([path])
+        if path is None:
+            return False
+        self.backend.push(old_path)
+        return self.go([path])
 
 
     def pop(self, args):
@@ -396,35 +4961,540 @@ class Dhop:
         pushed locations from the stack, then transports you to the final
         location popped from the stack.
         """
-        path = ""
+        if len(args) == 1 and args[0] == 'all':
+            path = self.backend.pop(None)
+        else:
+            path = self.backend.pop()
 
-        # first, check to see if we have anything to pop! If not, return an
-        # error.
-        if len(self.store['stack']) == 0:
+        # if there was nothing to pop, return an error.
+        if path is None:
             __print_error__("Empty stack; can't pop!")
+            return False
+
+        if len(path) == 0:
+            __print_error__("Weird... no path returned!")
+            return False
+
+        return self.go([path])
+
+    def serve(self, args):
+        """
+        Run dhop as a resident process that answers hops over a socket.
+
+        Usage: dhop serve
+
+        While 'dhop serve' is running, the dhop shell wrapper sends plain hops
+        and the 'path', 'set', 'push' and 'pop' commands to it, so that they
+        don't need to start a new Python interpreter and reload the store each
+        time. Other commands (and every command, if the server isn't running)
+        are run by dhop.py directly, as usual.
+
+        The server listens on $DHOP_SOCKET if it's set, otherwise on dhop.sock
+        in $XDG_RUNTIME_DIR, or on ~/.dhop.sock. Only your user can connect to
+        it. Stop the server with Ctrl-C or by sending it SIGTERM.
+
+        Note: the shell wrapper uses 'socat' to talk to the server. If socat
+        isn't installed, dhop keeps working without the server.
+        """
+        import signal
+        import socket
+
+        sock_path = __socket_path__()
+
+        # if there's a socket file already, see if something is listening on
+        # it. If not, it was left behind by a server that didn't shut down
+        # cleanly.
+        if os.path.exists(sock_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(sock_path)
+                __print_error__("dhop is already serving on %s" % sock_path)
+                return False
+            except socket.error:
+                os.remove(sock_path)
+            finally:
+                probe.close()
+
+        # create the socket so that only the current user can use it.
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(sock_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+
+        # treat SIGTERM just like Ctrl-C, so the socket gets cleaned up.
+        def on_sigterm(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+        print("dhop: serving on %s" % sock_path)
+        sys.stdout.flush()
+
+        # if tracing, each request is traced on its own from here on.
+        tracing = trace is not None
+        __finish_trace__()
+
+        try:
+            while True:
+                conn, _ = server.accept()
+                try:
+                    if tracing:
+                        __start_trace__(forced=True, served=True)
+                    self.__serve_request__(conn)
+                except Exception as e:
+                    # one bad request shouldn't take down the server.
+                    __print_error__("serve: %s" % e)
+                finally:
+                    conn.close()
+                    __finish_trace__()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            if os.path.exists(sock_path):
+                os.remove(sock_path)
+        return
+
+    def __serve_request__(self, conn):
+        """
+        Answer one request from the shell wrapper.
+
+        A request is a list of NUL-terminated fields: the number of arguments,
+        the client's working directory, and then the arguments themselves. The
+        reply starts with a status line: either 'fallback', which tells the
+        wrapper to run dhop.py itself, or 'ok', followed by a line with the
+        directory to go to (empty if there isn't one) and then the output of
+        the command.
+        """
+        encoding = sys.getfilesystemencoding()
+        conn.settimeout(5)
+
+        data = b''
+        fields = []
+        while True:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+            fields = data.split(b'\0')
+            # the count, cwd and args are each followed by a NUL, so there is
+            # an empty field at the end once the request is complete.
+            if fields[0].isdigit() and len(fields) >= int(fields[0]) + 3:
+                break
+
+        # nothing was sent; this was just a check to see if we're running.
+        if len(data) == 0:
             return
 
-        if len(args) == 1 and args[0] == 'all':
-            while len(self.store['stack']) > 0:
-                path = self.store['stack'].pop()
+        if len(fields) < 3 or not fields[0].isdigit():
+            conn.sendall(b'fallback\n')
+            return
+
+        fields = [f.decode(encoding, 'surrogateescape') for f in fields]
+        cwd = fields[1]
+        args = fields[2:2 + int(fields[0])]
+
+        if (len(args) == 0 or args[0] == '--trace' or
+                (args[0] in Dhop.USER_COMMANDS and
+                 args[0] not in Dhop.SERVED_COMMANDS)):
+            conn.sendall(b'fallback\n')
+            return
+
+        # with per-session stacks, the server can't tell whose stack it is.
+        if (isinstance(self.backend, SessionStore) and
+                args[0] in ('push', 'pop')):
+            conn.sendall(b'fallback\n')
+            return
+
+        # options such as 'path --stdin' read from the wrapper's stdin, which
+        # the server can't see.
+        if args[0] in Dhop.USER_COMMANDS and any(
+                [arg.startswith('--') for arg in args[1:]]):
+            conn.sendall(b'fallback\n')
+            return
+
+        try:
+            os.chdir(cwd)
+        except OSError:
+            conn.sendall(b'fallback\n')
+            return
+
+        # pick up any changes made by dhop.py runs that didn't go through the
+        # server.
+        if self.backend.is_stale():
+            self.backend.load()
+
+        import io
+        output = io.StringIO()
+        saved_stdout = sys.stdout
+        sys.stdout = output
+        self.serving = True
+        self.cd_target = None
+        try:
+            self.run(args)
+        finally:
+            sys.stdout = saved_stdout
+            self.serving = False
+
+        # the second line of the reply is the directory to go to, if any.
+        reply = 'ok\n%s\n%s' % (self.cd_target or '', output.getvalue())
+        conn.sendall(reply.encode(encoding, 'surrogateescape'))
+        return
+
+    def batch(self, args):
+        """
+        Run many dhop commands at once, reading them from a file (or stdin).
+
+        Usage: dhop batch [--null] [--atomic] [file]
+
+        Each line holds one command and its arguments, as they'd be typed
+        after 'dhop' (quote arguments that contain spaces; '#' starts a
+        comment). With --null, commands are separated by NUL characters
+        instead of newlines, so that they can contain newlines. If no file
+        is given, or it's '-', the commands are read from stdin.
+
+        The commands that can be used are: add, check, cp, delete, forget,
+        list, mark, mv, path, remove, resolve, set and unset.
+
+        The dhop data is loaded once and saved once, after the last command,
+        which is much faster than running dhop for each command. (Changes
+        are also saved before each cp or mv, so that other dhop commands
+        aren't kept waiting while the files are copied.) If a command fails,
+        an error naming its line is printed and the rest are still run.
+
+        With --atomic, the first failure stops the batch and none of its
+        changes to the dhop data are saved. Copies and moves can't be undone,
+        so cp and mv can't be used in an atomic batch.
+        """
+        import shlex
+
+        try:
+            (options, args) = __split_options__(args, {'null': False,
+                                                       'atomic': False})
+        except ValueError as e:
+            __print_error__(e)
+            self.show_help('batch')
+            return False
+
+        if len(args) > 1:
+            __print_error__("batch takes at most one file of commands.")
+            self.show_help('batch')
+            return False
+
+        if len(args) == 0 or args[0] == '-':
+            batch_file = sys.stdin
         else:
-            path = self.store['stack'].pop()
+            try:
+                batch_file = open(args[0], 'r')
+            except (IOError, OSError) as e:
+                __print_error__("Can't read %s: %s" % (args[0], e))
+                return False
+
+        separator = '\0' if 'null' in options else '\n'
+        failed_lines = []
+
+        for (line_number, line) in enumerate(
+                __read_records__(batch_file, separator), 1):
+            # commands return False when they fail.
+            try:
+                command = shlex.split(line, comments=True)
+                if len(command) == 0:
+                    continue
+                if command[0] not in Dhop.BATCH_COMMANDS:
+                    raise ValueError("'%s' can't be used in a batch" %
+                                     command[0])
+                if command[0] in ('cp', 'mv'):
+                    if 'atomic' in options:
+                        raise ValueError("'%s' can't be used in an atomic "
+                                         "batch" % command[0])
+                    # don't hold the store (an SQLite write lock, say) while
+                    # the files are copied.
+                    self.backend.commit()
+                self.resolved_location = None
+                succeeded = getattr(self, Dhop.USER_COMMANDS[command[0]])(
+                    command[1:]) is not False
+            except (ValueError, EnvironmentError) as e:
+                __print_error__(e)
+                succeeded = False
+
+            if not succeeded:
+                __print_error__("batch line %d failed: %s" %
+                                (line_number, line.strip()))
+                failed_lines.append(line_number)
+                if 'atomic' in options:
+                    break
+
+        if batch_file is not sys.stdin:
+            batch_file.close()
+
+        if len(failed_lines) != 0 and 'atomic' in options:
+            self.backend.rollback()
+            __print_error__("batch stopped at line %d; nothing was saved." %
+                            failed_lines[0])
+        elif len(failed_lines) != 0:
+            __print_error__("%d batch line(s) failed: %s" %
+                            (len(failed_lines),
+                             ', '.join([str(n) for n in failed_lines])))
+
+        # the changes are saved (once, for the whole batch) by run().
+        return len(failed_lines) == 0
+
+
+    def check(self, args):
+        """
+        Check that the stored locations, the stack and the mark still refer to
+        directories that exist.
 
-        if path is None or len(path) == 0:
-            __print_error__("Weird... no path returned!")
+        Usage: dhop check [--prune] [--jobs N] [--timeout SECONDS]
+
+        The paths are checked N at a time (32 by default), and
+        anything that isn't a directory is listed. A path that takes longer
+        than SECONDS to check (2 by default, or $DHOP_STAT_TIMEOUT) is listed
+        as unreachable, along with everything else on the same filesystem,
+        so a dead network mount doesn't hold things up.
+
+        With --prune, the locations, stack entries and mark that are missing
+        (or aren't directories) are removed. Unreachable ones are kept, since
+        they may well come back.
+        """
+        try:
+            (options, args) = __split_options__(args, {'prune': False,
+                                                       'jobs': True,
+                                                       'timeout': True})
+            jobs = str(options.get('jobs', HealthCheck.DEFAULT_JOBS))
+            if not jobs.isdigit() or int(jobs) < 1:
+                raise ValueError("--jobs must be a number, 1 or more")
+            timeout = float(options.get('timeout', self.stat_cache.timeout))
+            if timeout <= 0:
+                raise ValueError("--timeout must be more than 0")
+        except ValueError as e:
+            __print_error__(str(e))
+            self.show_help('check')
+            return False
+
+        if len(args) != 0:
+            __print_error__("check doesn't take any arguments.")
+            self.show_help('check')
+            return False
+
+        store = self.backend.dump()
+        locations = store['locations']
+        stack = list(store['stack'])
+        mark = store['mark']
+
+        paths = [os.path.normpath(path) for path in locations.values()]
+        paths.extend([os.path.normpath(path) for path in stack])
+        if len(mark) != 0:
+            paths.append(os.path.normpath(mark))
+
+        results = HealthCheck(int(jobs), timeout).run(paths)
+
+        def is_dead(path):
+            return results[os.path.normpath(path)] in ('missing',
+                                                       'not a directory')
+
+        problems = {'Locations': [], 'Stack': [], 'Mark': []}
+        for name in sorted(locations.keys()):
+            result = results[os.path.normpath(locations[name])]
+            if result != 'ok':
+                problems['Locations'].append("%s: %s (%s)" %
+                                             (name, locations[name], result))
+        for (pos, path) in enumerate(reversed(stack), 1):
+            result = results[os.path.normpath(path)]
+            if result != 'ok':
+                problems['Stack'].append("%3d: %s (%s)" % (pos, path, result))
+        if len(mark) != 0 and results[os.path.normpath(mark)] != 'ok':
+            problems['Mark'].append("%s (%s)" %
+                                    (mark, results[os.path.normpath(mark)]))
+
+        for heading in ['Locations', 'Stack', 'Mark']:
+            if len(problems[heading]) == 0:
+                continue
+            print("\n%s" % heading)
+            print('=' * len(heading))
+            for line in problems[heading]:
+                print(line)
+
+        counts = {}
+        for result in results.values():
+            counts[result] = counts.get(result, 0) + 1
+        print("\nChecked %d paths: %s." % (len(results), ", ".join(
+            ["%d %s" % (counts[result], result)
+             for result in sorted(counts.keys())]) or "nothing to check"))
+
+        if 'prune' not in options:
+            return
+
+        dead_names = [name for name in locations if is_dead(locations[name])]
+        for name in dead_names:
+            self.backend.forget(name)
+
+        dead_stack = [path for path in stack if is_dead(path)]
+        self.backend.drop_from_stack(dead_stack)
+
+        dead_mark = len(mark) != 0 and is_dead(mark)
+        if dead_mark:
+            self.backend.set_mark('')
+
+        # the changes are saved (in one go) by run().
+        print("Pruned %d location(s), %d stack entries and %s." %
+              (len(dead_names), len(dead_stack),
+               "the mark" if dead_mark else "no mark"))
+
+
+    def find(self, args):
+        """
+        Find directories by name, beneath the stored locations.
+
+        Usage: dhop find [--refresh] [--paths] [--jobs N] <pattern>
+
+        Lists the directories beneath each location whose names contain
+        pattern (ignoring case), or match it, if it's a shell-style pattern
+        such as 'test*' (quote it, so the shell doesn't expand it). Each one
+        is listed as the location followed by the rest of its path, which can
+        be given straight to dhop to go there. Use --paths to list full paths
+        instead.
+
+        The directories are found in an index (~/.dhop.dirs), so searching is
+        instant. The index is built the first time, and again whenever the
+        locations change; otherwise, once it's an hour old, it's refreshed in
+        the background after searching. Use --refresh to refresh it first.
+        Only the directories that have changed are read again, and the
+        locations are crawled N at a time (8 by default). Hidden directories
+        aren't indexed.
+        """
+        try:
+            (options, args) = __split_options__(args, {'refresh': False,
+                                                       'paths': False,
+                                                       'jobs': True})
+            jobs = str(options.get('jobs', DirectoryIndex.DEFAULT_JOBS))
+            if not jobs.isdigit() or int(jobs) < 1:
+                raise ValueError("--jobs must be a number, 1 or more")
+            jobs = int(jobs)
+        except ValueError as e:
+            __print_error__(str(e))
+            self.show_help('find')
+            return False
+
+        if len(args) != 1 or len(args[0]) == 0:
+            __print_error__("You must give find one pattern to look for.")
+            self.show_help('find')
+            return False
+
+        locations = self.backend.dump()['locations']
+        roots = list(locations.values())
+        timeout = self.stat_cache.timeout
+
+        index = DirectoryIndex(os.path.join(os.path.expanduser('~'),
+                                            Dhop.DHOP_DIRS))
+        refresh = index.needs_refresh(roots)
+        if refresh == 'now' or 'refresh' in options:
+            index.refresh(roots, jobs, timeout)
+            index.save()
+            refresh = None
+
+        # the name of the location at each path (the first, alphabetically,
+        # if there are several).
+        names = {}
+        for name in sorted(locations.keys(), reverse=True):
+            names[os.path.normpath(locations[name])] = name
+
+        results = []
+        for path in index.find(args[0]):
+            if 'paths' in options:
+                results.append(path)
+                continue
+            root = path
+            while root not in names and os.path.dirname(root) != root:
+                root = os.path.dirname(root)
+            if root == path:
+                results.append(names[root])
+            elif root in names:
+                results.append(os.path.join(names[root],
+                                            path[len(root):].lstrip(os.sep)))
+            else:
+                results.append(path)
+
+        for result in sorted(results):
+            print(result)
+
+        if refresh == 'later':
+            def refresh_index():
+                index.refresh(roots, jobs, timeout)
+                index.save()
+            __run_detached__(refresh_index)
+
+
+    def watch(self, args):
+        """
+        Keep the stored locations up to date as their directories are renamed,
+        moved or removed.
+
+        Usage: dhop watch [--prune]
+
+        While 'dhop watch' is running, renaming or moving a location's
+        directory (or any directory that it's in) changes the location to
+        match, and hops to locations that it knows are valid don't need to
+        check them first. Locations whose directories are removed are marked
+        invalid; with --prune, they're forgotten instead.
+
+        This uses Linux inotify. Elsewhere, or once the system's limit on
+        inotify watches is reached, locations are checked every few seconds
+        instead, and can't follow renames. Stop the watcher with Ctrl-C or
+        by sending it SIGTERM.
+        """
+        import signal
+
+        try:
+            (options, args) = __split_options__(args, {'prune': False})
+        except ValueError as e:
+            __print_error__(str(e))
+            self.show_help('watch')
+            return False
+
+        if len(args) != 0:
+            __print_error__("watch doesn't take any arguments.")
+            self.show_help('watch')
+            return False
+
+        watcher = Watcher(self.backend,
+                          os.path.join(os.path.expanduser('~'),
+                                       Dhop.DHOP_VALID),
+                          prune=('prune' in options))
+
+        # treat SIGTERM just like Ctrl-C, so the bitmap gets cleaned up.
+        def on_sigterm(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+        if watcher.fd is None:
+            print("dhop: watching %d locations (polling)" %
+                  len(watcher.paths))
         else:
-            self.go([path])
+            print("dhop: watching %d locations" % len(watcher.paths))
+        sys.stdout.flush()
+
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
 
-        return
 
     def show_list(self, args):
         """
         List all of the currently known locations.
 
         Usage: dhop list
+
+        Locations are listed with the ones you've visited most (and most
+        recently) first.
         """
-        for key in sorted(self.store.keys()):
-            data = self.store[key]
+        store = self.backend.dump()
+
+        for key in sorted(store.keys()):
+            data = store[key]
 
             # if there's no data for the section, skip ahead to the next
             # section.
@@ -437,7 +5507,14 @@ class Dhop:
 
             # the output depends on the type of data
             if type(data) is dict:
-                for data_key in sorted(data.keys()):
+                data_keys = sorted(data.keys())
+
+                # list the locations that are used the most first.
+                if key == 'locations':
+                    data_keys = [name for (score, name) in
+                                 self.resolver.rank(data_keys, data)]
+
+                for data_key in data_keys:
                     print("%s: %s" % (data_key, data[data_key]))
             elif type(data) is set or type(data) is list:
                 pos = 1
@@ -595,7 +5672,12 @@ class Dhop:
             __print_error__("You must specify one, and *only* one location to"
                             "go to!")
 
+        # a hop has already resolved the name (to the absolute path that's
+        # passed here), so keep the location that it went through.
+        location = self.resolved_location
         path = self.resolve_location_or_path(args)
+        if self.resolved_location is not None:
+            location = self.resolved_location
 
         if path is None:
             __print_error__("Couldn't find either a stored location or a"
@@ -603,8 +5685,29 @@ class Dhop:
             __print_error__("  " + args[0])
             return False
 
-        # OK, it looks like we're clear to *go*. Write the command file and
-        # return.
+        # OK, it looks like we're clear to *go*. Record the visit first. Going
+        # somewhere beneath a stored location (as in 'dhop name/sub/dir')
+        # counts as a visit to the location, too.
+        visited = [os.path.normpath(path)]
+        if location is not None and location not in visited:
+            visited.append(location)
+        self.history.record(visited)
+
+        if self.serving:
+            # 'dhop serve' sends the path back to the shell wrapper.
+            self.cd_target = path
+            return True
+
+        cd_fd = os.environ.get('DHOP_CD_FD')
+        if cd_fd and os.name == 'posix':
+            # the shell function from 'dhop init' reads the path from this
+            # file descriptor, so there's no command file to write (or read
+            # and remove) at all.
+            os.write(int(cd_fd), path.encode(sys.getfilesystemencoding(),
+                                             'surrogateescape'))
+            return True
+
+        # Write the command file and return.
         home_dir = os.path.expanduser('~')  # should work on all systems.
         cmd_file_location = os.path.join(home_dir, Dhop.DHOP_CMD_FILE)
         f = open(cmd_file_location, 'w')
@@ -623,91 +5726,111 @@ class Dhop:
         If it does, return the path.
 
         If it doesn't exist either as a stored location or path, this method
-        will return `None`.
+        prints why and returns `None`.
         """
         # if name is a list, convert it to a string by joining together the
         # elements.
         if type(name) is list:
             name = " ".join(name)
 
-        # First, if the name is an absolute path (starts with '/' on
-        # Unix-likes, and something like 'D:\' on Windows), then no processing
-        # needs to be done. Just check to see if its valid.
-        if os.path.isabs(name):
-            if os.path.exists(name):
-                return os.path.normpath(name)
-            else:
-                __print_error__("Path doesn't exist: %s" % name)
-                return None
-
-        # Now that we've gotten that out of the way...
-        locations = self.store['locations']
-
-        # The path might have directories or a filespec attached. No worries,
-        # just chop off the nose and use that as the part of the path to
-        # dereference.
-        rest_of_the_path = ''
-
-        if name.count(os.sep) != 0:
-            name, rest_of_the_path = name.strip().split(os.sep, 1)
-
-        resolved_path = None
-
-        # The undecorated name *might* refer to a stored location...
-        if name in self.store['locations']:
-            resolved_path = os.sep.join([locations[name], rest_of_the_path])
-            if not os.path.exists(resolved_path):
-                __print_error__("Location %s is set, but does not refer to a valid location!" %
-                    (name, resolved_path))
-                resolved_path = None
-        else:
-            if rest_of_the_path == '':
-                resolved_path = name
-            else:
-                resolved_path = os.sep.join([name, rest_of_the_path])
-            if os.path.exists(resolved_path):
-                resolved_path = os.path.normpath(resolved_path)
-            else:
-                __print_error__("Location or path doesn't exist: %s" % resolved_path)
-                resolved_path = None
-
-        # whatever it is (or isn't), return it.
-        return resolved_path
+        __trace_begin__('resolve')
+        try:
+            return self.__resolve__(name)
+        except LookupError as e:
+            for message in e.args:
+                __print_error__(message)
+            return None
+        finally:
+            __trace_end__('resolve')
+
+    def __resolve__(self, name):
+        """
+        Return the path that name (a stored location or path) refers to, or
+        raise LookupError (with one or more messages saying why) if it
+        doesn't refer to anything. See Resolver.
+        """
+        try:
+            return self.resolver.resolve(name)
+        finally:
+            self.resolved_location = self.resolver.resolved_location
 
     def run(self, args):
         """
-        Run the Dhop main loop
+        Run the Dhop main loop. Returns False if the command failed (commands
+        return False when they fail), and True otherwise.
         """
+        self.resolved_location = None
+
         # first, see if its a known command.
         if args[0] in Dhop.USER_COMMANDS:
-            getattr(self, Dhop.USER_COMMANDS[args[0]])(args[1:])
-            # Write the store (some of the commands might change it).
-            self.__write_store__()
+            if trace is not None:
+                trace.command = args[0]
+            __trace_begin__('command')
+            try:
+                succeeded = getattr(self, Dhop.USER_COMMANDS[args[0]])(
+                    args[1:]) is not False
+                __trace_end__('command')
+                # Write the store (some of the commands might change it).
+                self.__write_store__()
+            except BaseException:
+                # don't leave a half-made change (or, with the sqlite
+                # backend, an open write transaction) behind.
+                self.backend.rollback()
+                raise
         else:
+            if trace is not None:
+                trace.command = 'hop'
             # it might be a location or path, in which case, just go there...
             path = self.resolve_location_or_path(args)
 
             if path is None:
                 print("Type `dhop help` for a list of commands.")
-                return
+                succeeded = False
             else:
-                self.go([path])
+                succeeded = self.go([path]) is not False
                 # There's no need to write the store here... going someplace
                 # doesn't change a thing. Well, not in dhop.
-        return
+
+        # keep what was learned about which paths exist for the next run.
+        __trace_begin__('save stat cache')
+        self.stat_cache.save()
+        __trace_end__('save stat cache')
+        return succeeded
+
+def main(args):
+    """
+    Run dhop with the given command-line arguments (not including the name of
+    the script).
+
+    The shell wrappers call this after importing dhop as a module, rather than
+    running dhop.py as a script, so that Python loads the cached bytecode
+    instead of compiling the whole file on every hop. Returns the exit status:
+    0, or 1 if the command failed.
+    """
+    # '--trace' (before the command) traces this run; see Trace.
+    forced = len(args) != 0 and args[0] == '--trace'
+    if forced:
+        args = args[1:]
+    __start_trace__(forced)
+
+    try:
+        dhop = Dhop()
+
+        # Dhop needs at least one command.
+        if len(args) == 0:
+            dhop.show_help()
+            return 0
+
+        # A command was provided... run it.
+        if not dhop.run(args):
+            return 1
+    finally:
+        __finish_trace__()
+    return 0
 
 # ==========
 # the script
 # ==========
-if sys.argv[0] == __file__:
-    dhop = Dhop()
-
-    # Dhop needs at least one command.
-    if len(sys.argv) < 2:
-        dhop.show_help()
-        sys.exit(0)
-
-    # A command was provided... run it.
-    dhop.run(sys.argv[1:])
-    sys.exit(0)
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
 
@@ -0,0 +1,33 @@
+# Shared fixtures for the dhop tests.
+#
+# Copyright (C) 2013-2018, Abstrys / Eron Hennessey
+#
+# This file is released under the terms of the GNU General Public License, v3.
+# For details about this license, see LICENSE.txt or go to
+# <http://www.gnu.org/licenses/gpl.html>
+#
+# The tests import dhop.py the way the shell wrappers do (as the module
+# 'dhop'), and run everything in a temporary home directory.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src', 'dhop'))
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """
+    A temporary home directory, with none of dhop's settings from the
+    environment, and no runtime directory.
+    """
+    home_dir = tmp_path / 'home'
+    home_dir.mkdir()
+    monkeypatch.setenv('HOME', str(home_dir))
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    for name in list(os.environ):
+        if name.startswith('DHOP_'):
+            monkeypatch.delenv(name)
+    return home_dir
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+import dhop
+
+
+def test_a_resolver_reads_and_writes_nothing_until_used(home):
+    resolver = dhop.Resolver(home_dir=str(home))
+    assert resolver.store is None
+    assert os.listdir(str(home)) == []
+
+
+def test_resolving_with_a_given_store_leaves_home_alone(home, tmp_path):
+    (home / '.dhopcmd').write_text('cd /\n')
+    resolver = dhop.Resolver(dhop.MemoryStore({'proj': str(tmp_path)}))
+    assert os.path.normpath(resolver.resolve('proj')) == str(tmp_path)
+    assert sorted(os.listdir(str(home))) == ['.dhopcmd']
+
+
+def test_errors_are_raised_not_printed(home, tmp_path, capsys):
+    resolver = dhop.Resolver(dhop.MemoryStore({
+        'gone': str(tmp_path / 'gone')}))
+    with pytest.raises(dhop.InvalidLocationError) as error:
+        resolver.resolve('gone')
+    assert error.value.path.startswith(str(tmp_path / 'gone'))
+    with pytest.raises(dhop.NotFoundError):
+        resolver.resolve('nowhere')
+    assert capsys.readouterr() == ('', '')
+
+
+def test_open_store_rejects_an_unknown_backend(home):
+    with pytest.raises(dhop.DhopError):
+        dhop.open_store(str(home), 'nosuch')
+    assert isinstance(dhop.open_store(str(home), 'json'), dhop.JsonStore)
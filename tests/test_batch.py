@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+
+import dhop
+
+
+def run_batch(tmp_path, lines, *options):
+    batch_path = tmp_path / 'batch'
+    batch_path.write_text('\n'.join(lines) + '\n')
+    dhop_object = dhop.Dhop()
+    dhop_object.run(['batch'] + list(options) + [str(batch_path)])
+    return dhop_object
+
+
+def test_failed_lines_are_reported_and_the_rest_run(home, tmp_path, capsys):
+    dhop_object = run_batch(tmp_path, [
+        'set a %s' % tmp_path,
+        'set b %s' % (tmp_path / 'missing'),
+        'set c %s' % tmp_path])
+    assert 'batch line 2 failed' in capsys.readouterr().out
+    assert dhop_object.backend.get_location('a') == str(tmp_path)
+    assert dhop_object.backend.get_location('b') is None
+    assert dhop_object.backend.get_location('c') == str(tmp_path)
+
+
+def test_an_atomic_batch_cant_copy(home, tmp_path, capsys):
+    (tmp_path / 'a.txt').write_bytes(b'a')
+    dhop_object = run_batch(tmp_path, [
+        'set a %s' % tmp_path,
+        'cp %s %s' % (tmp_path / 'a.txt', tmp_path / 'b.txt')], '--atomic')
+    assert "can't be used in an atomic batch" in capsys.readouterr().out
+    assert not (tmp_path / 'b.txt').exists()
+    assert dhop.JsonStore(str(home)).get_location('a') is None
+
+
+def test_the_store_is_saved_before_copying(home, tmp_path, monkeypatch):
+    monkeypatch.setenv('DHOP_BACKEND', 'sqlite')
+    locked = []
+
+    def cp(self, args):
+        locked.append(self.backend.db.in_transaction)
+    monkeypatch.setattr(dhop.Dhop, 'cp', cp)
+
+    run_batch(tmp_path, ['set a %s' % tmp_path, 'cp a.txt b.txt'])
+    assert locked == [False]
+
+
+def test_a_failing_check_makes_dhop_exit_non_zero(home, tmp_path):
+    batch_path = tmp_path / 'batch'
+    batch_path.write_text('set a %s\ncheck --bogus\n' % tmp_path)
+    # as the shell wrappers run it.
+    script = ('import sys; sys.path.insert(0, sys.argv.pop(1)); '
+              'import dhop; sys.exit(dhop.main(sys.argv[1:]))')
+    status = subprocess.call(
+        [sys.executable, '-c', script, os.path.dirname(dhop.__file__),
+         'batch', str(batch_path)], stdout=subprocess.DEVNULL)
+    assert status != 0
+    # the rest of the batch was still saved.
+    assert dhop.JsonStore(str(home)).get_location('a') == str(tmp_path)
+
+
+def test_a_failing_check_stops_an_atomic_batch(home, tmp_path):
+    batch_path = tmp_path / 'batch'
+    batch_path.write_text('set a %s\ncheck extra\n' % tmp_path)
+    assert dhop.main(['batch', '--atomic', str(batch_path)]) == 1
+    assert dhop.JsonStore(str(home)).get_location('a') is None
+
+
+def test_a_failed_pop_is_a_failure(home):
+    assert dhop.Dhop().run(['pop']) is False
+
+
+def test_null_separated_commands_from_stdin(home, tmp_path, monkeypatch):
+    import io
+    (tmp_path / 'a\nb').mkdir()
+    commands = ['set one %s' % tmp_path, "set two '%s'" % (tmp_path / 'a\nb')]
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('\0'.join(commands)))
+
+    assert dhop.Dhop().run(['batch', '--null'])
+    store = dhop.JsonStore(str(home))
+    assert store.get_location('one') == str(tmp_path)
+    assert store.get_location('two') == str(tmp_path / 'a\nb')
@@ -0,0 +1,39 @@
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+import dhop
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'bench'))
+import run_bench
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_a_synthetic_home_loads_every_location(home, monkeypatch, backend):
+    monkeypatch.setattr(run_bench, 'TARGET_DIRS', 3)
+    monkeypatch.setattr(run_bench, 'STACK_DEPTH', 10)
+    home_dir = run_bench.make_home(50, backend)
+    try:
+        monkeypatch.setenv('HOME', home_dir)
+        monkeypatch.setenv('DHOP_BACKEND', backend)
+        instance = dhop.Dhop()
+        assert len(list(instance.backend.names())) == 50
+        assert os.path.isdir(instance.resolve_location_or_path('loc49'))
+    finally:
+        shutil.rmtree(home_dir)
+
+
+def test_compare_counts_timings_that_got_slower(tmp_path, capsys):
+    old_path = str(tmp_path / 'old.json')
+    with open(old_path, 'w') as old_file:
+        json.dump({'quick': False, 'results': {'init 1000': 10.0,
+                                               'write 1000': 10.0}},
+                  old_file)
+    results = {'init 1000': 10.0 * run_bench.TOLERANCE + 1,
+               'write 1000': 10.0}
+    assert run_bench.compare(results, False, old_path) == 1
+    assert '!! 1 timing(s)' in capsys.readouterr().out
@@ -0,0 +1,28 @@
+import dhop
+
+
+def test_check_lists_and_prunes_missing_locations(home, tmp_path, capsys):
+    (tmp_path / 'here').mkdir()
+    (tmp_path / 'file').write_bytes(b'')
+    store = dhop.JsonStore(str(home))
+    store.set_location('here', str(tmp_path / 'here'))
+    store.set_location('gone', str(tmp_path / 'gone'))
+    store.set_location('file', str(tmp_path / 'file'))
+    store.push(str(tmp_path / 'gone'))
+    store.push(str(tmp_path / 'here'))
+    store.set_mark(str(tmp_path / 'gone'))
+    store.commit()
+
+    assert dhop.Dhop().run(['check', '--jobs', '2'])
+    output = capsys.readouterr().out
+    assert 'gone: %s (missing)' % (tmp_path / 'gone') in output
+    assert 'file: %s (not a directory)' % (tmp_path / 'file') in output
+    assert 'here:' not in output
+    # nothing is changed without --prune.
+    assert dhop.JsonStore(str(home)).get_location('gone') is not None
+
+    assert dhop.Dhop().run(['check', '--prune'])
+    store = dhop.JsonStore(str(home))
+    assert sorted(store.names()) == ['here']
+    assert store.dump()['stack'] == [str(tmp_path / 'here')]
+    assert store.get_mark() == ''
@@ -0,0 +1,56 @@
+import pytest
+
+import dhop
+
+
+def completion_names(home):
+    names = set()
+    for line in open(str(home / '.dhop.completions')):
+        (name, tab, path) = line.rstrip('\n').partition('\t')
+        if len(path) != 0:
+            names.add(name)
+    return names
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_concurrent_changes_all_reach_the_completions(home, tmp_path,
+                                                      backend):
+    store_class = dhop.Dhop.BACKENDS[backend]
+    first = store_class(str(home))
+    second = store_class(str(home))
+
+    first.set_location('one', str(tmp_path))
+    first.commit()
+    second.set_location('two', str(tmp_path))
+    second.commit()
+    assert completion_names(home) == set(['one', 'two'])
+
+    first.forget('one')
+    first.commit()
+    assert completion_names(home) == set(['two'])
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite', 'sharded'])
+def test_completions_are_written_in_the_stores_home(home, tmp_path,
+                                                   backend):
+    other_home = tmp_path / 'other'
+    other_home.mkdir()
+    store = dhop.Dhop.BACKENDS[backend](str(other_home))
+    store.set_location('one', str(tmp_path))
+    store.commit()
+
+    assert completion_names(other_home) == set(['one'])
+    assert not (home / '.dhop.completions').exists()
+
+
+def test_init_writes_the_commands_and_locations(home, tmp_path, capsys):
+    store = dhop.JsonStore(str(home))
+    store.set_location('proj', str(tmp_path))
+    store.commit()
+    (home / '.dhop.completions').unlink()
+
+    assert dhop.Dhop().run(['init', 'bash']) is not False
+    assert '-F _dhop_complete dhop' in capsys.readouterr().out
+    lines = (home / '.dhop.completions').read_text().splitlines()
+    assert 'cp\t' in lines
+    assert 'proj\t%s' % tmp_path in lines
@@ -0,0 +1,51 @@
+import os
+
+import dhop
+
+
+def test_find_lists_matching_directories_under_locations(home, tmp_path,
+                                                         capsys):
+    root = tmp_path / 'proj'
+    for path in ['src/tests', 'docs', 'lib/test_data', '.git/tests',
+                 'node_modules/tests']:
+        (root / path).mkdir(parents=True)
+    store = dhop.JsonStore(str(home))
+    store.set_location('proj', str(root))
+    store.commit()
+
+    assert dhop.Dhop().run(['find', 'test'])
+    assert capsys.readouterr().out.splitlines() == [
+        os.path.join('proj', 'lib', 'test_data'),
+        os.path.join('proj', 'src', 'tests')]
+    assert (home / '.dhop.dirs').exists()
+
+    assert dhop.Dhop().run(['find', '--paths', 'test*'])
+    assert capsys.readouterr().out.splitlines() == [
+        str(root / 'lib' / 'test_data'), str(root / 'src' / 'tests')]
+
+
+def test_a_refresh_only_rereads_changed_directories(home, tmp_path,
+                                                    monkeypatch):
+    root = tmp_path / 'proj'
+    (root / 'a' / 'deep').mkdir(parents=True)
+    (root / 'b').mkdir()
+    # times from the last few seconds aren't trusted.
+    for path in [root, root / 'a', root / 'a' / 'deep', root / 'b']:
+        os.utime(str(path), (1000000000, 1000000000))
+    index = dhop.DirectoryIndex(str(home / '.dhop.dirs'))
+    index.refresh([str(root)], 2, 2.0)
+
+    (root / 'b' / 'new').mkdir()
+    os.utime(str(root / 'b'), (1000000100, 1000000100))
+    read = []
+    scandir = os.scandir
+
+    def recording_scandir(path):
+        read.append(path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', recording_scandir)
+    index.refresh([str(root)], 2, 2.0)
+
+    assert str(root / 'b') in read
+    assert str(root / 'a') not in read
+    assert list(index.find('new')) == [str(root / 'b' / 'new')]
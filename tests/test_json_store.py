@@ -0,0 +1,59 @@
+import dhop
+
+
+def test_version_only_changes_with_the_locations(home, tmp_path):
+    store = dhop.JsonStore(str(home))
+    store.set_location('proj', str(tmp_path))
+    store.commit()
+    version = store.version()
+
+    store = dhop.JsonStore(str(home))
+    store.push(str(tmp_path))
+    store.set_mark(str(tmp_path))
+    store.commit()
+    assert dhop.JsonStore(str(home)).version() == version
+
+    store.set_location('other', str(tmp_path))
+    assert store.version() != version
+
+
+def test_version_is_kept_when_the_journal_is_compacted(home, tmp_path):
+    store = dhop.JsonStore(str(home))
+    store.set_location('proj', str(tmp_path))
+    store.commit()
+    version = store.version()
+
+    store.compact()
+    store = dhop.JsonStore(str(home))
+    assert store.version() == version
+    assert 'generation' not in store.dump()
+
+
+def test_changes_are_appended_to_the_journal(home, tmp_path):
+    store = dhop.JsonStore(str(home))
+    store.set_location('proj', str(tmp_path))
+    store.push(str(tmp_path))
+    store.commit()
+    assert not (home / '.dhop.json').exists()
+    assert len((home / '.dhop.journal').read_text().splitlines()) == 2
+
+    store.forget('proj')
+    store.commit()
+    assert len((home / '.dhop.journal').read_text().splitlines()) == 3
+
+    # another process replays the journal.
+    reloaded = dhop.JsonStore(str(home))
+    assert reloaded.get_location('proj') is None
+    assert reloaded.pop() == str(tmp_path)
+
+
+def test_compacting_folds_the_journal_into_the_snapshot(home, tmp_path):
+    store = dhop.JsonStore(str(home))
+    store.set_location('proj', str(tmp_path))
+    store.commit()
+
+    store.compact()
+    assert (home / '.dhop.json').exists()
+    assert (not (home / '.dhop.journal').exists() or
+            (home / '.dhop.journal').read_text() == '')
+    assert dhop.JsonStore(str(home)).get_location('proj') == str(tmp_path)
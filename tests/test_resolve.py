@@ -0,0 +1,174 @@
+import os
+import select
+import subprocess
+import sys
+
+import pytest
+
+import dhop
+
+DHOP_DIR = os.path.dirname(dhop.__file__)
+
+
+def make_location(home, tmp_path, name='proj'):
+    target = tmp_path / name
+    (target / 'sub').mkdir(parents=True)
+    dhop_object = dhop.Dhop()
+    dhop_object.backend.set_location(name, str(target))
+    dhop_object.__write_store__()
+    return target
+
+
+def test_hop_below_a_location_records_both_visits(home, tmp_path):
+    target = make_location(home, tmp_path)
+
+    dhop.Dhop().run(['proj/sub'])
+
+    scores = dhop.History(str(home)).scores()
+    assert str(target / 'sub') in scores
+    assert str(target) in scores
+
+
+def test_path_stdin_streams_each_result(home, tmp_path):
+    target = make_location(home, tmp_path)
+
+    # a reader that waits for each answer before asking the next question
+    # would hang if the results weren't flushed as they're written.
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'import sys; sys.path.insert(0, sys.argv[1]); '
+         'import dhop; dhop.main(sys.argv[2:])', DHOP_DIR, 'path', '--stdin'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        universal_newlines=True, bufsize=1)
+    try:
+        for name in ['proj', 'proj/sub']:
+            process.stdin.write(name + '\n')
+            process.stdin.flush()
+            assert select.select([process.stdout], [], [], 10)[0]
+            assert os.path.normpath(process.stdout.readline().strip()) == \
+                os.path.normpath(os.path.join(str(target), name[5:]))
+    finally:
+        process.kill()
+        process.wait(10)
+
+
+def test_errors_name_the_whole_name(tmp_path):
+    (tmp_path / 'proj').mkdir()
+    resolver = dhop.Resolver(dhop.MemoryStore({
+        'proj': str(tmp_path / 'proj'), 'gone': str(tmp_path / 'gone')}))
+
+    with pytest.raises(dhop.NotFoundError) as error:
+        resolver.resolve('nosuch/sub')
+    assert error.value.name == 'nosuch/sub'
+
+    with pytest.raises(dhop.InvalidLocationError) as error:
+        resolver.resolve('gone/sub')
+    assert error.value.name == 'gone/sub'
+
+
+def test_memory_store_rolls_back_to_its_last_commit(tmp_path):
+    store = dhop.MemoryStore({'proj': str(tmp_path)})
+    store.set_location('other', str(tmp_path))
+    store.commit()
+    store.forget('proj')
+    store.rollback()
+    assert sorted(store.names()) == ['other', 'proj']
+    assert store.snapshot_path is None
+
+
+def test_a_hop_sends_the_directory_on_the_cd_fd(home, tmp_path, monkeypatch):
+    (read_fd, write_fd) = os.pipe()
+    monkeypatch.setenv('DHOP_CD_FD', str(write_fd))
+    try:
+        assert dhop.Dhop().run([str(tmp_path)])
+        os.close(write_fd)
+        write_fd = None
+        assert os.read(read_fd, 4096).decode() == str(tmp_path)
+    finally:
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+    assert not (home / dhop.Dhop.DHOP_CMD_FILE).exists()
+
+
+def test_a_unique_prefix_or_a_close_name_finds_a_location(tmp_path,
+                                                          monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ['project', 'photos', 'papers']:
+        (tmp_path / 'dirs' / name).mkdir(parents=True)
+    resolver = dhop.Resolver(dhop.MemoryStore(dict(
+        (name, str(tmp_path / 'dirs' / name))
+        for name in ['project', 'photos', 'papers'])))
+
+    assert os.path.normpath(resolver.resolve('proj')) == \
+        str(tmp_path / 'dirs' / 'project')
+
+    with pytest.raises(dhop.NotFoundError) as error:
+        resolver.resolve('p')
+    assert sorted(error.value.suggestions) == ['papers', 'photos', 'project']
+
+    with pytest.raises(dhop.NotFoundError) as error:
+        resolver.resolve('phtoos')
+    assert error.value.suggestions[0] == 'photos'
+
+
+def test_the_name_index_is_kept_until_the_locations_change(tmp_path):
+    store = dhop.MemoryStore({'project': str(tmp_path)})
+    index_path = str(tmp_path / 'index')
+    dhop.Resolver(store, index_path=index_path).location_index()
+    assert dhop.LocationIndex.load(index_path).stamp == store.version()
+
+    store.set_location('other', str(tmp_path))
+    index = dhop.Resolver(store, index_path=index_path).location_index()
+    assert index.prefix('oth') == ['other']
+
+
+def test_the_most_visited_location_wins_a_shared_prefix(home, tmp_path,
+                                                        monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ['proj-a', 'proj-b']:
+        make_location(home, tmp_path, name)
+    for n in range(3):
+        dhop.Dhop().run(['proj-b'])
+    dhop.Dhop().run(['proj-a'])
+
+    history = dhop.History(str(home))
+    resolver = dhop.Resolver(dhop.JsonStore(str(home)), history=history)
+    assert os.path.normpath(resolver.resolve('proj')) == \
+        str(tmp_path / 'proj-b')
+
+
+def test_list_shows_the_most_visited_locations_first(home, tmp_path,
+                                                    monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    for name in ['alpha', 'beta']:
+        make_location(home, tmp_path, name)
+    dhop.Dhop().run(['beta'])
+    capsys.readouterr()
+
+    dhop.Dhop().run(['list'])
+    lines = capsys.readouterr().out.splitlines()
+    assert lines.index('beta: %s' % (tmp_path / 'beta')) < \
+        lines.index('alpha: %s' % (tmp_path / 'alpha'))
+
+
+def test_path_stdin_output_formats(home, tmp_path, monkeypatch, capsys):
+    import io
+    import json
+    monkeypatch.chdir(tmp_path)
+    target = make_location(home, tmp_path)
+    dhop_object = dhop.Dhop()
+
+    output = io.StringIO()
+    dhop_object.__resolve_stream__(io.StringIO('proj\0nosuch\0'), output,
+                                   null=True)
+    results = output.getvalue().split('\0')
+    assert os.path.normpath(results[0]) == str(target)
+    assert results[1:] == ['', '']
+    assert 'nosuch' in capsys.readouterr().err
+
+    output = io.StringIO()
+    dhop_object.__resolve_stream__(io.StringIO('proj/sub\nnosuch\n'), output,
+                                   as_json=True)
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert os.path.normpath(results[0]['path']) == str(target / 'sub')
+    assert results[1]['name'] == 'nosuch' and 'error' in results[1]
@@ -0,0 +1,39 @@
+import socket
+
+import dhop
+
+
+def serve_request(dhop_object, cwd, args):
+    (client, server) = socket.socketpair()
+    try:
+        request = [str(len(args)), str(cwd)] + list(args)
+        client.sendall(''.join([field + '\0' for field in request]).encode())
+        client.shutdown(socket.SHUT_WR)
+        dhop_object.__serve_request__(server)
+        server.close()
+        reply = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+        return reply.decode()
+    finally:
+        client.close()
+
+
+def test_a_served_hop_replies_with_the_directory(home, tmp_path,
+                                                 monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'proj').mkdir()
+    dhop_object = dhop.Dhop()
+    dhop_object.backend.set_location('proj', str(tmp_path / 'proj'))
+
+    reply = serve_request(dhop_object, tmp_path, ['proj'])
+    assert reply.split('\n')[:2] == ['ok', str(tmp_path / 'proj')]
+
+
+def test_other_commands_are_left_to_dhop(home, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    reply = serve_request(dhop.Dhop(), tmp_path, ['cp', 'a', 'b'])
+    assert reply == 'fallback\n'
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+
+import dhop
+
+
+def dead_pid():
+    # the ID of a process that has exited.
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_a_named_session_outlives_its_shell(home):
+    store = dhop.SessionStore(dhop.MemoryStore(), str(home), 'work',
+                              pid=dead_pid())
+    store.push('/a')
+    store.commit()
+
+    # a later terminal, with another shell, gets the same stack.
+    store = dhop.SessionStore(dhop.MemoryStore(), str(home), 'work',
+                              pid=os.getpid())
+    assert store.pop() == '/a'
+
+
+def test_an_auto_session_left_by_a_dead_shell_is_ignored(home):
+    store = dhop.SessionStore(dhop.MemoryStore(), str(home), 'tty1',
+                              pid=dead_pid(), auto=True)
+    store.push('/a')
+    store.commit()
+
+    store = dhop.SessionStore(dhop.MemoryStore(), str(home), 'tty1',
+                              pid=os.getpid(), auto=True)
+    assert store.pop() is None
+
+
+def test_only_dead_auto_sessions_are_collected(home, monkeypatch):
+    monkeypatch.setattr(dhop.SessionStore, 'GC_INTERVAL', 0)
+    pid = dead_pid()
+    for (name, auto) in [('work', False), ('tty1', True)]:
+        store = dhop.SessionStore(dhop.MemoryStore(), str(home), name,
+                                  pid=pid, auto=auto)
+        store.push('/a')
+        store.commit()
+
+    store = dhop.SessionStore(dhop.MemoryStore(), str(home), 'tty2',
+                              pid=os.getpid(), auto=True)
+    store.push('/b')
+    store.commit()
+    sessions = sorted(os.listdir(str(home / '.dhop.sessions')))
+    assert 'work.json' in sessions
+    assert 'tty1.json' not in sessions
+
+
+def test_sessions_shared_by_two_terminals_keep_both_pushes(home):
+    first = dhop.SessionStore(dhop.MemoryStore(), str(home), 'work')
+    second = dhop.SessionStore(dhop.MemoryStore(), str(home), 'work')
+    first.push('/a')
+    second.push('/b')
+    first.commit()
+    second.commit()
+
+    store = dhop.SessionStore(dhop.MemoryStore(), str(home), 'work')
+    assert store.pop(None) == '/a'
@@ -0,0 +1,37 @@
+import dhop
+
+
+def test_commit_doesnt_read_every_shard(home, tmp_path, monkeypatch):
+    store = dhop.ShardedStore(str(home))
+    store.set_location('one', str(tmp_path))
+    store.commit()
+
+    read = []
+    read_json = dhop.ShardedStore.__read_json__
+
+    def counting_read_json(self, path, default):
+        read.append(path)
+        return read_json(self, path, default)
+    monkeypatch.setattr(dhop.ShardedStore, '__read_json__',
+                        counting_read_json)
+
+    store = dhop.ShardedStore(str(home))
+    store.set_location('two', str(tmp_path))
+    store.commit()
+    assert len(read) < 5
+    assert 'two\t%s\n' % tmp_path in open(
+        str(home / '.dhop.completions')).read()
+
+
+def test_migrating_says_the_json_files_are_left_behind(home, tmp_path,
+                                                       capsys):
+    store = dhop.JsonStore(str(home))
+    store.set_location('proj', str(tmp_path))
+    store.commit()
+
+    store = dhop.ShardedStore(str(home))
+    assert store.get_location('proj') == str(tmp_path)
+    assert '.dhop.json' in capsys.readouterr().err
+
+    dhop.ShardedStore(str(home))
+    assert capsys.readouterr().err == ''
@@ -0,0 +1,69 @@
+import pytest
+
+import dhop
+
+
+@pytest.fixture
+def sqlite_home(home, monkeypatch):
+    monkeypatch.setenv('DHOP_BACKEND', 'sqlite')
+    return home
+
+
+def test_failed_command_releases_the_write_lock(sqlite_home, tmp_path,
+                                               monkeypatch):
+    set_location = dhop.SqliteStore.set_location
+
+    def failing_set_location(self, name, path):
+        set_location(self, name, path)
+        raise RuntimeError("failed after the change")
+    monkeypatch.setattr(dhop.SqliteStore, 'set_location', failing_set_location)
+
+    dhop_object = dhop.Dhop()
+    with pytest.raises(RuntimeError):
+        dhop_object.run(['set', 'proj', str(tmp_path)])
+    assert not dhop_object.backend.db.in_transaction
+    assert dhop_object.backend.get_location('proj') is None
+
+
+def test_forgetting_an_unknown_name_starts_no_transaction(sqlite_home):
+    store = dhop.SqliteStore(str(sqlite_home))
+    store.forget('nosuchname')
+    assert not store.db.in_transaction
+    assert store.location_changes == {}
+
+
+def test_version_only_changes_with_the_locations(sqlite_home, tmp_path):
+    store = dhop.SqliteStore(str(sqlite_home))
+    version = store.version()
+    store.push(str(tmp_path))
+    store.set_mark(str(tmp_path))
+    store.commit()
+    assert store.version() == version
+
+    store.set_location('proj', str(tmp_path))
+    store.commit()
+    assert dhop.SqliteStore(str(sqlite_home)).version() != version
+
+
+def test_locations_are_shared_through_the_database(sqlite_home, tmp_path):
+    store = dhop.SqliteStore(str(sqlite_home))
+    store.set_location('proj', str(tmp_path))
+    store.push(str(tmp_path))
+    store.commit()
+
+    other = dhop.SqliteStore(str(sqlite_home))
+    assert other.get_location('proj') == str(tmp_path)
+    assert other.pop() == str(tmp_path)
+    mode = other.db.execute('PRAGMA journal_mode').fetchone()[0]
+    assert mode.lower() == 'wal'
+
+
+def test_the_json_data_is_copied_in(sqlite_home, tmp_path):
+    store = dhop.JsonStore(str(sqlite_home))
+    store.set_location('proj', str(tmp_path))
+    store.set_mark(str(tmp_path))
+    store.commit()
+
+    store = dhop.SqliteStore(str(sqlite_home))
+    assert store.get_location('proj') == str(tmp_path)
+    assert store.get_mark() == str(tmp_path)
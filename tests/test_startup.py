@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+import dhop
+
+DHOP_DIR = os.path.dirname(dhop.__file__)
+
+
+def modules_after(script, home, *args):
+    # runs in a fresh interpreter, as the shell wrappers do.
+    output = subprocess.check_output(
+        [sys.executable, '-I', '-S', '-c',
+         'import sys; sys.path.insert(0, sys.argv.pop(1)); '
+         'before = set(sys.modules); ' + script + '; '
+         'sys.stderr.write(" ".join(sorted(set(sys.modules) - before)))',
+         DHOP_DIR] + list(args),
+        env=dict(os.environ, HOME=str(home)), stderr=subprocess.STDOUT)
+    return set(output.decode().split())
+
+
+def test_importing_dhop_imports_nothing_heavy(home):
+    modules = modules_after('import dhop', home)
+    for name in ['json', 'sqlite3', 'shutil', 'threading', 'glob']:
+        assert name not in modules
+
+
+def test_a_hop_doesnt_load_the_copy_or_database_code(home, tmp_path):
+    modules = modules_after('import dhop; dhop.main(sys.argv[1:])', home,
+                            str(tmp_path))
+    for name in ['sqlite3', 'shutil', 'concurrent.futures', 'glob']:
+        assert name not in modules
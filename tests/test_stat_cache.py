@@ -0,0 +1,129 @@
+import os
+import sys
+
+import pytest
+
+import dhop
+
+
+def test_relative_paths_are_cached_by_absolute_path(home, tmp_path,
+                                                    monkeypatch):
+    # 'build' doesn't exist here...
+    (tmp_path / 'elsewhere').mkdir()
+    monkeypatch.chdir(tmp_path / 'elsewhere')
+    cache = dhop.StatCache(str(home))
+    assert not cache.exists('build')
+    cache.save()
+
+    # ...but it does here, and the earlier miss mustn't count.
+    (tmp_path / 'project' / 'build').mkdir(parents=True)
+    monkeypatch.chdir(tmp_path / 'project')
+    assert dhop.StatCache(str(home)).exists('build')
+
+
+def test_missing_paths_are_not_cached(home, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = dhop.StatCache(str(home))
+    assert not cache.exists('newdir')
+    cache.save()
+
+    os.mkdir(str(tmp_path / 'newdir'))
+    assert cache.exists('newdir')
+    assert dhop.StatCache(str(home)).exists('newdir')
+
+
+def test_existing_paths_are_cached(home, tmp_path):
+    cache = dhop.StatCache(str(home))
+    assert cache.exists(str(tmp_path))
+    cache.save()
+
+    # the second process finds it in the cache, so there's nothing to save.
+    reloaded = dhop.StatCache(str(home))
+    reloaded.exists(str(tmp_path))
+    assert not reloaded.changed
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/task'),
+                    reason="needs /proc to count threads")
+def test_checks_share_one_thread(home, tmp_path):
+    cache = dhop.StatCache(str(home))
+    before = len(os.listdir('/proc/self/task'))
+    for n in range(500):
+        cache.exists(str(tmp_path / ('missing%d' % n)))
+    assert len(os.listdir('/proc/self/task')) <= before + 1
+
+
+def test_the_same_answer_again_isnt_saved(home, tmp_path, monkeypatch):
+    cache = dhop.StatCache(str(home))
+    assert cache.exists(str(tmp_path))
+    cache.save()
+
+    # the entry has expired, but the check finds what it did before.
+    monkeypatch.setattr(dhop.StatCache, 'TTL', 0)
+    reloaded = dhop.StatCache(str(home))
+    assert reloaded.exists(str(tmp_path))
+    assert not reloaded.changed
+
+
+def test_a_hop_writes_nothing_to_the_home_directory(home, tmp_path,
+                                                    monkeypatch):
+    runtime_dir = tmp_path / 'runtime'
+    runtime_dir.mkdir()
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(runtime_dir))
+    (read_fd, write_fd) = os.pipe()
+    monkeypatch.setenv('DHOP_CD_FD', str(write_fd))
+    try:
+        dhop_object = dhop.Dhop()
+        before = sorted(os.listdir(str(home)))
+        assert dhop_object.run([str(tmp_path)])
+        assert sorted(os.listdir(str(home))) == before
+        assert sorted(os.listdir(str(runtime_dir))) == ['dhop.stats',
+                                                         'dhop.visits']
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_visits_reach_the_history_file_in_batches(home, tmp_path,
+                                                  monkeypatch):
+    monkeypatch.setattr(dhop.History, 'PENDING_LIMIT', 100)
+    history = dhop.History(str(home), str(tmp_path))
+    history.record(['/a'])
+    assert not (home / '.dhop.history').exists()
+    assert list(history.scores().keys()) == ['/a']
+
+    for n in range(10):
+        history.record(['/a'])
+    assert (home / '.dhop.history').exists()
+    assert os.path.getsize(str(tmp_path / 'dhop.visits')) < 100
+    assert round(history.scores()['/a']) == 11
+
+
+def test_a_hung_filesystem_times_out_and_stays_failed(home, tmp_path,
+                                                      monkeypatch):
+    import threading
+    import time
+    hung = str(tmp_path / 'hung')
+    release = threading.Event()
+    real_exists = os.path.exists
+
+    def exists(path):
+        if path == hung:
+            release.wait(10)
+        return real_exists(path)
+    monkeypatch.setattr(os.path, 'exists', exists)
+    monkeypatch.setenv('DHOP_STAT_TIMEOUT', '0.2')
+
+    cache = dhop.StatCache()
+    try:
+        with pytest.raises(dhop.UnreachableError):
+            cache.exists(hung)
+        # the answer is cached, so there's no waiting the second time.
+        start = time.time()
+        with pytest.raises(dhop.UnreachableError):
+            cache.exists(hung)
+        assert time.time() - start < 0.1
+        # other paths are checked by a new worker.
+        assert cache.exists(str(tmp_path))
+    finally:
+        release.set()
@@ -0,0 +1,39 @@
+import json
+import os
+
+import dhop
+
+
+def test_trace_prints_phases_and_calls(home, tmp_path, capsys):
+    stat = os.stat
+    assert dhop.main(['--trace', 'path', str(tmp_path)]) == 0
+    err = capsys.readouterr().err
+    assert err.startswith('dhop trace: path')
+    assert 'total' in err
+    assert 'calls: ' in err
+    # the wrapped functions are put back once the run is over.
+    assert dhop.trace is None
+    assert os.stat is stat
+
+
+def test_trace_log_gets_one_record_per_run(home, tmp_path, monkeypatch,
+                                           capsys):
+    log_path = tmp_path / 'trace.log'
+    monkeypatch.setenv('DHOP_TRACE', str(log_path))
+    monkeypatch.setenv('DHOP_TRACE_START', '0')
+    for x in range(2):
+        assert dhop.main(['path', str(tmp_path)]) == 0
+    assert capsys.readouterr().err == ''
+
+    records = [json.loads(line) for line in
+               log_path.read_text().splitlines()]
+    assert len(records) == 2
+    assert records[0]['command'] == 'path'
+    assert 'total' in records[0]['ms']
+    assert 'startup' in records[0]['ms']
+    assert records[0]['calls']['stat'] >= 1
+
+
+def test_no_trace_without_the_setting(home, tmp_path, capsys):
+    assert dhop.main(['path', str(tmp_path)]) == 0
+    assert 'dhop trace' not in capsys.readouterr().err
@@ -0,0 +1,297 @@
+import os
+
+import dhop
+
+
+def gives_up(*args):
+    # what copy_file_range does on filesystems that can't copy in the kernel
+    # (procfs, some FUSE and network mounts): nothing, without an error.
+    return 0
+
+
+def test_copy_falls_back_when_copy_file_range_gives_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, 'copy_file_range', gives_up, raising=False)
+    source = tmp_path / 'source'
+    source.write_bytes(b'data' * 1000)
+
+    transfer = dhop.Transfer()
+    (strategy, error) = transfer.__copy_file__(str(source),
+                                               str(tmp_path / 'target'))
+    assert error is None
+    assert (tmp_path / 'target').read_bytes() == source.read_bytes()
+
+
+def test_large_copy_falls_back_when_copy_file_range_gives_up(home, tmp_path,
+                                                             monkeypatch):
+    monkeypatch.setattr(os, 'copy_file_range', gives_up, raising=False)
+    monkeypatch.setattr(dhop.Transfer, 'CHECKPOINT_SIZE', 1000)
+    source = tmp_path / 'source'
+    source.write_bytes(b'data' * 1000)
+
+    journal = dhop.TransferJournal(str(home), ['cp', 'test'])
+    transfer = dhop.Transfer(journal=journal)
+    transfer.unsupported[(os.stat(str(source)).st_dev,
+                          os.stat(str(tmp_path)).st_dev)] = set(['reflink'])
+    (strategy, error) = transfer.__copy_file__(str(source),
+                                               str(tmp_path / 'target'))
+    journal.close()
+    assert error is None
+    assert (tmp_path / 'target').read_bytes() == source.read_bytes()
+
+
+def test_short_copy_is_not_recorded_as_done(home, tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.write_bytes(b'data' * 1000)
+
+    def short_copy(self, strategy, source_fd, target_fd):
+        # the source shrinks under the copy.
+        os.write(target_fd, b'data')
+        return True
+    monkeypatch.setattr(dhop.Transfer, '__copy_with__', short_copy)
+
+    journal = dhop.TransferJournal(str(home), ['cp', 'test'])
+    transfer = dhop.Transfer(journal=journal)
+    (strategy, error) = transfer.__copy_file__(str(source),
+                                               str(tmp_path / 'target'))
+    journal.close()
+    assert error is not None
+    resumed = dhop.TransferJournal(str(home), ['cp', 'test'], resume=True)
+    assert not resumed.is_done(str(source), str(tmp_path / 'target'))
+
+
+def test_an_existing_path_with_brackets_is_copied_as_it_is(home, tmp_path):
+    source = tmp_path / 'report[1].txt'
+    source.write_bytes(b'data')
+    (tmp_path / 'out').mkdir()
+
+    dhop.Dhop().run(['cp', str(source), str(tmp_path / 'out')])
+    assert (tmp_path / 'out' / 'report[1].txt').read_bytes() == b'data'
+
+
+def test_globs_are_expanded_as_the_copy_goes(home, tmp_path, monkeypatch):
+    import glob
+    found = []
+
+    def iglob(pattern, recursive=False):
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            found.append(name)
+            yield str(tmp_path / name)
+    monkeypatch.setattr(glob, 'iglob', iglob)
+
+    sources = dhop.Dhop().__interpret_src_args__(
+        [str(tmp_path / '*.txt')], str(tmp_path / 'out'), [])
+    assert next(sources) == str(tmp_path / 'a.txt')
+    assert found == ['a.txt']
+
+
+def test_glob_matches_in_the_destination_are_left_out(home, tmp_path,
+                                                      capsys):
+    (tmp_path / 'a.txt').write_bytes(b'a')
+    (tmp_path / 'out').mkdir()
+    (tmp_path / 'out' / 'old.txt').write_bytes(b'old')
+
+    dhop.Dhop().run(['cp', str(tmp_path / '**' / '*.txt'),
+                     str(tmp_path / 'out')])
+    assert 'error' not in capsys.readouterr().out
+    assert sorted(os.listdir(str(tmp_path / 'out'))) == ['a.txt', 'old.txt']
+
+
+def test_a_glob_with_two_matches_needs_a_directory(home, tmp_path, capsys):
+    (tmp_path / 'a.txt').write_bytes(b'a')
+    (tmp_path / 'b.txt').write_bytes(b'b')
+
+    dhop.Dhop().run(['cp', str(tmp_path / '*.txt'), str(tmp_path / 'c.txt')])
+    assert 'the destination must be a directory' in capsys.readouterr().out
+    assert not (tmp_path / 'c.txt').exists()
+
+
+def test_mv_into_a_directory_thats_in_the_way(home, tmp_path):
+    # as with shutil.move: dest/proj is a directory, so proj goes inside it.
+    (tmp_path / 'proj').mkdir()
+    (tmp_path / 'proj' / 'file').write_bytes(b'data')
+    (tmp_path / 'dest' / 'proj').mkdir(parents=True)
+    (tmp_path / 'dest' / 'proj' / 'other').write_bytes(b'other')
+
+    dhop.Dhop().run(['mv', str(tmp_path / 'proj'), str(tmp_path / 'dest')])
+    assert not (tmp_path / 'proj').exists()
+    assert (tmp_path / 'dest' / 'proj' / 'proj' / 'file').read_bytes() == \
+        b'data'
+    assert (tmp_path / 'dest' / 'proj' / 'other').read_bytes() == b'other'
+
+
+def test_a_small_copy_writes_no_journal(home, tmp_path):
+    (tmp_path / 'a.txt').write_bytes(b'a')
+
+    dhop.Dhop().run(['cp', str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')])
+    assert (tmp_path / 'b.txt').read_bytes() == b'a'
+    assert not (home / '.dhop.transfers').exists()
+
+
+def test_journal_records_are_written_once_there_are_enough(home,
+                                                          monkeypatch):
+    monkeypatch.setattr(dhop.TransferJournal, 'MIN_RECORDS', 2)
+    journal = dhop.TransferJournal(str(home), ['cp', 'test'])
+    journal.record('done', '/a', 1, 1)
+    assert not os.path.exists(journal.path)
+
+    journal.record('done', '/b', 1, 1)
+    journal.record('done', '/c', 1, 1)
+    # everything is flushed as it's written.
+    assert len(open(journal.path).readlines()) == 3
+    journal.close()
+
+
+def test_an_unfinished_transfer_keeps_its_journal(home):
+    journal = dhop.TransferJournal(str(home), ['cp', 'test'])
+    journal.record('done', '/a', 1, 1)
+    journal.close()
+
+    resumed = dhop.TransferJournal(str(home), ['cp', 'test'], resume=True)
+    assert resumed.resumed
+    assert resumed.done == {'/a': (1, 1)}
+    resumed.close(remove=True)
+    assert not os.path.exists(resumed.path)
+
+
+def test_mv_to_another_filesystem_keeps_symlinks(home, tmp_path,
+                                                 monkeypatch):
+    monkeypatch.setattr(dhop.Dhop, '__same_device__',
+                        lambda self, source, target, devices: False)
+    (tmp_path / 'outside').mkdir()
+    (tmp_path / 'outside' / 'file').write_bytes(b'outside')
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'file_link').symlink_to(tmp_path / 'outside' / 'file')
+    (tree / 'dir_link').symlink_to(tmp_path / 'outside')
+    (tree / 'loop').symlink_to('.')
+    (tmp_path / 'dest').mkdir()
+
+    assert dhop.Dhop().run(['mv', str(tree), str(tmp_path / 'dest')]) \
+        is not False
+    moved = tmp_path / 'dest' / 'tree'
+    assert not tree.exists()
+    assert os.readlink(str(moved / 'file_link')) == \
+        str(tmp_path / 'outside' / 'file')
+    assert os.readlink(str(moved / 'dir_link')) == str(tmp_path / 'outside')
+    assert os.readlink(str(moved / 'loop')) == '.'
+    assert (tmp_path / 'outside' / 'file').read_bytes() == b'outside'
+
+
+def test_transfer_journals_are_kept_in_the_given_home(home, tmp_path):
+    journal = dhop.TransferJournal(str(tmp_path), ['cp', 'test'])
+    assert os.path.dirname(journal.path) == str(tmp_path / '.dhop.transfers')
+
+
+def test_a_tree_is_copied_by_several_workers(home, tmp_path):
+    source = tmp_path / 'source'
+    for n in range(40):
+        path = source / ('d%d' % (n % 4)) / ('f%02d' % n)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'%d' % n)
+    os.utime(str(source / 'd0'), (1000000000, 1000000000))
+
+    assert dhop.Dhop().run(['cp', '--jobs', '4', str(source),
+                            str(tmp_path / 'target')])
+    for n in range(40):
+        path = tmp_path / 'target' / ('d%d' % (n % 4)) / ('f%02d' % n)
+        assert path.read_bytes() == b'%d' % n
+    # directories get their times once their contents have been copied.
+    assert os.stat(str(tmp_path / 'target' / 'd0')).st_mtime == 1000000000
+
+
+def test_jobs_must_be_a_positive_number(home, tmp_path):
+    (tmp_path / 'a').write_bytes(b'a')
+    assert dhop.Dhop().run(['cp', '--jobs', '0', str(tmp_path / 'a'),
+                            str(tmp_path / 'b')]) is False
+    assert not (tmp_path / 'b').exists()
+
+
+def test_a_strategy_that_fails_isnt_tried_again(tmp_path, monkeypatch):
+    import errno
+    tried = []
+    copy_with = dhop.Transfer.__copy_with__
+
+    def reflink_unsupported(self, strategy, source_fd, target_fd):
+        tried.append(strategy)
+        if strategy == 'reflink':
+            raise OSError(errno.EOPNOTSUPP, 'not supported')
+        return copy_with(self, strategy, source_fd, target_fd)
+    monkeypatch.setattr(dhop.Transfer, '__copy_with__', reflink_unsupported)
+
+    transfer = dhop.Transfer()
+    for name in ['a', 'b']:
+        (tmp_path / name).write_bytes(b'data')
+        (strategy, error) = transfer.__copy_file__(
+            str(tmp_path / name), str(tmp_path / (name + '.copy')))
+        assert error is None and strategy != 'reflink'
+        assert (tmp_path / (name + '.copy')).read_bytes() == b'data'
+    assert tried.count('reflink') == 1
+
+
+def test_sync_copies_only_what_changed(home, tmp_path, capsys):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ['same', 'changed']:
+        (source / name).write_bytes(b'old')
+    (tmp_path / 'dest').mkdir()
+    target = tmp_path / 'dest' / 'source'
+    assert dhop.Dhop().run(['cp', str(source), str(tmp_path / 'dest')])
+
+    (source / 'changed').write_bytes(b'new!')
+    (source / 'added').write_bytes(b'added')
+    (target / 'extra').write_bytes(b'extra')
+    capsys.readouterr()
+    assert dhop.Dhop().run(['cp', '--sync', '--delete', '--verbose',
+                            str(source), str(tmp_path / 'dest')])
+    output = capsys.readouterr().out
+    assert '2 file(s) copied' in output
+    assert '1 unchanged, 1 deleted' in output
+    assert (target / 'changed').read_bytes() == b'new!'
+    assert (target / 'added').read_bytes() == b'added'
+    assert not (target / 'extra').exists()
+
+
+def test_sync_with_checksum_compares_contents(home, tmp_path):
+    (tmp_path / 'source').write_bytes(b'abc')
+    (tmp_path / 'target').write_bytes(b'xyz')
+    stamp = os.stat(str(tmp_path / 'source')).st_mtime
+    os.utime(str(tmp_path / 'target'), (stamp, stamp))
+
+    # the same size and time, so only --checksum sees the difference.
+    assert dhop.Dhop().run(['cp', '--sync', str(tmp_path / 'source'),
+                            str(tmp_path / 'target')])
+    assert (tmp_path / 'target').read_bytes() == b'xyz'
+    assert dhop.Dhop().run(['cp', '--sync', '--checksum',
+                            str(tmp_path / 'source'),
+                            str(tmp_path / 'target')])
+    assert (tmp_path / 'target').read_bytes() == b'abc'
+
+
+def test_cp_link_builds_a_hardlink_farm(home, tmp_path):
+    source = tmp_path / 'build'
+    (source / 'lib').mkdir(parents=True)
+    (source / 'lib' / 'module.so').write_bytes(b'binary')
+    assert dhop.Dhop().run(['cp', '--link', str(source),
+                            str(tmp_path / 'snapshot')])
+    copy = tmp_path / 'snapshot' / 'lib' / 'module.so'
+    assert os.stat(str(copy)).st_ino == \
+        os.stat(str(source / 'lib' / 'module.so')).st_ino
+    assert not os.path.islink(str(tmp_path / 'snapshot' / 'lib'))
+
+
+def test_cp_link_and_sync_cant_be_used_together(home, tmp_path, capsys):
+    (tmp_path / 'source').write_bytes(b'data')
+    assert not dhop.Dhop().run(['cp', '--link', '--sync',
+                                str(tmp_path / 'source'),
+                                str(tmp_path / 'target')])
+    assert "can't be used together" in capsys.readouterr().out
+
+
+def test_mv_on_one_filesystem_renames(home, tmp_path):
+    source = tmp_path / 'tree'
+    source.mkdir()
+    (source / 'file').write_bytes(b'data')
+    inode = os.stat(str(source / 'file')).st_ino
+    assert dhop.Dhop().run(['mv', str(source), str(tmp_path / 'moved')])
+    assert not source.exists()
+    assert os.stat(str(tmp_path / 'moved' / 'file')).st_ino == inode
@@ -0,0 +1,88 @@
+import os
+
+import dhop
+
+
+def watcher_for(tmp_path, locations, monkeypatch, checked):
+    run = dhop.HealthCheck.run
+
+    def counting_run(self, paths):
+        checked.extend(paths)
+        return run(self, paths)
+    monkeypatch.setattr(dhop.HealthCheck, 'run', counting_run)
+    store = dhop.MemoryStore(locations)
+    return (store, dhop.Watcher(store, str(tmp_path / 'valid')))
+
+
+def test_only_new_locations_are_checked(tmp_path, monkeypatch):
+    (tmp_path / 'proj').mkdir()
+    (tmp_path / 'other').mkdir()
+    checked = []
+    (store, watcher) = watcher_for(tmp_path, {'proj': str(tmp_path / 'proj')},
+                                   monkeypatch, checked)
+    assert checked == [str(tmp_path / 'proj')]
+
+    # a push doesn't change the locations, so nothing is checked.
+    store.push(str(tmp_path))
+    store.commit()
+    watcher.__load__()
+    assert checked == [str(tmp_path / 'proj')]
+
+    store.set_location('other', str(tmp_path / 'other'))
+    store.commit()
+    watcher.__load__()
+    assert checked == [str(tmp_path / 'proj'), str(tmp_path / 'other')]
+    assert watcher.valid == set([str(tmp_path / 'proj'),
+                                 str(tmp_path / 'other')])
+
+
+def test_a_move_split_across_reads_is_followed(tmp_path, monkeypatch):
+    (tmp_path / 'proj').mkdir()
+    (store, watcher) = watcher_for(tmp_path, {'proj': str(tmp_path / 'proj')},
+                                   monkeypatch, [])
+    wd = watcher.watched.get(str(tmp_path))
+    if wd is None:
+        # no inotify here; there's nothing to follow the move with.
+        return
+
+    os.rename(str(tmp_path / 'proj'), str(tmp_path / 'renamed'))
+    watcher.__handle__([(wd, dhop.Watcher.IN_MOVED_FROM |
+                         dhop.Watcher.IN_ISDIR, 7, 'proj')])
+    watcher.__handle__([(wd, dhop.Watcher.IN_MOVED_TO |
+                         dhop.Watcher.IN_ISDIR, 7, 'renamed')])
+    assert store.get_location('proj') == str(tmp_path / 'renamed')
+    assert str(tmp_path / 'renamed') in watcher.valid
+
+
+def test_renaming_a_parent_directory_moves_the_location(tmp_path,
+                                                        monkeypatch):
+    (tmp_path / 'work' / 'proj').mkdir(parents=True)
+    (store, watcher) = watcher_for(
+        tmp_path, {'proj': str(tmp_path / 'work' / 'proj')}, monkeypatch, [])
+    if watcher.fd is None:
+        # no inotify here.
+        return
+
+    os.rename(str(tmp_path / 'work'), str(tmp_path / 'play'))
+    assert watcher.__handle__(watcher.__read_events__())
+    assert store.get_location('proj') == str(tmp_path / 'play' / 'proj')
+
+
+def test_hops_can_trust_the_saved_bitmap(tmp_path, monkeypatch):
+    (tmp_path / 'proj').mkdir()
+    (store, watcher) = watcher_for(
+        tmp_path, {'proj': str(tmp_path / 'proj'),
+                   'gone': str(tmp_path / 'gone')}, monkeypatch, [])
+    watcher.__save__()
+
+    validity = dhop.Watcher.read_validity(str(tmp_path / 'valid'))
+    assert dhop.Watcher.is_valid(validity, str(tmp_path / 'proj'),
+                                 store.version())
+    assert not dhop.Watcher.is_valid(validity, str(tmp_path / 'gone'),
+                                     store.version())
+
+    # once the locations change, the bitmap isn't trusted until it's saved
+    # again.
+    store.set_location('other', str(tmp_path))
+    assert not dhop.Watcher.is_valid(validity, str(tmp_path / 'proj'),
+                                     store.version())